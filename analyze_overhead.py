@@ -1,109 +1,141 @@
-import pandas as pd
-import os
-import glob
-from pathlib import Path
-
-# Path to the LongEnough-defended dataset directory
-data_dir = './LongEnough-defended'
-
-# Scrambler subfolder to process
-scrambler_folder = os.path.join(data_dir, 'constant_4000-scramblerz120z1100z400z1000')
-
-# Discover all subfolders dynamically
-subfolders = [f for f in os.listdir(scrambler_folder) 
-              if os.path.isdir(os.path.join(scrambler_folder, f))]
-
-# List to store overhead statistics
-overhead_stats = []
-
-# Find all .log and _modified.log files in the discovered subfolders
-log_files = []
-modified_log_files = []
-for subfolder in subfolders:
-    subfolder_path = os.path.join(scrambler_folder, subfolder)
-    log_files.extend([f for f in glob.glob(os.path.join(subfolder_path, '*.log')) 
-                      if not f.endswith('.qoe.log') and '_modified.log' not in f])
-    modified_log_files.extend([f for f in glob.glob(os.path.join(subfolder_path, '*_modified.log')) 
-                              if not f.endswith('.qoe.log')])
-
-# Check if any log files were found
-if not log_files or not modified_log_files:
-    print("No .log or _modified.log files found in Scrambler subfolders:", subfolders)
-    exit()
-
-# Process each pair of original and modified .log files
-for log_file in log_files:
-    try:
-        # Find corresponding modified file
-        modified_file = log_file.replace('.log', '_modified.log')
-        if modified_file not in modified_log_files:
-            print(f"Warning: No modified file found for {log_file}")
-            continue
-        
-        # Load original .log file
-        df_original = pd.read_csv(log_file, 
-                                  names=['timestamp_ns', 'event_type', 'packet_size', 
-                                         'absolute_timestamp', 'cumulative_sent', 'cumulative_received'])
-        
-        # Load modified .log file
-        df_modified = pd.read_csv(modified_file, 
-                                  names=['timestamp_ns', 'event_type', 'packet_size', 
-                                         'absolute_timestamp', 'cumulative_sent', 'cumulative_received'])
-        
-        # Ensure packet_size is numeric
-        df_original['packet_size'] = pd.to_numeric(df_original['packet_size'], errors='coerce')
-        df_modified['packet_size'] = pd.to_numeric(df_modified['packet_size'], errors='coerce')
-        
-        # Check for non-numeric values
-        if df_original['packet_size'].isna().any():
-            print(f"Warning: Non-numeric packet_size values found in {log_file}. Skipping invalid rows.")
-            df_original = df_original.dropna(subset=['packet_size'])
-        if df_modified['packet_size'].isna().any():
-            print(f"Warning: Non-numeric packet_size values found in {modified_file}. Skipping invalid rows.")
-            df_modified = df_modified.dropna(subset=['packet_size'])
-        
-        # Calculate overhead (total packet size)
-        original_overhead = df_original['packet_size'].sum()
-        modified_overhead = df_modified['packet_size'].sum()
-        
-        # Store statistics
-        stats = {
-            'file': log_file,
-            'original_overhead': original_overhead,
-            'modified_overhead': modified_overhead,
-            'overhead_reduction': original_overhead - modified_overhead,
-            'overhead_reduction_percentage': (original_overhead - modified_overhead) / original_overhead * 100
-        }
-        overhead_stats.append(stats)
-        
-        print(f"Processed {log_file}:")
-        print(f"  Original overhead: {original_overhead} bytes")
-        print(f"  Modified overhead: {modified_overhead} bytes")
-        print(f"  Overhead reduction: {stats['overhead_reduction']} bytes ({stats['overhead_reduction_percentage']:.2f}%)")
-        
-    except Exception as e:
-        print(f"Error processing {log_file}: {e}")
-
-# Convert overhead statistics to a DataFrame
-overhead_df = pd.DataFrame(overhead_stats)
-
-# Check if any statistics were collected
-if overhead_df.empty:
-    print("No valid statistics collected. Check the log files for packet_size data.")
-    exit()
-
-# Calculate aggregated overhead statistics
-overall_original_overhead = overhead_df['original_overhead'].sum()
-overall_modified_overhead = overhead_df['modified_overhead'].sum()
-overall_reduction = overall_original_overhead - overall_modified_overhead
-overall_reduction_percentage = (overall_reduction / overall_original_overhead * 100) if overall_original_overhead > 0 else 0
-
-# Print aggregated overhead statistics
-print("\nAggregated overhead statistics across all Scrambler .log files:")
-print(f"Total original overhead: {overall_original_overhead} bytes")
-print(f"Total modified overhead: {overall_modified_overhead} bytes")
-print(f"Total overhead reduction: {overall_reduction} bytes ({overall_reduction_percentage:.2f}%)")
-
-# Save overhead statistics to a CSV file
-overhead_df.to_csv('overhead_comparison.csv', index=False)
-print("Overhead comparison statistics saved to overhead_comparison.csv")
\ No newline at end of file
+import pandas as pd
+import numpy as np
+import os
+import argparse
+import run_metrics
+from manifest import find_log_files, load_manifest, MANIFEST_FILE
+from trace_cache import load_trace, modified_trace_path, traffic_totals, TOTALS_KEYS
+
+# Path to the LongEnough-defended dataset directory
+data_dir = './LongEnough-defended'
+
+# Scrambler subfolder to process
+scrambler_folder = os.path.join(data_dir, 'constant_4000-scramblerz120z1100z400z1000')
+
+
+def manifest_rows(scrambler_folder):
+    # One row per defended trace from the run manifest, without reading any trace
+    rows = []
+    manifest_path = os.path.join(scrambler_folder, MANIFEST_FILE)
+    with run_metrics.stage('load', manifest_path) as record:
+        entries = load_manifest(manifest_path)
+        record.update(rows=len(entries), bytes_read=run_metrics.file_size(manifest_path))
+    for entry in entries.values():
+        output_file = entry['output_file']
+        if output_file is not None and not os.path.exists(os.path.join(scrambler_folder, output_file)):
+            print(f"Warning: {os.path.join(scrambler_folder, output_file)} listed in the manifest no longer exists")
+        rows.append(overhead_row(entry['file'], entry['label'], entry['original'], entry['modified']))
+    return rows
+
+
+def rescan_rows(scrambler_folder):
+    # Same rows computed by reading every original and modified trace
+    _, log_files = find_log_files(scrambler_folder)
+    rows = [rescan_row(log_file, scrambler_folder) for log_file in log_files]
+    return [row for row in rows if row is not None]
+
+
+def rescan_row(log_file, root):
+    # Overhead row of one trace from its original and modified files, or None if it cannot be read;
+    # the file column holds the path relative to root, as in the run manifest
+    try:
+        # Find corresponding modified file (binary _modified.trc preferred over _modified.log)
+        modified_file = modified_trace_path(log_file)
+        if modified_file is None:
+            print(f"Warning: No modified file found for {log_file}")
+            return None
+
+        # Load original and modified traces through the binary trace cache
+        trace_original = load_trace(log_file)
+        trace_modified = load_trace(modified_file)
+
+        # Check for non-numeric values (stored as -1 in the cache)
+        if (trace_original.packet_size < 0).any():
+            print(f"Warning: Non-numeric packet_size values found in {log_file}. Skipping invalid rows.")
+        if (trace_modified.packet_size < 0).any():
+            print(f"Warning: Non-numeric packet_size values found in {modified_file}. Skipping invalid rows.")
+
+        label = os.path.basename(os.path.dirname(log_file))
+        with run_metrics.stage('aggregate', log_file) as record:
+            row = overhead_row(os.path.relpath(log_file, root), label, traffic_totals(trace_original), traffic_totals(trace_modified))
+            record['rows'] = len(trace_original.timestamp_ns) + len(trace_modified.timestamp_ns)
+        return row
+    except Exception as e:
+        print(f"Error processing {log_file}: {e}")
+        return None
+
+
+def overhead_row(trace_key, label, original, modified):
+    row = {'file': trace_key, 'class': label}
+    row.update({f'original_{key}': original[key] for key in TOTALS_KEYS})
+    row.update({f'modified_{key}': modified[key] for key in TOTALS_KEYS})
+    return row
+
+
+def add_overhead_columns(df):
+    # Byte reduction (positive when the defense saves bandwidth) overall and per direction
+    df['original_overhead'] = df['original_bytes']
+    df['modified_overhead'] = df['modified_bytes']
+    for prefix in ('', 'sent_', 'received_'):
+        original = df[f'original_{prefix}bytes']
+        reduction = original - df[f'modified_{prefix}bytes']
+        df[f'{prefix}overhead_reduction'] = reduction
+        df[f'{prefix}overhead_reduction_percentage'] = np.where(original > 0, reduction / original.where(original > 0, 1) * 100, 0.0)
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="scrambler folder holding the original and defended traces", default=scrambler_folder)
+    parser.add_argument("--rescan", help="read every trace instead of the run manifest", action="store_true")
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    run_metrics.configure(args, 'analyze_overhead')
+
+    manifest_path = os.path.join(args.path, MANIFEST_FILE)
+    if not args.rescan and not os.path.exists(manifest_path):
+        print(f"No run manifest at {manifest_path}; reading the traces instead")
+        args.rescan = True
+    with run_metrics.profiled(args.profile):
+        overhead_stats = rescan_rows(args.path) if args.rescan else manifest_rows(args.path)
+
+    # Convert overhead statistics to a DataFrame
+    overhead_df = pd.DataFrame(overhead_stats)
+
+    # Check if any statistics were collected
+    if overhead_df.empty:
+        print("No valid statistics collected. Check the log files for packet_size data.")
+        exit()
+
+    overhead_df = add_overhead_columns(overhead_df.sort_values('file').reset_index(drop=True))
+
+    # Per-class and overall totals
+    totals = [f'{side}_{key}' for side in ('original', 'modified') for key in TOTALS_KEYS]
+    class_df = overhead_df.groupby('class')[totals].sum()
+    class_df.insert(0, 'traces', overhead_df.groupby('class').size())
+    class_df = add_overhead_columns(class_df.reset_index())
+    class_df = class_df.sort_values('class', key=lambda labels: pd.to_numeric(labels, errors='coerce')).reset_index(drop=True)
+    overall = add_overhead_columns(pd.DataFrame([overhead_df[totals].sum()])).to_dict('records')[0]
+
+    print("Overhead per class:")
+    print(class_df[['class', 'traces', 'original_overhead', 'modified_overhead', 'overhead_reduction_percentage',
+                    'sent_overhead_reduction_percentage', 'received_overhead_reduction_percentage']]
+          .to_string(index=False, float_format=lambda value: f"{value:.2f}"))
+
+    # Print aggregated overhead statistics
+    print(f"\nAggregated overhead statistics across {len(overhead_df)} Scrambler traces:")
+    print(f"Total original overhead: {overall['original_overhead']} bytes")
+    print(f"Total modified overhead: {overall['modified_overhead']} bytes")
+    print(f"Total overhead reduction: {overall['overhead_reduction']} bytes ({overall['overhead_reduction_percentage']:.2f}%)")
+    for direction in ('sent', 'received'):
+        print(f"  {direction.capitalize()}: {overall[f'original_{direction}_bytes']} -> {overall[f'modified_{direction}_bytes']} bytes "
+              f"({overall[f'{direction}_overhead_reduction_percentage']:.2f}% reduction), "
+              f"{overall[f'original_{direction}_packets']} -> {overall[f'modified_{direction}_packets']} packets")
+
+    # Save overhead statistics to CSV files
+    with run_metrics.stage('write') as record:
+        overhead_df.to_csv('overhead_comparison.csv', index=False)
+        class_df.to_csv('overhead_by_class.csv', index=False)
+        record.update(rows=len(overhead_df) + len(class_df),
+                      bytes_written=run_metrics.file_size('overhead_comparison.csv') + run_metrics.file_size('overhead_by_class.csv'))
+    print("Overhead comparison statistics saved to overhead_comparison.csv and overhead_by_class.csv")
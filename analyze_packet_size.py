@@ -1,81 +1,186 @@
-import pandas as pd
-import os
-import glob
-from pathlib import Path
-
-# Path to the LongEnough dataset directory
-data_dir = './LongEnough'
-
-# List of subfolders to process
-subfolders = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', '13', '14', '15']
-
-# List to store statistics for each log file
-stats_list = []
-
-# Find all .log files (excluding .qoe.log) in the specified subfolders
-log_files = []
-for subfolder in subfolders:
-    subfolder_path = os.path.join(data_dir, subfolder)
-    # Get all .log files, excluding those with .qoe.log
-    log_files.extend([f for f in glob.glob(os.path.join(subfolder_path, '*.log')) 
-                      if not f.endswith('.qoe.log')])
-
-# Check if any log files were found
-if not log_files:
-    print("No .log files (excluding .qoe.log) found in the subfolders:", subfolders)
-    exit()
-
-# Process each .log file
-for log_file in log_files:
-    try:
-        # Load the .log file
-        df = pd.read_csv(log_file, 
-                         names=['timestamp_ns', 'event_type', 'packet_size', 
-                                'absolute_timestamp', 'cumulative_sent', 'cumulative_received'])
-        
-        # Filter sent packets (event_type == 's')
-        sent_packets = df[df['event_type'] == 's']
-        
-        # Check if there are sent packets
-        if not sent_packets.empty:
-            # Calculate packet size statistics
-            stats = {
-                'file': log_file,
-                'mean_packet_size': sent_packets['packet_size'].mean(),
-                'std_packet_size': sent_packets['packet_size'].std(),
-                'min_packet_size': sent_packets['packet_size'].min(),
-                'max_packet_size': sent_packets['packet_size'].max(),
-                'count': len(sent_packets)
-            }
-            stats_list.append(stats)
-        else:
-            print(f"Warning: No sent packets found in {log_file}")
-            
-    except Exception as e:
-        print(f"Error processing {log_file}: {e}")
-
-# Convert statistics to a DataFrame
-stats_df = pd.DataFrame(stats_list)
-
-# Check if any statistics were collected
-if stats_df.empty:
-    print("No valid statistics collected. Check the log files for sent packets.")
-    exit()
-
-# Calculate aggregated statistics across all files
-overall_mean = stats_df['mean_packet_size'].mean()
-overall_std = stats_df['std_packet_size'].mean()
-overall_min = stats_df['min_packet_size'].min()
-overall_max = stats_df['max_packet_size'].max()
-
-# Print aggregated statistics
-print("Aggregated packet size statistics for sent packets across all .log files:")
-print(f"Mean packet size: {overall_mean:.2f} bytes")
-print(f"Mean standard deviation: {overall_std:.2f} bytes")
-print(f"Minimum packet size: {overall_min:.2f} bytes")
-print(f"Maximum packet size: {overall_max:.2f} bytes")
-print(f"Total number of sent packets: {stats_df['count'].sum()}")
-
-# Save statistics to a CSV file
-stats_df.to_csv('packet_size_stats.csv', index=False)
-print("Statistics saved to packet_size_stats.csv")
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import run_metrics
+from manifest import find_log_files
+from trace_cache import iter_trace_chunks, EVENT_CODES, SENT_CODES, RECEIVED_CODES
+
+# Path to the LongEnough dataset directory
+data_dir = './LongEnough'
+
+# Histogram of exact sizes in [0, HISTOGRAM_SIZE); larger packets share one overflow bin
+HISTOGRAM_SIZE = 4096
+
+# Percentiles reported for every group
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Statistics groups: both directions, then each event type
+GROUPS = {'sent': SENT_CODES, 'received': RECEIVED_CODES}
+GROUPS.update({event_type: np.array([EVENT_CODES[event_type]], dtype=np.int8) for event_type in ('s', 'r', 'sp', 'rp')})
+
+# Rows read per chunk, which bounds memory regardless of trace length
+CHUNK_ROWS = 1000000
+
+
+class SizeStats:
+    # Mergeable packet size accumulator: count, mean and M2 (sum of squared deviations) combined with
+    # Chan et al.'s pairwise update, exact min/max, and a fixed-bin histogram for percentiles
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.histogram = np.zeros(HISTOGRAM_SIZE + 1, dtype=np.int64)
+
+    def update(self, sizes):
+        if len(sizes) == 0:
+            return
+        sizes = np.asarray(sizes, dtype=np.int64)
+        other = SizeStats()
+        other.count = len(sizes)
+        other.mean = float(sizes.mean())
+        other.m2 = float(((sizes - other.mean) ** 2).sum())
+        other.min = int(sizes.min())
+        other.max = int(sizes.max())
+        other.histogram = np.bincount(np.minimum(sizes, HISTOGRAM_SIZE), minlength=HISTOGRAM_SIZE + 1)
+        self.merge(other)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.histogram += other.histogram
+        return self
+
+    def std(self):
+        # Sample standard deviation, as pandas/numpy with ddof=1
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else float('nan')
+
+    def percentile(self, q):
+        # Nearest-rank percentile; exact for sizes below HISTOGRAM_SIZE
+        if self.count == 0:
+            return float('nan')
+        rank = max(int(np.ceil(q / 100 * self.count)), 1)
+        size = int(np.searchsorted(np.cumsum(self.histogram), rank))
+        return self.max if size >= HISTOGRAM_SIZE else size
+
+    def state(self):
+        # JSON-serializable accumulator, histogram stored sparsely as [[size, count], ...]; see from_state
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2, 'min': self.min, 'max': self.max,
+                'histogram': [[int(size), int(self.histogram[size])] for size in np.flatnonzero(self.histogram)]}
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls()
+        stats.count, stats.mean, stats.m2 = state['count'], state['mean'], state['m2']
+        stats.min, stats.max = state['min'], state['max']
+        for size, count in state['histogram']:
+            stats.histogram[size] = count
+        return stats
+
+    def row(self):
+        row = {
+            'count': self.count,
+            'mean_packet_size': self.mean if self.count else float('nan'),
+            'std_packet_size': self.std(),
+            'min_packet_size': self.min,
+            'max_packet_size': self.max,
+        }
+        row.update({f'p{q}_packet_size': self.percentile(q) for q in PERCENTILES})
+        return row
+
+
+def analyze_file(log_file, chunk_rows=CHUNK_ROWS):
+    # One pass over a trace in chunks; returns {group: SizeStats}
+    stats = {group: SizeStats() for group in GROUPS}
+    with run_metrics.stage('analyze', log_file) as record:
+        for chunk in iter_trace_chunks(log_file, chunk_rows):
+            valid = chunk.packet_size >= 0
+            sizes = chunk.packet_size[valid]
+            event_codes = chunk.event_code[valid]
+            for group, codes in GROUPS.items():
+                stats[group].update(sizes[np.isin(event_codes, codes)])
+            record['rows'] += len(valid)
+            record['bad_rows'] += int((~valid).sum())
+        record['bytes_read'] = run_metrics.file_size(log_file)
+    return stats
+
+
+def _analyze(log_file):
+    try:
+        return log_file, analyze_file(log_file)
+    except Exception as e:
+        print(f"Error processing {log_file}: {e}")
+        return log_file, None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="dataset directory with one subfolder per class", default=data_dir)
+    parser.add_argument("-j", "--workers", help="files analyzed in parallel", type=int, default=os.cpu_count())
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    run_metrics.configure(args, 'analyze_packet_size')
+
+    # Find all .log files (excluding .qoe.log and _modified.log) in every subfolder
+    subfolders, log_files = find_log_files(args.path)
+    if not log_files:
+        print("No .log files (excluding .qoe.log) found in the subfolders of", args.path)
+        exit()
+
+    with run_metrics.profiled(args.profile):
+        if args.workers > 1:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                results = list(run_metrics.map_collected(executor, _analyze, log_files, chunksize=4))
+        else:
+            results = [_analyze(log_file) for log_file in log_files]
+
+    # Per-file rows, and pooled statistics merged from the per-file accumulators
+    pooled = {group: SizeStats() for group in GROUPS}
+    stats_list = []
+    with run_metrics.stage('aggregate') as record:
+        for log_file, stats in results:
+            if stats is None:
+                continue
+            if stats['s'].count == 0:
+                print(f"Warning: No sent packets found in {log_file}")
+            for group, group_stats in stats.items():
+                pooled[group].merge(group_stats)
+                if group_stats.count:
+                    stats_list.append({'file': log_file, 'group': group, **group_stats.row()})
+        record['rows'] = len(stats_list)
+
+    if not stats_list:
+        print("No valid statistics collected. Check the log files for packets.")
+        exit()
+
+    pooled_df = pd.DataFrame([{'group': group, **group_stats.row()} for group, group_stats in pooled.items()])
+
+    print(f"Pooled packet size statistics across {len(log_files)} .log files in {len(subfolders)} folders:")
+    print(pooled_df.to_string(index=False, float_format=lambda value: f"{value:.2f}"))
+
+    padding = SizeStats().merge(pooled['sp']).merge(pooled['rp'])
+    if padding.count:
+        print(f"Padding packets (sp, rp): median {padding.percentile(50)} bytes, "
+              f"5th-95th percentile {padding.percentile(5)}-{padding.percentile(95)} bytes "
+              f"(candidate padding_size_range)")
+
+    # Save statistics to CSV files
+    with run_metrics.stage('write') as record:
+        pd.DataFrame(stats_list).to_csv('packet_size_stats.csv', index=False)
+        pooled_df.to_csv('packet_size_pooled.csv', index=False)
+        record.update(rows=len(stats_list) + len(pooled_df),
+                      bytes_written=run_metrics.file_size('packet_size_stats.csv') + run_metrics.file_size('packet_size_pooled.csv'))
+    print("Statistics saved to packet_size_stats.csv and packet_size_pooled.csv")
@@ -0,0 +1,112 @@
+import numpy as np
+
+from streaming_defense import SENT_COUNTED, RECEIVED_COUNTED
+from trace_cache import Trace, COLUMN_DTYPES, PADDING_CODES
+
+
+def concatenate_traces(traces):
+    # One Trace holding the valid rows of every trace back to back, and offsets (len(traces) + 1)
+    # such that trace i occupies rows offsets[i]:offsets[i + 1]
+    valid = [trace.packet_size >= 0 for trace in traces]
+    offsets = np.concatenate([[0], np.cumsum([int(mask.sum()) for mask in valid], dtype=np.int64)]).astype(np.int64)
+    return Trace(*(
+        np.concatenate([np.asarray(getattr(trace, column)[mask]) for trace, mask in zip(traces, valid)]
+                       + [np.empty(0, dtype=dtype)]).astype(dtype)
+        for column, dtype in COLUMN_DTYPES.items()
+    )), offsets
+
+
+def split_traces(trace, offsets):
+    # Inverse of concatenate_traces
+    return [Trace(*(column[start:stop] for column in trace)) for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def segment_ids(offsets):
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def segmented_cumsum(values, offsets):
+    # Running sums restarting at every segment
+    total = np.cumsum(values, dtype=np.int64)
+    before = np.concatenate([[0], total])[offsets[:-1]]
+    return total - np.repeat(before, np.diff(offsets))
+
+
+def random_ranks(groups, n_groups, rng):
+    # Uniformly random rank of every element within its group (0 .. group size - 1);
+    # keeping ranks below k takes a uniform k-subset of each group
+    sizes = np.bincount(groups, minlength=n_groups)
+    order = np.lexsort((rng.random(len(groups)), groups))
+    ranks = np.empty(len(groups), dtype=np.int64)
+    ranks[order] = np.arange(len(groups)) - np.repeat(np.concatenate([[0], np.cumsum(sizes)])[:-1], sizes)
+    return ranks
+
+
+def batch_defense(trace, offsets, rng, padding_size_range, time_scramble_std, padding_reduction_ratio,
+                  extra_dummy_packets):
+    # modify_padding_improved.apply_defense applied to every trace of a concatenated batch in a few
+    # vectorized passes. Each trace gets the same treatment as the per-file path (exactly
+    # int(padding * ratio) padding packets kept, chosen uniformly; resized padding; jitter; dummies up to
+    # its last timestamp; stable time sort; recounted cumulative columns), but the random draws come from
+    # one stream for the whole batch, so outputs are equal in distribution, not bit-identical.
+    # Returns (defended trace, offsets).
+    n_traces = len(offsets) - 1
+    segments = segment_ids(offsets)
+    event_code = trace.event_code
+
+    # 1. Padding reduction: rank each trace's padding packets by a random key and keep the lowest
+    padding = np.isin(event_code, PADDING_CODES)
+    padding_rows = np.flatnonzero(padding)
+    padding_segments = segments[padding_rows]
+    n_padding = np.bincount(padding_segments, minlength=n_traces)
+    n_keep = (n_padding * padding_reduction_ratio).astype(np.int64)
+    keep = np.ones(len(event_code), dtype=bool)
+    keep[padding_rows] = random_ranks(padding_segments, n_traces, rng) < n_keep[padding_segments]
+
+    segments = segments[keep]
+    event_code = event_code[keep]
+    padding = padding[keep]
+    size = np.asarray(trace.packet_size[keep], dtype=np.int64)
+    absolute = trace.absolute_timestamp[keep]
+    lengths = np.bincount(segments, minlength=n_traces)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    # 2. Randomize padding packet sizes
+    size[padding] = rng.integers(padding_size_range[0], padding_size_range[1] + 1, size=int(padding.sum()), dtype=np.int64)
+
+    # 3. Time scrambling
+    noise = rng.normal(0, time_scramble_std, size=len(segments)).astype(np.int64)
+    timestamp = np.maximum(trace.timestamp_ns[keep] + noise, 0)
+
+    # 4. Absolute timestamps from each trace's first remaining packet
+    has_rows = lengths > 0
+    start_time = np.zeros(n_traces, dtype=np.int64)
+    start_time[has_rows] = absolute[offsets[:-1][has_rows]]
+
+    # 5. Dummy packets up to each trace's last timestamp (traces left empty get none)
+    max_time = np.zeros(n_traces, dtype=np.int64)
+    np.maximum.at(max_time, segments, timestamp)
+    dummy_segments = np.repeat(np.flatnonzero(has_rows), extra_dummy_packets)
+    dummy_times = rng.integers(0, max_time[dummy_segments] + 1, dtype=np.int64)
+    dummy_codes = rng.choice(PADDING_CODES, size=len(dummy_segments))
+    dummy_sizes = rng.integers(padding_size_range[0], padding_size_range[1] + 1, size=len(dummy_segments), dtype=np.int64)
+
+    # 6. Segmented stable sort; dummies come after original packets with the same timestamp
+    segments = np.concatenate([segments, dummy_segments])
+    timestamp = np.concatenate([timestamp, dummy_times])
+    order = np.lexsort((timestamp, segments))
+    segments = segments[order]
+    timestamp = timestamp[order]
+    event_code = np.concatenate([event_code, dummy_codes])[order]
+    size = np.concatenate([size, dummy_sizes])[order]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(segments, minlength=n_traces))])
+
+    # 7. Segmented cumulative counts
+    return Trace(
+        timestamp_ns=timestamp,
+        event_code=event_code,
+        packet_size=size,
+        absolute_timestamp=start_time[segments] + (timestamp / 1e6).astype(np.int64),
+        cumulative_sent=segmented_cumsum(np.isin(event_code, SENT_COUNTED), offsets),
+        cumulative_received=segmented_cumsum(np.isin(event_code, RECEIVED_COUNTED), offsets),
+    ), offsets
@@ -1,184 +1,546 @@
-import argparse
-import ast
-import math
-import numpy as np
-import os
-import random
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.metrics import accuracy_score
-
-FEATURE_PATH = "features.txt"
-
-def get_last_time(lines):
-    for line in reversed(lines):
-        tokens = line.split(",")
-        if len(tokens) < 2:
-            continue
-        if "r" == tokens[1] or "r+p" == tokens[1] or "s" == tokens[1] or "s+p" == tokens[1]:
-            try:
-                last_time = int(tokens[0]) / 1000000000
-                last_time = math.ceil(last_time / 2) * 2
-                return last_time
-            except ValueError:
-                continue
-    return -1
-
-def get_packet_count(trace_file, direction, start, end):
-    counts = []
-    
-    try:
-        with open(trace_file) as f:
-            lines = f.readlines()
-    except Exception as e:
-        print(f"Error reading {trace_file}: {e}")
-        return counts
-    
-    last_time = get_last_time(lines)
-    if last_time == -1:
-        print(f"Warning: No valid packets found in {trace_file}")
-        return counts
-    
-    for line in lines:
-        tokens = line.split(",")
-        if len(tokens) < 2:
-            continue
-        try:
-            timestamp = int(tokens[0]) / 1000000000
-        except ValueError:
-            continue
-        
-        if timestamp < last_time - start:
-            continue
-        if timestamp >= last_time - end:
-            break
-        
-        if direction not in tokens[1]:
-            continue
-        
-        offset = (timestamp - (last_time - start)) * 4.0
-        
-        while len(counts) <= offset:
-            counts.append(0)
-        
-        counts[math.floor(offset)] += 1
-    
-    offset = (start - end) * 4.0
-    while len(counts) < offset:
-        counts.append(0)
-    
-    return counts
-
-def extract_features(path, start, end, modified=False):
-    all_pairs = []
-    
-    max_pps_up = None
-    max_pps_down = None
-    max_pps_all = None
-    
-    video_folders = [f for f in os.listdir(path) if os.path.isdir(os.path.join(path, f))]
-    num_classes = len(video_folders)
-    print(f"Found {num_classes} video folders: {video_folders}")
-    
-    for video in video_folders:
-        video_root = os.path.join(path, video)
-        all_traces = [file for file in os.listdir(video_root) if (not modified and ".log" in file and file.count(".") == 1 and "_modified.log" not in file) or (modified and "_modified.log" in file)]
-        print(f"Found {len(all_traces)} traces in {video_root}: {all_traces}")
-        
-        if not all_traces:
-            print(f"Warning: No valid traces found in {video_root}")
-            continue
-        
-        for trace in all_traces:
-            trace_file = os.path.join(video_root, trace)
-            
-            pps_up = get_packet_count(trace_file, "s", start, end)
-            pps_down = get_packet_count(trace_file, "r", start, end)
-            pps_all = [pps_up[i] + pps_down[i] for i in range(len(pps_up))]
-            
-            if not pps_up or not pps_down:
-                print(f"Warning: Empty packet counts for {trace_file}")
-                continue
-            
-            pps_up = [value / 0.25 for value in pps_up]
-            pps_down = [value / 0.25 for value in pps_down]
-            pps_all = [value / 0.25 for value in pps_all]
-            
-            max_pps_up = max(max_pps_up, max(pps_up)) if max_pps_up else max(pps_up)
-            max_pps_down = max(max_pps_down, max(pps_down)) if max_pps_down else max(pps_down)
-            max_pps_all = max(max_pps_all, max(pps_all)) if max_pps_all else max(pps_all)
-            
-            labels = [0.0] * num_classes
-            try:
-                labels[int(video)] = 1.0
-            except ValueError:
-                print(f"Warning: Invalid video folder name {video}, skipping")
-                continue
-            
-            all_pairs.append(([pps_down, pps_up, pps_all], labels))
-    
-    if not all_pairs:
-        print("Error: No valid features extracted")
-        exit()
-    
-    for i in range(len(all_pairs)):
-        for j in range((start - end) * 4):
-            all_pairs[i][0][0][j] /= max_pps_down
-            all_pairs[i][0][1][j] /= max_pps_up
-            all_pairs[i][0][2][j] /= max_pps_all
-    
-    print(f"Extracted {len(all_pairs)} feature-label pairs")
-
-    feature_set = {tuple(np.concatenate(x)) for x, _ in all_pairs}
-    print(f"Unique feature vectors: {len(feature_set)}, Total pairs: {len(all_pairs)}")
-
-    with open(FEATURE_PATH, "w") as f:
-        f.write(f"{all_pairs}\n")
-    
-    return num_classes
-
-def load_features():
-    with open(FEATURE_PATH) as f:
-        lines = f.readlines()
-    all_pairs = ast.literal_eval(lines[0])
-    
-    random.shuffle(all_pairs)
-    split = math.floor(len(all_pairs) * 0.7)
-    
-    train_x = [np.concatenate(x) for x, _ in all_pairs[:split]]  # Flatten features
-    train_y = [np.argmax(y) for _, y in all_pairs[:split]]       # Convert one-hot to class index
-    
-    test_x = [np.concatenate(x) for x, _ in all_pairs[split:]]
-    test_y = [np.argmax(y) for _, y in all_pairs[split:]]
-    
-    print(f"Training set size: {len(train_x)}, Test set size: {len(test_x)}")
-    
-    return np.array(train_x), np.array(train_y), np.array(test_x), np.array(test_y)
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("path", help="trace dataset for use in attack")
-    parser.add_argument("-s", "--start", help="eavesdropping start time, in seconds from end of trace", type=int, default=60)
-    parser.add_argument("-e", "--end", help="eavesdropping end time, in seconds from end of trace", type=int, default=0)
-    parser.add_argument("--extract", help="extract features, required when running first time", action="store_true")
-    parser.add_argument("--modified", help="process _modified.log files instead of .log files", action="store_true")
-    args = parser.parse_args()
-    
-    if args.extract:
-        num_classes = extract_features(args.path, args.start, args.end, args.modified)
-    else:
-        num_classes = len([f for f in os.listdir(args.path) if os.path.isdir(os.path.join(args.path, f))])
-    
-    # Train and evaluate k-NN
-    train_x, train_y, test_x, test_y = load_features()
-    
-    knn = KNeighborsClassifier(n_neighbors=5)  # k=5 as a starting point
-    knn.fit(train_x, train_y)
-    
-    train_pred = knn.predict(train_x)
-    test_pred = knn.predict(test_x)
-    
-    train_accuracy = accuracy_score(train_y, train_pred)
-    test_accuracy = accuracy_score(test_y, test_pred)
-    
-    print(f"Train accuracy: {train_accuracy:.4f}")
-    print(f"Test accuracy: {test_accuracy:.4f}")
\ No newline at end of file
+import argparse
+import csv
+import hashlib
+import math
+import numpy as np
+import os
+import random
+import time
+import run_metrics
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.metrics import accuracy_score, confusion_matrix, pairwise_distances_chunked
+from sklearn.model_selection import StratifiedKFold
+from trace_cache import load_trace, EVENT_CODES, SENT_CODES, RECEIVED_CODES, MODIFIED_SUFFIX, MODIFIED_TRACE_SUFFIX
+from feature_store import FEATURE_DIR, LEGACY_FEATURE_PATH, RAW_DIR, WINDOW_DIR, save_features, load_feature_store, load_legacy_features, has_feature_store, save_window_counts, load_window_counts, create_raw_store, load_raw_store, append_raw_counts
+
+# Events that define the end of a trace (injected sp/rp dummies are ignored)
+LAST_TIME_CODES = np.array([EVENT_CODES[e] for e in ("r", "r+p", "s", "s+p")], dtype=np.int8)
+
+def get_last_time(trace):
+    candidates = np.flatnonzero(np.isin(trace.event_code, LAST_TIME_CODES))
+    if len(candidates) == 0:
+        return -1
+    last_time = int(trace.timestamp_ns[candidates[-1]]) / 1000000000
+    last_time = math.ceil(last_time / 2) * 2
+    return last_time
+
+def get_packet_counts(trace_file, start, end):
+    # Bin up, down and all packets of one trace into fixed-length 0.25 s counts
+    try:
+        trace = load_trace(trace_file)
+    except Exception as e:
+        print(f"Error reading {trace_file}: {e}")
+        return None
+    
+    with run_metrics.stage('bin', trace_file) as record:
+        counts = bin_packets(trace, start, end)
+        record['rows'] = len(trace.timestamp_ns)
+    if counts is None:
+        print(f"Warning: No valid packets found in {trace_file}")
+    return counts
+
+def bin_packets(trace, start, end):
+    # Same as get_packet_counts for a trace already in memory (any object with timestamp_ns/event_code)
+    last_time = get_last_time(trace)
+    if last_time == -1:
+        return None
+    
+    n_bins = (start - end) * 4
+    timestamps = trace.timestamp_ns / 1000000000
+    
+    # Packets are processed in file order up to the first one past the window end
+    past_end = np.flatnonzero(timestamps >= last_time - end)
+    stop = past_end[0] if len(past_end) else len(timestamps)
+    timestamps = timestamps[:stop]
+    event_codes = trace.event_code[:stop]
+    
+    in_window = timestamps >= last_time - start
+    offsets = np.floor((timestamps[in_window] - (last_time - start)) * 4.0).astype(np.int64)
+    event_codes = event_codes[in_window]
+    
+    # Float rounding can place a packet just below the window end into bin n_bins; drop it
+    keep = offsets < n_bins
+    offsets = offsets[keep]
+    event_codes = event_codes[keep]
+    
+    pps_up = np.bincount(offsets[np.isin(event_codes, SENT_CODES)], minlength=n_bins)
+    pps_down = np.bincount(offsets[np.isin(event_codes, RECEIVED_CODES)], minlength=n_bins)
+    pps_all = pps_up + pps_down
+    
+    return pps_up, pps_down, pps_all
+
+def get_cumulative_counts(trace_file, max_start):
+    # Running [down, up, all] packet counts over the last max_start seconds, at 0.25 s resolution.
+    # Bins use exact integer nanoseconds and assume the trace is time-ordered.
+    try:
+        trace = load_trace(trace_file)
+    except Exception as e:
+        print(f"Error reading {trace_file}: {e}")
+        return None
+    
+    with run_metrics.stage('bin', trace_file) as record:
+        cumulative = bin_cumulative(trace, max_start)
+        record['rows'] = len(trace.timestamp_ns)
+    if cumulative is None:
+        print(f"Warning: No valid packets found in {trace_file}")
+    return cumulative
+
+def bin_cumulative(trace, max_start):
+    # Same as get_cumulative_counts for a trace already in memory
+    last_time = get_last_time(trace)
+    if last_time == -1:
+        return None
+    
+    n_bins = max_start * 4
+    last_time_ns = last_time * 1000000000
+    origin_ns = last_time_ns - max_start * 1000000000
+    
+    in_window = (trace.timestamp_ns >= origin_ns) & (trace.timestamp_ns < last_time_ns)
+    offsets = (trace.timestamp_ns[in_window] - origin_ns) // 250000000
+    event_codes = trace.event_code[in_window]
+    
+    pps_up = np.bincount(offsets[np.isin(event_codes, SENT_CODES)], minlength=n_bins)
+    pps_down = np.bincount(offsets[np.isin(event_codes, RECEIVED_CODES)], minlength=n_bins)
+    
+    cumulative = np.zeros((3, n_bins + 1), dtype=np.int32)
+    np.cumsum(np.stack([pps_down, pps_up, pps_down + pps_up]), axis=1, out=cumulative[:, 1:])
+    return cumulative
+
+def find_traces(path, modified=False):
+    # Returns (num_classes, [(video, trace_file), ...]) for the class folders under path, ordered by the
+    # original trace's relative path (as manifest.find_log_files and the sharded reduce order them)
+    traces = []
+    
+    video_folders = sorted(f for f in os.listdir(path) if os.path.isdir(os.path.join(path, f)))
+    num_classes = len(video_folders)
+    run_metrics.log(f"Found {num_classes} video folders: {video_folders}")
+    
+    for video in video_folders:
+        video_root = os.path.join(path, video)
+        all_traces = [file for file in os.listdir(video_root) if (not modified and ".log" in file and file.count(".") == 1 and "_modified.log" not in file) or (modified and "_modified.log" in file)]
+        if modified:
+            # Defended traces persisted in binary form take precedence over their CSV copy
+            binary_traces = [file for file in os.listdir(video_root) if file.endswith(MODIFIED_TRACE_SUFFIX)]
+            replaced = {file.replace(MODIFIED_TRACE_SUFFIX, MODIFIED_SUFFIX) for file in binary_traces}
+            all_traces = [file for file in all_traces if file not in replaced] + binary_traces
+        run_metrics.log(f"Found {len(all_traces)} traces in {video_root}: {all_traces}")
+        
+        if not all_traces:
+            print(f"Warning: No valid traces found in {video_root}")
+            continue
+        
+        all_traces.sort(key=lambda file: file.replace(MODIFIED_TRACE_SUFFIX, '.log').replace(MODIFIED_SUFFIX, '.log'))
+        traces.extend((video, os.path.join(video_root, trace)) for trace in all_traces)
+    
+    return num_classes, traces
+
+def normalize_features(pps, n_bins):
+    # pps: N x (3 * n_bins) rows of [down, up, all] packets/s; each direction is scaled by its corpus maximum
+    maxima = pps.reshape(len(pps), 3, n_bins).max(axis=(0, 2))
+    features = pps / np.repeat(maxima, n_bins)
+    return features, maxima
+
+def extract_features(path, start, end, modified=False):
+    all_counts = []
+    all_labels = []
+    
+    num_classes, traces = find_traces(path, modified)
+    
+    for video, trace_file in traces:
+        counts = get_packet_counts(trace_file, start, end)
+        
+        if counts is None or len(counts[0]) == 0:
+            print(f"Warning: Empty packet counts for {trace_file}")
+            continue
+        
+        pps_up, pps_down, pps_all = (c / 0.25 for c in counts)
+        
+        try:
+            label = int(video)
+        except ValueError:
+            print(f"Warning: Invalid video folder name {video}, skipping")
+            continue
+        
+        all_counts.append(np.concatenate([pps_down, pps_up, pps_all]))
+        all_labels.append(label)
+    
+    if not all_counts:
+        print("Error: No valid features extracted")
+        exit()
+    
+    n_bins = (start - end) * 4
+    with run_metrics.stage('normalize') as record:
+        features, (max_pps_down, max_pps_up, max_pps_all) = normalize_features(np.array(all_counts), n_bins)
+        record['rows'] = len(features)
+    
+    print(f"Extracted {len(features)} feature-label pairs")
+
+    unique_features = len(np.unique(features, axis=0))
+    print(f"Unique feature vectors: {unique_features}, Total pairs: {len(features)}")
+
+    meta = {
+        "start": start,
+        "end": end,
+        "num_classes": num_classes,
+        "bins": n_bins,
+        "max_pps_down": float(max_pps_down),
+        "max_pps_up": float(max_pps_up),
+        "max_pps_all": float(max_pps_all),
+    }
+    with run_metrics.stage('write') as record:
+        save_features(features, all_labels, meta)
+        record.update(rows=len(features), bytes_written=sum(run_metrics.file_size(os.path.join(FEATURE_DIR, f)) for f in os.listdir(FEATURE_DIR)))
+    
+    return num_classes
+
+def extract_window_counts(path, max_start, modified=False):
+    # Bin every trace once and store cumulative counts for slicing windows with start <= max_start
+    all_cumulative = []
+    all_labels = []
+    
+    num_classes, traces = find_traces(path, modified)
+    
+    for video, trace_file in traces:
+        try:
+            label = int(video)
+        except ValueError:
+            print(f"Warning: Invalid video folder name {video}, skipping")
+            continue
+        
+        cumulative = get_cumulative_counts(trace_file, max_start)
+        if cumulative is None or cumulative.shape[1] == 1:
+            print(f"Warning: Empty packet counts for {trace_file}")
+            continue
+        
+        all_cumulative.append(cumulative)
+        all_labels.append(label)
+    
+    if not all_cumulative:
+        print("Error: No valid features extracted")
+        exit()
+    
+    print(f"Extracted cumulative counts for {len(all_cumulative)} traces")
+    
+    meta = {"max_start": max_start, "num_classes": num_classes, "resolution": 0.25}
+    save_window_counts(np.stack(all_cumulative), all_labels, meta)
+    
+    return num_classes
+
+def window_features(cumulative, max_start, start, end):
+    # Slice normalized [down, up, all] features for one window out of the cumulative counts
+    if not 0 <= end < start <= max_start:
+        raise ValueError(f"Window {start}-{end}s is outside the extracted range 0-{max_start}s")
+    
+    first = (max_start - start) * 4
+    last = (max_start - end) * 4
+    pps = np.diff(cumulative[:, :, first:last + 1], axis=2) / 0.25
+    
+    maxima = pps.max(axis=(0, 2))
+    features = (pps / maxima[np.newaxis, :, np.newaxis]).reshape(len(pps), -1)
+    return features.astype(np.float32), maxima
+
+def file_fingerprint(path):
+    # SHA-256 of the file contents
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def ingest_traces(path, start, end, modified=False, raw_dir=RAW_DIR):
+    # Add new or changed traces under path to the raw count store and retire removed ones.
+    # Unchanged traces (same size and mtime, or same content hash) are not read, so the cost is
+    # proportional to the number of new traces. Returns the number of rows added.
+    n_bins = (start - end) * 4
+    if os.path.exists(os.path.join(raw_dir, "meta.json")):
+        counts, entries, meta = load_raw_store(raw_dir)
+        if (meta["start"], meta["end"], meta["modified"]) != (start, end, modified):
+            print(f"Error: {raw_dir} holds {meta['start']}-{meta['end']}s counts of "
+                  f"{'modified' if meta['modified'] else 'original'} traces; use another --raw-dir")
+            exit()
+    else:
+        meta = create_raw_store({"start": start, "end": end, "bins": n_bins, "modified": modified}, raw_dir)
+        counts, entries = np.empty((0, 3, n_bins), dtype=np.int32), {}
+    
+    _, traces = find_traces(path, modified)
+    new_counts = []
+    new_entries = []
+    retired_rows = []
+    unchanged = 0
+    seen = set()
+    
+    for video, trace_file in traces:
+        try:
+            label = int(video)
+        except ValueError:
+            print(f"Warning: Invalid video folder name {video}, skipping")
+            continue
+        
+        key = os.path.relpath(trace_file, path)
+        seen.add(key)
+        stat = os.stat(trace_file)
+        entry = entries.get(key)
+        if entry is not None and (entry["size"], entry["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            unchanged += 1
+            continue
+        
+        fingerprint = file_fingerprint(trace_file)
+        if entry is not None and entry["sha256"] == fingerprint and entry["label"] == label:
+            # Touched but not changed: only refresh the recorded size and mtime
+            new_entries.append(dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns))
+            unchanged += 1
+            continue
+        if entry is not None and entry["row"] is not None:
+            retired_rows.append(entry["row"])
+        
+        row = None
+        trace_counts = get_packet_counts(trace_file, start, end)
+        if trace_counts is None or len(trace_counts[0]) == 0:
+            print(f"Warning: Empty packet counts for {trace_file}")
+        else:
+            pps_up, pps_down, pps_all = trace_counts
+            row = meta["rows"] + len(new_counts)
+            new_counts.append(np.stack([pps_down, pps_up, pps_all]))
+        new_entries.append({"path": key, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                            "sha256": fingerprint, "label": label, "row": row})
+    
+    removed = sorted(key for key, entry in entries.items() if key not in seen and entry["sha256"] is not None)
+    for key in removed:
+        if entries[key]["row"] is not None:
+            retired_rows.append(entries[key]["row"])
+        new_entries.append(dict(entries[key], row=None, size=None, mtime_ns=None, sha256=None))
+    
+    new_counts = np.array(new_counts, dtype=np.int32).reshape(-1, 3, n_bins)
+    
+    # Running maxima only grow with new rows; they are recomputed from the live rows only when
+    # a retired row may have held one of them
+    maxima = np.array(meta["maxima"])
+    if retired_rows and (counts[retired_rows].max(axis=(0, 2)) >= maxima).any():
+        retired = set(retired_rows)
+        live = sorted(entry["row"] for entry in entries.values() if entry["row"] is not None and entry["row"] not in retired)
+        maxima = counts[live].max(axis=(0, 2)) if live else np.zeros(3, dtype=np.int64)
+    if len(new_counts):
+        maxima = np.maximum(maxima, new_counts.max(axis=(0, 2)))
+    meta["maxima"] = [int(m) for m in maxima]
+    
+    append_raw_counts(new_counts, new_entries, meta, raw_dir)
+    print(f"Ingested {len(new_counts)} new or changed traces, {unchanged} unchanged, "
+          f"{len(removed)} removed")
+    return len(new_counts)
+
+def load_ingested_features(raw_dir=RAW_DIR):
+    # Normalized [down, up, all] features of the live traces in the raw count store, in ingestion order.
+    # Same values as extract_features over the same traces.
+    counts, entries, meta = load_raw_store(raw_dir)
+    live = sorted((entry["row"], entry["label"]) for entry in entries.values() if entry["row"] is not None)
+    rows = [row for row, _ in live]
+    labels = np.array([label for _, label in live], dtype=np.int32)
+    
+    maxima = np.array(meta["maxima"], dtype=np.float64)
+    features = counts[rows] / maxima[np.newaxis, :, np.newaxis]
+    return features.reshape(len(rows), -1).astype(np.float32), labels
+
+def split_features(features, labels):
+    order = list(range(len(labels)))
+    random.shuffle(order)
+    split = math.floor(len(order) * 0.7)
+    
+    train_x = features[order[:split]]
+    train_y = labels[order[:split]]
+    
+    test_x = features[order[split:]]
+    test_y = labels[order[split:]]
+    
+    print(f"Training set size: {len(train_x)}, Test set size: {len(test_x)}")
+    
+    return train_x, train_y, test_x, test_y
+
+def load_all_features(raw_dir=None):
+    if raw_dir is not None:
+        return load_ingested_features(raw_dir)
+    if has_feature_store(FEATURE_DIR):
+        features, labels, _ = load_feature_store(FEATURE_DIR)
+    else:
+        features, labels, _ = load_legacy_features(LEGACY_FEATURE_PATH)
+    return features, labels
+
+def load_features(raw_dir=None):
+    return split_features(*load_all_features(raw_dir))
+
+def evaluate_knn(train_x, train_y, test_x, test_y, n_neighbors=5):
+    knn = KNeighborsClassifier(n_neighbors=n_neighbors)
+    with run_metrics.stage('fit') as record:
+        knn.fit(train_x, train_y)
+        record['rows'] = len(train_x)
+    
+    with run_metrics.stage('predict') as record:
+        train_pred = knn.predict(train_x)
+        test_pred = knn.predict(test_x)
+        record['rows'] = len(train_x) + len(test_x)
+    
+    return accuracy_score(train_y, train_pred), accuracy_score(test_y, test_pred)
+
+def distance_matrix(features, metric="euclidean", working_memory=256):
+    # Full N x N distance matrix, computed in row blocks of at most working_memory MiB
+    n = len(features)
+    distances = np.empty((n, n), dtype=np.float32)
+    row = 0
+    for block in pairwise_distances_chunked(features, metric=metric, working_memory=working_memory):
+        distances[row:row + len(block)] = block
+        row += len(block)
+    return distances
+
+def kfold_evaluate(features, labels, n_splits=5, neighbors=(5,), metrics=("euclidean",), seed=0):
+    # Stratified k-fold k-NN evaluation. One distance matrix per metric is shared by every fold and
+    # every k; each fold ranks its test rows' neighbors once, up to the largest k.
+    labels = np.asarray(labels)
+    classes = np.unique(labels)
+    class_index = np.searchsorted(classes, labels)
+    max_k = max(neighbors)
+    folds = list(StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed).split(features, labels))
+    
+    timings = {"distances": 0.0, "ranking": 0.0, "voting": 0.0}
+    results = []
+    confusions = {}
+    
+    for metric in metrics:
+        began = time.perf_counter()
+        distances = distance_matrix(np.asarray(features, dtype=np.float32), metric)
+        timings["distances"] += time.perf_counter() - began
+        
+        fold_accuracies = {k: [] for k in neighbors}
+        fold_confusions = {k: np.zeros((len(classes), len(classes)), dtype=np.int64) for k in neighbors}
+        for train_idx, test_idx in folds:
+            began = time.perf_counter()
+            block = distances[np.ix_(test_idx, train_idx)]
+            k_max = min(max_k, len(train_idx))
+            nearest = np.argpartition(block, k_max - 1, axis=1)[:, :k_max]
+            order = np.argsort(np.take_along_axis(block, nearest, axis=1), axis=1, kind="stable")
+            neighbor_classes = class_index[train_idx][np.take_along_axis(nearest, order, axis=1)]
+            timings["ranking"] += time.perf_counter() - began
+            
+            began = time.perf_counter()
+            for k in neighbors:
+                votes = np.zeros((len(test_idx), len(classes)), dtype=np.int32)
+                np.add.at(votes, (np.arange(len(test_idx))[:, np.newaxis], neighbor_classes[:, :k]), 1)
+                # Ties go to the lowest class, as in KNeighborsClassifier
+                predicted = votes.argmax(axis=1)
+                fold_accuracies[k].append(np.mean(predicted == class_index[test_idx]))
+                fold_confusions[k] += confusion_matrix(class_index[test_idx], predicted, labels=range(len(classes)))
+            timings["voting"] += time.perf_counter() - began
+        
+        for k in neighbors:
+            results.append({
+                "metric": metric,
+                "n_neighbors": k,
+                "mean_accuracy": float(np.mean(fold_accuracies[k])),
+                "std_accuracy": float(np.std(fold_accuracies[k])),
+                "min_accuracy": float(np.min(fold_accuracies[k])),
+                "max_accuracy": float(np.max(fold_accuracies[k])),
+            })
+            confusions[(metric, k)] = fold_confusions[k]
+    
+    return results, confusions, classes, timings
+
+def parse_window(value):
+    start, end = value.split(":")
+    return int(start), int(end)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="trace dataset for use in attack")
+    parser.add_argument("-s", "--start", help="eavesdropping start time, in seconds from end of trace", type=int, default=60)
+    parser.add_argument("-e", "--end", help="eavesdropping end time, in seconds from end of trace", type=int, default=0)
+    parser.add_argument("--extract", help="extract features, required when running first time", action="store_true")
+    parser.add_argument("--modified", help="process _modified.log files instead of .log files", action="store_true")
+    parser.add_argument("--ingest", help="add only new or changed traces to the raw count store and evaluate from it", action="store_true")
+    parser.add_argument("--raw-dir", help="raw count store used by --ingest", default=RAW_DIR)
+    parser.add_argument("--windows", help="evaluate several START:END windows from one extraction pass, e.g. 60:0 30:0 45:15", type=parse_window, nargs="+")
+    parser.add_argument("--kfold", help="stratified k-fold evaluation with this many folds instead of one 70/30 split", type=int)
+    parser.add_argument("--neighbors", help="k values evaluated with --kfold", type=int, nargs="+", default=[5])
+    parser.add_argument("--metrics", help="distance metrics evaluated with --kfold", nargs="+", default=["euclidean"])
+    parser.add_argument("--seed", help="fold assignment seed for --kfold", type=int, default=0)
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    run_metrics.configure(args, 'beauty_modified_knn')
+    
+    if args.windows:
+        max_start = max(start for start, _ in args.windows)
+        if args.extract:
+            with run_metrics.profiled(args.profile):
+                extract_window_counts(args.path, max_start, args.modified)
+        
+        cumulative, labels, meta = load_window_counts(WINDOW_DIR)
+        if meta["max_start"] < max_start:
+            print(f"Error: window counts cover only {meta['max_start']}s, re-run with --extract")
+            exit()
+        
+        results = []
+        for start, end in args.windows:
+            features, maxima = window_features(cumulative, meta["max_start"], start, end)
+            train_accuracy, test_accuracy = evaluate_knn(*split_features(features, labels))
+            print(f"Window {start}-{end}s: train accuracy {train_accuracy:.4f}, test accuracy {test_accuracy:.4f}")
+            results.append({
+                "start": start,
+                "end": end,
+                "max_pps_down": float(maxima[0]),
+                "max_pps_up": float(maxima[1]),
+                "max_pps_all": float(maxima[2]),
+                "train_accuracy": train_accuracy,
+                "test_accuracy": test_accuracy,
+            })
+        
+        with open("window_sweep.csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+        print("Window sweep results saved to window_sweep.csv")
+        exit()
+    
+    raw_dir = None
+    with run_metrics.profiled(args.profile):
+        if args.ingest:
+            ingest_traces(args.path, args.start, args.end, args.modified, args.raw_dir)
+            raw_dir = args.raw_dir
+        
+        if args.extract:
+            num_classes = extract_features(args.path, args.start, args.end, args.modified)
+    if not args.extract:
+        num_classes = len([f for f in os.listdir(args.path) if os.path.isdir(os.path.join(args.path, f))])
+    
+    if args.kfold:
+        began = time.perf_counter()
+        features, labels = load_all_features(raw_dir)
+        load_time = time.perf_counter() - began
+        
+        results, confusions, classes, timings = kfold_evaluate(features, labels, args.kfold, args.neighbors, args.metrics, args.seed)
+        timings = {"load": load_time, **timings}
+        
+        print(f"{args.kfold}-fold evaluation over {len(labels)} traces:")
+        for result in results:
+            print(f"  {result['metric']}, k={result['n_neighbors']}: accuracy {result['mean_accuracy']:.4f} +/- {result['std_accuracy']:.4f}")
+        
+        best = max(results, key=lambda result: result["mean_accuracy"])
+        confusion = confusions[(best["metric"], best["n_neighbors"])]
+        print(f"Confusion matrix for {best['metric']}, k={best['n_neighbors']} (rows: true class, columns: predicted):")
+        print("  class " + " ".join(f"{c:>5}" for c in classes) + "  recall")
+        for i, (c, row) in enumerate(zip(classes, confusion)):
+            recall = row[i] / row.sum() if row.sum() else 0.0
+            print(f"  {c:>5} " + " ".join(f"{v:>5}" for v in row) + f"  {recall:.3f}")
+        
+        print("Timing per phase: " + ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in timings.items()))
+        
+        with open("kfold_results.csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+        print("k-fold results saved to kfold_results.csv")
+        exit()
+    
+    # Train and evaluate k-NN
+    train_x, train_y, test_x, test_y = load_features(raw_dir)
+    
+    train_accuracy, test_accuracy = evaluate_knn(train_x, train_y, test_x, test_y)  # k=5 as a starting point
+    
+    print(f"Train accuracy: {train_accuracy:.4f}")
+    print(f"Test accuracy: {test_accuracy:.4f}")
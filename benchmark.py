@@ -0,0 +1,204 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from analyze_overhead import rescan_rows
+from analyze_packet_size import analyze_file
+from beauty_modified_knn import extract_features, load_features, evaluate_knn
+from feature_store import FEATURE_DIR
+from manifest import find_log_files, load_manifest, save_manifest, MANIFEST_FILE
+from modify_padding_improved import process_trace
+from synthetic_dataset import generate_dataset, ORIGINAL_DIR, DEFENDED_DIR
+
+# Pipeline stages in the order they run on a corpus; each one runs in a fresh process so its peak RSS
+# and timing are its own
+STAGES = ['size', 'defense', 'overhead', 'features', 'knn']
+
+BASELINE_FILE = 'benchmark_baseline.json'
+RESULTS_FILE = 'benchmark_results.csv'
+
+# A stage regresses when its time or peak RSS grows by more than the tolerance over the baseline;
+# time differences below MIN_DELTA_SECONDS are treated as noise
+TOLERANCE = 0.25
+MIN_DELTA_SECONDS = 0.05
+
+SEED = 0
+
+
+def stage_size():
+    _, log_files = find_log_files(ORIGINAL_DIR)
+    packets = 0
+    for log_file in log_files:
+        stats = analyze_file(log_file)
+        packets += stats['sent'].count + stats['received'].count
+    return len(log_files), packets
+
+
+def stage_defense():
+    _, log_files = find_log_files(DEFENDED_DIR)
+    entries = {}
+    for log_file in log_files:
+        entry, _ = process_trace(log_file, SEED, root=DEFENDED_DIR)
+        entries[os.path.relpath(log_file, DEFENDED_DIR)] = entry
+    save_manifest(entries, os.path.join(DEFENDED_DIR, MANIFEST_FILE))
+    return len(entries), sum(entry['original']['packets'] for entry in entries.values())
+
+
+def stage_overhead():
+    rows = rescan_rows(DEFENDED_DIR)
+    return len(rows), sum(row['original_packets'] + row['modified_packets'] for row in rows)
+
+
+def stage_features():
+    extract_features(DEFENDED_DIR, 60, 0, modified=True)
+    entries = load_manifest(os.path.join(DEFENDED_DIR, MANIFEST_FILE)).values()
+    return len(entries), sum(entry['modified']['packets'] for entry in entries)
+
+
+def stage_knn():
+    random.seed(SEED)
+    train_x, train_y, test_x, test_y = load_features()
+    evaluate_knn(train_x, train_y, test_x, test_y)
+    return len(train_y) + len(test_y), 0
+
+
+STAGE_FUNCTIONS = {'size': stage_size, 'defense': stage_defense, 'overhead': stage_overhead,
+                   'features': stage_features, 'knn': stage_knn}
+
+
+def run_stage(stage):
+    # Child side: run one stage on the corpus in the working directory and return its measurements;
+    # the stages' own progress output is swallowed
+    began = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        traces, packets = STAGE_FUNCTIONS[stage]()
+    seconds = time.perf_counter() - began
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'stage': stage, 'traces': traces, 'packets': packets, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb}
+
+
+def clear_stage_outputs(stage, root):
+    # Remove what an earlier run of the stage left in the corpus, so a kept --workdir is timed cold too
+    if stage == 'defense':
+        for pattern in ('*_modified.log', '*_modified.trc'):
+            for path in glob.glob(os.path.join(root, DEFENDED_DIR, '*', pattern)):
+                os.remove(path)
+        manifest_path = os.path.join(root, DEFENDED_DIR, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+    elif stage == 'features':
+        shutil.rmtree(os.path.join(root, FEATURE_DIR), ignore_errors=True)
+
+
+def measure_stage(stage, root):
+    # Parent side: run one stage in a child process on the corpus at root, with an empty trace cache of its
+    # own, so every stage parses its input traces instead of reading the memmaps an earlier stage wrote
+    clear_stage_outputs(stage, root)
+    cache_dir = tempfile.mkdtemp(prefix=f'trace-cache-{stage}-')
+    env = dict(os.environ, TRACE_CACHE_DIR=cache_dir,
+               PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                        os.environ.get('PYTHONPATH')])))
+    try:
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), '--stage', stage], cwd=root, env=env,
+                                capture_output=True, text=True)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Stage {stage} failed:\n{result.stderr}")
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def benchmark_scale(root, classes, traces_per_class, duration):
+    # Generate a corpus and time every stage on it, cold: each stage starts with an empty trace cache and
+    # without the outputs of its own earlier runs
+    began = time.perf_counter()
+    generate_dataset(root, classes, traces_per_class, duration, seed=SEED)
+    print(f"Generated {classes} x {traces_per_class} traces of {duration}s in {time.perf_counter() - began:.1f}s")
+    rows = []
+    for stage in STAGES:
+        row = {'classes': classes, 'traces_per_class': traces_per_class, 'duration': duration}
+        row.update(measure_stage(stage, root))
+        row['traces_per_s'] = row['traces'] / row['seconds']
+        row['packets_per_s'] = row['packets'] / row['seconds'] if row['packets'] else None
+        rows.append(row)
+        print(f"  {stage:>8}: {row['seconds']:8.3f}s  {row['traces_per_s']:10.1f} traces/s  "
+              f"{row['packets_per_s'] or 0:12.0f} packets/s  {row['peak_rss_mb']:8.1f} MB peak RSS")
+    return rows
+
+
+def find_regressions(results, baseline, tolerance=TOLERANCE):
+    # Stages slower or bigger than the baseline run of the same corpus by more than the tolerance
+    key = ['classes', 'traces_per_class', 'duration', 'stage']
+    merged = results.merge(pd.DataFrame(baseline), on=key, suffixes=('', '_baseline'))
+    regressions = []
+    for row in merged.to_dict('records'):
+        if (row['seconds'] > row['seconds_baseline'] * (1 + tolerance)
+                and row['seconds'] - row['seconds_baseline'] > MIN_DELTA_SECONDS):
+            regressions.append(f"{row['stage']} at {row['classes']}x{row['traces_per_class']}: "
+                               f"{row['seconds']:.3f}s vs {row['seconds_baseline']:.3f}s baseline")
+        if row['peak_rss_mb'] > row['peak_rss_mb_baseline'] * (1 + tolerance):
+            regressions.append(f"{row['stage']} at {row['classes']}x{row['traces_per_class']}: "
+                               f"{row['peak_rss_mb']:.1f} MB vs {row['peak_rss_mb_baseline']:.1f} MB baseline peak RSS")
+    return regressions, len(merged)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", help="traces per class of each corpus benchmarked", type=int, nargs="+", default=[2, 5, 10])
+    parser.add_argument("--classes", help="number of classes in every corpus", type=int, default=8)
+    parser.add_argument("--duration", help="trace length in seconds", type=int, default=120)
+    parser.add_argument("--workdir", help="keep the generated corpora in this directory (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--baseline", help="stored results to compare against", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", help="store this run as the new baseline", action="store_true")
+    parser.add_argument("--tolerance", help="relative slowdown or RSS growth flagged as a regression", type=float, default=TOLERANCE)
+    parser.add_argument("--stage", help=argparse.SUPPRESS, choices=STAGES)
+    args = parser.parse_args()
+
+    if args.stage:
+        print(json.dumps(run_stage(args.stage)))
+        exit()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark-')
+    rows = []
+    try:
+        for traces_per_class in args.scales:
+            root = os.path.join(workdir, f'{args.classes}x{traces_per_class}')
+            shutil.rmtree(root, ignore_errors=True)
+            rows.extend(benchmark_scale(root, args.classes, traces_per_class, args.duration))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = pd.DataFrame(rows)
+    results.to_csv(RESULTS_FILE, index=False)
+    print(f"Benchmark results saved to {RESULTS_FILE}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(rows, f, indent=1)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions, compared = find_regressions(results, baseline, args.tolerance)
+        if not compared:
+            print(f"No run in {args.baseline} matches these corpus sizes; nothing compared")
+        elif regressions:
+            print(f"Regressions against {args.baseline} (tolerance {args.tolerance:.0%}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            exit(1)
+        else:
+            print(f"No regressions against {args.baseline} across {compared} stage runs")
@@ -0,0 +1,124 @@
+import numpy as np
+
+from batch_defense import random_ranks, segmented_cumsum
+from streaming_defense import SENT_COUNTED, RECEIVED_COUNTED
+from trace_cache import Trace, EVENT_CODES, PADDING_CODES, SENT_CODES, RECEIVED_CODES
+
+# Bin width of the Beauty features; padding is scheduled per bin and direction
+BIN_NS = 250000000
+
+# Bins over which the local peak rate is taken; a bin's deficit is how far its packet count falls
+# below that peak, i.e. how much padding it takes to flatten the rate around it
+SMOOTHING_BINS = 9
+
+# Unpadded traffic the percentage budget refers to
+UNPADDED_CODES = np.array([EVENT_CODES['s'], EVENT_CODES['r']], dtype=np.int8)
+
+
+def budget_bytes(trace, budget_bps=None, budget_percent=None):
+    # Padding budget of one trace: budget_bps bytes per second of trace, or budget_percent of its s/r bytes
+    valid = trace.packet_size >= 0
+    if budget_bps is not None:
+        duration = int(trace.timestamp_ns[valid].max()) / 1e9 if valid.any() else 0.0
+        return budget_bps * duration
+    unpadded = np.isin(trace.event_code[valid], UNPADDED_CODES)
+    return budget_percent / 100 * int(trace.packet_size[valid][unpadded].sum(dtype=np.int64))
+
+
+def rate_deficits(bins, upstream, n_bins, smoothing_bins=SMOOTHING_BINS):
+    # Per-bin packet counts of the [down, up] traffic and their shortfall from the local peak rate
+    counts = np.stack([np.bincount(bins[~upstream], minlength=n_bins), np.bincount(bins[upstream], minlength=n_bins)])
+    half = smoothing_bins // 2
+    padded = np.pad(counts, ((0, 0), (half, half)), mode='edge')
+    peaks = np.lib.stride_tricks.sliding_window_view(padded, smoothing_bins, axis=1).max(axis=2)
+    return peaks - counts
+
+
+def allocate(weights, n_packets):
+    # Split n_packets over cells in proportion to weights (largest remainder); a cell gets at most its
+    # weight while the total weight covers n_packets, and the rest is spread evenly
+    weights = np.asarray(weights, dtype=np.int64)
+    total = int(weights.sum())
+    if n_packets > total:
+        extra = allocate(np.ones_like(weights), n_packets - total)
+        return weights + extra
+    if n_packets == 0 or total == 0:
+        return np.zeros_like(weights)
+    shares = weights * n_packets / total
+    allocation = np.floor(shares).astype(np.int64)
+    remainder = n_packets - int(allocation.sum())
+    allocation[np.argsort(allocation - shares, kind='stable')[:remainder]] += 1
+    return allocation
+
+
+def defend_with_budget(trace, rng, budget_bps=None, budget_percent=None, padding_size_range=(50, 70),
+                       time_scramble_std=5000000, smoothing_bins=SMOOTHING_BINS):
+    # Defense under a padding budget. int(budget / mean padding size) padding sizes are drawn up front and the
+    # longest prefix whose total fits the budget is bought, so padding_bytes never exceeds budget_bytes. The
+    # packets are spread over 0.25 s (bin, direction) cells in proportion to each cell's rate deficit, so the
+    # padding fills the dips that make the Beauty features distinctive. In every cell the trace's own
+    # padding packets are kept first (a uniform subset, resized) and dummies make up the rest at uniform
+    # times within the bin. Other packets get the usual timestamp jitter.
+    # Returns (defended Trace, {'budget_bytes', 'padding_bytes', 'unpadded_bytes', 'duration_s'}).
+    valid = trace.packet_size >= 0
+    timestamp = np.asarray(trace.timestamp_ns[valid], dtype=np.int64)
+    event_code = np.asarray(trace.event_code[valid])
+    size = np.asarray(trace.packet_size[valid], dtype=np.int64)
+    start_time = int(trace.absolute_timestamp[valid][0]) if valid.any() else 0
+    unpadded_bytes = int(size[np.isin(event_code, UNPADDED_CODES)].sum())
+    duration = int(timestamp.max()) / 1e9 if len(timestamp) else 0.0
+
+    budget = budget_bytes(trace, budget_bps, budget_percent)
+    padding_sizes = rng.integers(padding_size_range[0], padding_size_range[1] + 1,
+                                 size=int(budget // ((padding_size_range[0] + padding_size_range[1]) / 2)), dtype=np.int64)
+    n_packets = int(np.searchsorted(np.cumsum(padding_sizes), budget, side='right'))
+    padding_sizes = padding_sizes[:n_packets]
+    n_bins = int(timestamp.max()) // BIN_NS + 1 if len(timestamp) else 1
+    bins = timestamp // BIN_NS
+
+    padding = np.isin(event_code, PADDING_CODES)
+    traffic = ~padding & (np.isin(event_code, SENT_CODES) | np.isin(event_code, RECEIVED_CODES))
+    deficits = rate_deficits(bins[traffic], np.isin(event_code[traffic], SENT_CODES), n_bins, smoothing_bins)
+    allocation = allocate(deficits.ravel(), n_packets)
+
+    # Cells are indexed direction * n_bins + bin, with direction 0 = down (rp) and 1 = up (sp)
+    padding_rows = np.flatnonzero(padding)
+    padding_cells = (event_code[padding_rows] == EVENT_CODES['sp']) * n_bins + bins[padding_rows]
+    keep = ~padding
+    keep[padding_rows] = random_ranks(padding_cells, 2 * n_bins, rng) < allocation[padding_cells]
+    kept_per_cell = np.bincount(padding_cells[keep[padding_rows]], minlength=2 * n_bins)
+
+    timestamp, event_code, size, padding = timestamp[keep], event_code[keep], size[keep], padding[keep]
+    n_kept = int(padding.sum())
+    size[padding] = padding_sizes[:n_kept]
+    noise = rng.normal(0, time_scramble_std, size=len(timestamp)).astype(np.int64)
+    timestamp = np.maximum(timestamp + noise, 0)
+
+    dummy_cells = np.repeat(np.arange(2 * n_bins), allocation - kept_per_cell)
+    dummy_times = (dummy_cells % n_bins) * BIN_NS + rng.integers(0, BIN_NS, size=len(dummy_cells), dtype=np.int64)
+    dummy_codes = np.where(dummy_cells >= n_bins, EVENT_CODES['sp'], EVENT_CODES['rp']).astype(np.int8)
+    dummy_sizes = padding_sizes[n_kept:]
+
+    # Stable time sort, dummies after original packets with the same timestamp
+    timestamp = np.concatenate([timestamp, dummy_times])
+    order = np.argsort(timestamp, kind='stable')
+    timestamp = timestamp[order]
+    event_code = np.concatenate([event_code, dummy_codes])[order]
+    size = np.concatenate([size, dummy_sizes])[order]
+    padding_bytes = int(size[np.isin(event_code, PADDING_CODES)].sum())
+
+    offsets = np.array([0, len(timestamp)])
+    defended = Trace(
+        timestamp_ns=timestamp,
+        event_code=event_code,
+        packet_size=size,
+        absolute_timestamp=start_time + (timestamp / 1e6).astype(np.int64),
+        cumulative_sent=segmented_cumsum(np.isin(event_code, SENT_COUNTED), offsets),
+        cumulative_received=segmented_cumsum(np.isin(event_code, RECEIVED_COUNTED), offsets),
+    )
+    return defended, {
+        'budget_bytes': budget,
+        'padding_bytes': padding_bytes,
+        'unpadded_bytes': unpadded_bytes,
+        'duration_s': duration,
+    }
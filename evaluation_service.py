@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import signal
+import socketserver
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from sklearn.neighbors import KNeighborsClassifier
+
+import modify_padding_improved as defense
+import sweep_defense as sweep
+from feature_store import FEATURE_DIR, has_feature_store, load_feature_store
+from fingerprint_index import trace_vectors
+from service_client import SERVICE_PORT
+
+# Defended feature matrices kept between requests, least recently used evicted first
+CACHE_SIZE = 32
+
+# Defense parameters a request may set; the rest keep the module defaults of modify_padding_improved
+DEFENSE_PARAMS = ['padding_size_range', 'time_scramble_std', 'padding_reduction_ratio', 'extra_dummy_packets']
+
+
+def canonical_params(request_params):
+    # Request parameters merged with the defaults and cast to one type each, so equal configurations
+    # (e.g. 5000000 and 5000000.0) share a cache entry
+    unknown = set(request_params) - set(DEFENSE_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown defense parameters: {sorted(unknown)}")
+    params = {'padding_size_range': defense.padding_size_range, 'time_scramble_std': defense.time_scramble_std,
+              'padding_reduction_ratio': defense.padding_reduction_ratio,
+              'extra_dummy_packets': defense.extra_dummy_packets, **request_params}
+    low, high = (int(size) for size in params['padding_size_range'])
+    return {'padding_size_range': (low, high), 'time_scramble_std': float(params['time_scramble_std']),
+            'padding_reduction_ratio': float(params['padding_reduction_ratio']),
+            'extra_dummy_packets': int(params['extra_dummy_packets'])}
+
+
+class EvaluationService:
+    # Original traces, the feature store and a fitted k-NN classifier held in memory between requests
+
+    def __init__(self, scrambler_folder, start=60, end=0, n_neighbors=5, cache_size=CACHE_SIZE, feature_dir=FEATURE_DIR):
+        began = time.perf_counter()
+        self.scrambler_folder = scrambler_folder
+        self.start = start
+        self.end = end
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.originals = sweep.load_originals(scrambler_folder)
+
+        # Reference fingerprints for classify requests, if features have been extracted
+        self.meta = None
+        self.model = None
+        if has_feature_store(feature_dir):
+            features, labels, self.meta = load_feature_store(feature_dir, mmap=False)
+            self.model = KNeighborsClassifier(n_neighbors=n_neighbors).fit(features, labels)
+        self.load_seconds = time.perf_counter() - began
+
+    def defended(self, params, seed):
+        # (features, labels, original_overhead, modified_overhead) of one configuration, through the LRU cache
+        key = (json.dumps(params, sort_keys=True), seed)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key], True
+        self.misses += 1
+        result = sweep.defended_features(self.originals, params, seed, self.start, self.end)
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result, False
+
+    def evaluate(self, request):
+        # {"params": {...}, "seed": int, "n_neighbors": int} -> overhead and attack accuracy of the defense
+        params = canonical_params(request.get('params', {}))
+        seed = int(request.get('seed', 0))
+        n_neighbors = int(request.get('n_neighbors', 5))
+
+        began = time.perf_counter()
+        (features, labels, original_overhead, modified_overhead), cached = self.defended(params, seed)
+        train_accuracy, test_accuracy = sweep.attack_accuracy(features, labels, seed, n_neighbors)
+        reduction = original_overhead - modified_overhead
+        return {
+            'params': {**params, 'padding_size_range': list(params['padding_size_range'])},
+            'seed': seed,
+            'n_neighbors': n_neighbors,
+            'traces': len(labels),
+            'original_overhead': original_overhead,
+            'modified_overhead': modified_overhead,
+            'overhead_reduction': reduction,
+            'overhead_reduction_percentage': reduction / original_overhead * 100 if original_overhead > 0 else 0,
+            'train_accuracy': train_accuracy,
+            'test_accuracy': test_accuracy,
+            'cached': cached,
+            'seconds': time.perf_counter() - began,
+        }
+
+    def classify(self, request):
+        # {"traces": [path, ...]} -> predicted class of every trace, against the feature store
+        if self.model is None:
+            raise RuntimeError("No feature store loaded; run beauty_modified_knn.py --extract and restart the service")
+        trace_files = request['traces']
+        if not isinstance(trace_files, list):
+            raise TypeError("traces must be a list of paths")
+        missing = [trace_file for trace_file in trace_files if not os.path.isfile(trace_file)]
+        if missing:
+            raise FileNotFoundError(f"No such trace files: {missing}")
+        vectors, kept = trace_vectors(trace_files, self.meta)
+        labels = self.model.predict(vectors) if kept else []
+        return {
+            'predictions': [{'file': trace_file, 'label': int(label)} for trace_file, label in zip(kept, labels)],
+            'unreadable': [trace_file for trace_file in trace_files if trace_file not in kept],
+        }
+
+    def status(self, request=None):
+        return {
+            'scrambler_folder': self.scrambler_folder,
+            'traces': len(self.originals),
+            'window': [self.start, self.end],
+            'feature_store': self.meta is not None,
+            'load_seconds': self.load_seconds,
+            'cache_entries': len(self.cache),
+            'cache_size': self.cache_size,
+            'cache_hits': self.hits,
+            'cache_misses': self.misses,
+        }
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # JSON over HTTP: GET /status, POST /evaluate and POST /classify
+
+    def do_GET(self):
+        self.dispatch({'/status': self.server.service.status}, None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self.respond(400, {'error': f"Invalid JSON: {e}"})
+            return
+        self.dispatch({'/evaluate': self.server.service.evaluate, '/classify': self.server.service.classify}, request)
+
+    def dispatch(self, routes, request):
+        if self.path not in routes:
+            self.respond(404, {'error': f"Unknown endpoint {self.command} {self.path}"})
+            return
+        try:
+            self.respond(200, routes[self.path](request))
+        except (KeyError, ValueError, TypeError) as e:
+            self.respond(400, {'error': f"Bad request: {e!r}"})
+        except FileNotFoundError as e:
+            self.respond(404, {'error': str(e)})
+        except RuntimeError as e:
+            self.respond(409, {'error': str(e)})
+        except Exception as e:
+            # Anything else is a bug or bad data in the corpus; answer rather than drop the connection
+            traceback.print_exc()
+            self.respond(500, {'error': f"Internal error: {e!r}"})
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    pass
+
+
+def serve(service, port=SERVICE_PORT, socket_path=None):
+    # Requests are handled one at a time, so the cache and the global RNG seeding need no locking
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ServiceHandler)
+        address = socket_path
+    else:
+        server = HTTPServer(('127.0.0.1', port), ServiceHandler)
+        address = f"http://127.0.0.1:{port}"
+    server.service = service
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving {len(service.originals)} traces on {address} (loaded in {service.load_seconds:.1f}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="scrambler folder holding the original traces", default=defense.scrambler_folder)
+    parser.add_argument("--port", help="localhost TCP port to listen on", type=int, default=SERVICE_PORT)
+    parser.add_argument("--socket", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("-s", "--start", help="eavesdropping start time, in seconds from end of trace", type=int, default=60)
+    parser.add_argument("-e", "--end", help="eavesdropping end time, in seconds from end of trace", type=int, default=0)
+    parser.add_argument("-k", "--n-neighbors", help="k of the classifier used by classify requests", type=int, default=5)
+    parser.add_argument("--cache-size", help="defended feature matrices kept in memory", type=int, default=CACHE_SIZE)
+    parser.add_argument("--features", help="feature store used by classify requests", default=FEATURE_DIR)
+    args = parser.parse_args()
+
+    service = EvaluationService(args.path, args.start, args.end, args.n_neighbors, args.cache_size, args.features)
+    if not service.originals:
+        print("No original .log files (excluding .qoe.log and _modified.log) found in", args.path)
+        exit()
+    serve(service, args.port, args.socket)
@@ -0,0 +1,154 @@
+import ast
+import json
+import os
+
+import numpy as np
+
+# Binary feature store: one directory holding the feature matrix, labels and metadata
+FEATURE_DIR = "features"
+FEATURES_FILE = "features.npy"
+LABELS_FILE = "labels.npy"
+META_FILE = "meta.json"
+
+# Window store: per-trace cumulative 0.25 s counts from which any (start, end) window can be sliced
+WINDOW_DIR = "window_counts"
+CUMULATIVE_FILE = "cumulative_counts.npy"
+
+# Raw count store for incremental ingestion: per-trace 0.25 s counts appended row by row, with an
+# append-only log of which trace (path, size, mtime, content hash) each row belongs to
+RAW_DIR = "raw_counts"
+COUNTS_FILE = "counts.i32"
+ENTRIES_FILE = "entries.jsonl"
+
+# Feature files written by earlier versions (Python repr of all_pairs on one line)
+LEGACY_FEATURE_PATH = "features.txt"
+
+
+def _save_arrays(directory, arrays, meta):
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for file_name, array in arrays.items():
+        np.save(os.path.join(directory, file_name), array)
+
+    # meta.json is written last so a partially written store is never picked up
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def _load_arrays(directory, file_names, mmap):
+    with open(os.path.join(directory, META_FILE)) as f:
+        meta = json.load(f)
+    mmap_mode = "r" if mmap else None
+    arrays = [np.load(os.path.join(directory, file_name), mmap_mode=mmap_mode) for file_name in file_names]
+    return arrays, meta
+
+
+def save_features(features, labels, meta, feature_dir=FEATURE_DIR):
+    # features: N x (3 * bins) matrix laid out as [down, up, all]; labels: N class indices
+    meta = dict(meta, rows=int(len(labels)), columns=int(features.shape[1]) if len(labels) else 0)
+    _save_arrays(feature_dir, {
+        FEATURES_FILE: np.ascontiguousarray(features, dtype=np.float32),
+        LABELS_FILE: np.asarray(labels, dtype=np.int32),
+    }, meta)
+
+
+def load_feature_store(feature_dir=FEATURE_DIR, mmap=True):
+    # Returns (features, labels, meta); arrays are memory-mapped read-only when mmap is set
+    (features, labels), meta = _load_arrays(feature_dir, [FEATURES_FILE, LABELS_FILE], mmap)
+    return features, labels, meta
+
+
+def save_window_counts(cumulative, labels, meta, window_dir=WINDOW_DIR):
+    # cumulative: N x 3 x (bins + 1) running packet counts, directions ordered [down, up, all]
+    meta = dict(meta, rows=int(len(labels)))
+    _save_arrays(window_dir, {
+        CUMULATIVE_FILE: np.ascontiguousarray(cumulative, dtype=np.int32),
+        LABELS_FILE: np.asarray(labels, dtype=np.int32),
+    }, meta)
+
+
+def load_window_counts(window_dir=WINDOW_DIR, mmap=True):
+    # Returns (cumulative, labels, meta); arrays are memory-mapped read-only when mmap is set
+    (cumulative, labels), meta = _load_arrays(window_dir, [CUMULATIVE_FILE, LABELS_FILE], mmap)
+    return cumulative, labels, meta
+
+
+def load_legacy_features(path=LEGACY_FEATURE_PATH):
+    # Convert an old features.txt into the (features, labels, meta) layout
+    with open(path) as f:
+        all_pairs = ast.literal_eval(f.readline())
+    features = np.array([np.concatenate(x) for x, _ in all_pairs], dtype=np.float32)
+    labels = np.array([np.argmax(y) for _, y in all_pairs], dtype=np.int32)
+    meta = {"num_classes": len(all_pairs[0][1]) if all_pairs else 0}
+    return features, labels, meta
+
+
+def has_feature_store(feature_dir=FEATURE_DIR):
+    return os.path.exists(os.path.join(feature_dir, META_FILE))
+
+
+def create_raw_store(meta, raw_dir=RAW_DIR):
+    # Start an empty raw count store; meta must hold "bins" (0.25 s bins per direction)
+    os.makedirs(raw_dir, exist_ok=True)
+    for file_name in (META_FILE, COUNTS_FILE, ENTRIES_FILE):
+        path = os.path.join(raw_dir, file_name)
+        if os.path.exists(path):
+            os.remove(path)
+    meta = dict(meta, rows=0, entries_bytes=0, maxima=[0, 0, 0])
+    save_raw_meta(meta, raw_dir)
+    return meta
+
+
+def save_raw_meta(meta, raw_dir=RAW_DIR):
+    tmp_path = os.path.join(raw_dir, META_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(raw_dir, META_FILE))
+
+
+def load_raw_store(raw_dir=RAW_DIR):
+    # Returns (counts, entries, meta). counts is a read-only memmap of rows x 3 x bins [down, up, all]
+    # packet counts; entries maps each trace path to its latest entry. Entries or rows written after
+    # meta.json was last saved (an interrupted ingest) are ignored: meta records how many bytes of
+    # entries.jsonl are committed (stores written before it was recorded fall back to the row check).
+    with open(os.path.join(raw_dir, META_FILE)) as f:
+        meta = json.load(f)
+    shape = (meta["rows"], 3, meta["bins"])
+    if meta["rows"]:
+        counts = np.memmap(os.path.join(raw_dir, COUNTS_FILE), dtype=np.int32, mode="r", shape=shape)
+    else:
+        counts = np.empty(shape, dtype=np.int32)
+
+    entries = {}
+    entries_path = os.path.join(raw_dir, ENTRIES_FILE)
+    if os.path.exists(entries_path):
+        with open(entries_path, "rb") as f:
+            lines = f.read(meta.get("entries_bytes")).decode(errors="replace").splitlines()
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry["row"] is None or entry["row"] < meta["rows"]:
+                    entries[entry["path"]] = entry
+    return counts, entries, meta
+
+
+def append_raw_counts(counts, entries, meta, raw_dir=RAW_DIR):
+    # Append rows of counts and their entries, then commit them by saving meta (with rows updated).
+    # Entries pointing at new rows use row numbers starting at meta["rows"] before the call.
+    counts_path = os.path.join(raw_dir, COUNTS_FILE)
+    with open(counts_path, "ab") as f:
+        # Drop rows left behind by an interrupted ingest so the new ones line up with meta
+        f.truncate(meta["rows"] * 3 * meta["bins"] * np.dtype(np.int32).itemsize)
+        f.write(np.ascontiguousarray(counts, dtype=np.int32).tobytes())
+    meta["rows"] += len(counts)
+    with open(os.path.join(raw_dir, ENTRIES_FILE), "ab") as f:
+        # Same for entries, which could otherwise point at rows reused by this ingest
+        if "entries_bytes" in meta:
+            f.truncate(meta["entries_bytes"])
+        f.write("".join(json.dumps(entry) + "\n" for entry in entries).encode())
+        meta["entries_bytes"] = f.tell()
+    save_raw_meta(meta, raw_dir)
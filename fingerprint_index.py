@@ -0,0 +1,306 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA
+
+from beauty_modified_knn import get_packet_counts
+from feature_store import FEATURE_DIR, load_feature_store
+
+# On-disk layout: append-only raw arrays plus a JSON header holding their shapes
+INDEX_DIR = "fingerprint_index"
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.f32"
+NORMS_FILE = "norms.f32"
+LABELS_FILE = "labels.i32"
+LISTS_FILE = "lists.i32"
+CENTROIDS_FILE = "centroids.npy"
+PCA_COMPONENTS_FILE = "pca_components.npy"
+PCA_MEAN_FILE = "pca_mean.npy"
+
+# Index rows scanned per block during exact search, bounding the query-time distance buffer
+SEARCH_BLOCK_ROWS = 65536
+
+
+class FingerprintIndex:
+    # Labelled fingerprint vectors for the Beauty attack, memory-mapped from index_dir.
+    # Optional PCA projection shrinks the vectors; optional IVF lists (k-means cells) make search
+    # approximate by scanning only the nprobe cells nearest to each query.
+
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.components = self._load_optional(PCA_COMPONENTS_FILE)
+        self.mean = self._load_optional(PCA_MEAN_FILE)
+        self.centroids = self._load_optional(CENTROIDS_FILE)
+        self._open()
+
+    @classmethod
+    def build(cls, vectors, labels, meta=None, index_dir=INDEX_DIR, pca_dims=None, n_lists=None, seed=0):
+        # Create an index from vectors (N x D) and labels; meta carries the feature window and maxima
+        vectors = np.asarray(vectors, dtype=np.float32)
+        os.makedirs(index_dir, exist_ok=True)
+        for file_name in (VECTORS_FILE, NORMS_FILE, LABELS_FILE, LISTS_FILE, CENTROIDS_FILE,
+                          PCA_COMPONENTS_FILE, PCA_MEAN_FILE):
+            path = os.path.join(index_dir, file_name)
+            if os.path.exists(path):
+                os.remove(path)
+
+        dim = vectors.shape[1]
+        if pca_dims:
+            pca = PCA(n_components=pca_dims, random_state=seed).fit(vectors)
+            np.save(os.path.join(index_dir, PCA_COMPONENTS_FILE), pca.components_.astype(np.float32))
+            np.save(os.path.join(index_dir, PCA_MEAN_FILE), pca.mean_.astype(np.float32))
+            dim = pca_dims
+        if n_lists:
+            projected = vectors
+            if pca_dims:
+                projected = (vectors - pca.mean_) @ pca.components_.T
+            kmeans = KMeans(n_clusters=n_lists, n_init=1, random_state=seed).fit(projected)
+            np.save(os.path.join(index_dir, CENTROIDS_FILE), kmeans.cluster_centers_.astype(np.float32))
+
+        meta = {key: value for key, value in (meta or {}).items() if key not in ("rows", "columns")}
+        meta = dict(meta, input_dim=int(vectors.shape[1]), dim=int(dim), rows=0, n_lists=int(n_lists or 0))
+        _write_meta(index_dir, meta)
+
+        index = cls(index_dir)
+        index.add(vectors, labels)
+        return index
+
+    def _load_optional(self, file_name):
+        path = os.path.join(self.index_dir, file_name)
+        return np.load(path) if os.path.exists(path) else None
+
+    def _open(self):
+        rows, dim = self.meta["rows"], self.meta["dim"]
+        self.vectors = self._map(VECTORS_FILE, np.float32, (rows, dim))
+        self.norms = self._map(NORMS_FILE, np.float32, (rows,))
+        self.labels = self._map(LABELS_FILE, np.int32, (rows,))
+        self.lists = self._map(LISTS_FILE, np.int32, (rows,)) if self.centroids is not None else None
+
+        # Inverted lists: row ids grouped by cell, built in memory from the per-row cell ids
+        if self.lists is not None:
+            self.list_order = np.argsort(self.lists, kind="stable").astype(np.int64)
+            self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(self.lists, minlength=len(self.centroids)))])
+
+    def _map(self, file_name, dtype, shape):
+        if shape[0] == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.index_dir, file_name), dtype=dtype, mode="r", shape=shape)
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def project(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.components is None:
+            return vectors
+        return ((vectors - self.mean) @ self.components.T).astype(np.float32)
+
+    def add(self, vectors, labels):
+        # Append labelled vectors (in the original feature space) to the index files
+        projected = self.project(vectors)
+        appended = {
+            VECTORS_FILE: np.ascontiguousarray(projected, dtype=np.float32),
+            NORMS_FILE: np.einsum("ij,ij->i", projected, projected).astype(np.float32),
+            LABELS_FILE: np.asarray(labels, dtype=np.int32),
+        }
+        if self.centroids is not None:
+            appended[LISTS_FILE] = _squared_distances(projected, self.centroids).argmin(axis=1).astype(np.int32)
+
+        for file_name, array in appended.items():
+            with open(os.path.join(self.index_dir, file_name), "ab") as f:
+                # Drop rows left behind by an interrupted add so the files stay aligned with meta
+                f.truncate(self.meta["rows"] * array.itemsize * int(np.prod(array.shape[1:])))
+                f.write(array.tobytes())
+        # meta.json is written last and commits the new rows
+        self.meta["rows"] += len(projected)
+        _write_meta(self.index_dir, self.meta)
+        self._open()
+
+    def search(self, queries, k=5, nprobe=None):
+        # Batched top-k search; returns (squared distances, row ids), both shaped len(queries) x k.
+        # With IVF lists, nprobe cells per query are scanned (all rows when nprobe is None).
+        queries = self.project(queries)
+        k = min(k, len(self))
+        if k == 0 or len(queries) == 0:
+            return np.full((len(queries), k), np.inf, dtype=np.float32), np.full((len(queries), k), -1, dtype=np.int64)
+        if self.lists is None or nprobe is None or nprobe >= len(self.centroids):
+            return self._search_exact(queries, k)
+
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        probes = np.argsort(_squared_distances(queries, self.centroids), axis=1)[:, :nprobe]
+        for i, query in enumerate(queries):
+            candidates = np.concatenate([self.list_order[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes[i]])
+            if len(candidates) == 0:
+                continue
+            candidate_distances = _squared_distances(query[np.newaxis], self.vectors[candidates], self.norms[candidates])[0]
+            top = min(k, len(candidates))
+            best = np.argpartition(candidate_distances, top - 1)[:top]
+            best = best[np.argsort(candidate_distances[best], kind="stable")]
+            distances[i, :top] = candidate_distances[best]
+            ids[i, :top] = candidates[best]
+        return distances, ids
+
+    def _search_exact(self, queries, k):
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for start in range(0, len(self), SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, len(self))
+            block = _squared_distances(queries, self.vectors[start:stop], self.norms[start:stop])
+            merged_distances = np.concatenate([distances, block], axis=1)
+            merged_ids = np.concatenate([ids, np.broadcast_to(np.arange(start, stop), block.shape)], axis=1)
+            best = np.argpartition(merged_distances, k - 1, axis=1)[:, :k]
+            distances = np.take_along_axis(merged_distances, best, axis=1)
+            ids = np.take_along_axis(merged_ids, best, axis=1)
+        order = np.argsort(distances, axis=1, kind="stable")
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def classify(self, queries, k=5, nprobe=None):
+        # Majority vote over the top-k neighbors; ties go to the lowest label, as in KNeighborsClassifier
+        if len(self) == 0:
+            raise ValueError("Cannot classify against an empty index")
+        _, ids = self.search(queries, k, nprobe)
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        labels = np.asarray(self.labels)
+        n_labels = int(labels.max()) + 1
+        votes = np.zeros((len(ids), n_labels), dtype=np.int32)
+        rows = np.broadcast_to(np.arange(len(ids))[:, np.newaxis], ids.shape)
+        found = ids >= 0
+        np.add.at(votes, (rows[found], labels[ids[found]]), 1)
+        return votes.argmax(axis=1)
+
+    def trace_vectors(self, trace_files):
+        # Beauty feature vectors for raw traces, normalized with the maxima the index was built with
+        return trace_vectors(trace_files, self.meta)
+
+
+def trace_vectors(trace_files, meta):
+    # Beauty feature vectors for raw traces over the window of a feature store or index meta, normalized
+    # with its maxima; returns (vectors, trace files that could be binned)
+    start, end = meta["start"], meta["end"]
+    maxima = np.repeat([meta["max_pps_down"], meta["max_pps_up"], meta["max_pps_all"]], (start - end) * 4)
+    vectors = []
+    kept = []
+    for trace_file in trace_files:
+        counts = get_packet_counts(trace_file, start, end)
+        if counts is None:
+            continue
+        pps_up, pps_down, pps_all = (c / 0.25 for c in counts)
+        vectors.append(np.concatenate([pps_down, pps_up, pps_all]) / maxima)
+        kept.append(trace_file)
+    return np.array(vectors, dtype=np.float32).reshape(len(vectors), 3 * (start - end) * 4), kept
+
+
+def _squared_distances(queries, vectors, norms=None):
+    if norms is None:
+        norms = np.einsum("ij,ij->i", vectors, vectors)
+    query_norms = np.einsum("ij,ij->i", queries, queries)
+    return np.maximum(query_norms[:, np.newaxis] - 2 * queries @ vectors.T + norms[np.newaxis, :], 0)
+
+
+def _write_meta(index_dir, meta):
+    tmp_path = os.path.join(index_dir, META_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(index_dir, META_FILE))
+
+
+def benchmark(features, labels, meta, k=5, pca_dims=None, n_lists=None, nprobe=1, seed=0, index_dir=INDEX_DIR):
+    # Build an exact index and the requested approximate one on 80% of the traces, query with the rest,
+    # and report recall of the exact top-k, query speed and attack accuracy for both
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(labels))
+    split = int(len(order) * 0.8)
+    train, test = np.sort(order[:split]), np.sort(order[split:])
+    features = np.asarray(features, dtype=np.float32)
+    labels = np.asarray(labels)
+
+    report = []
+    exact_ids = None
+    for name, options in (("exact", {}), ("approximate", {"pca_dims": pca_dims, "n_lists": n_lists})):
+        directory = os.path.join(index_dir, name)
+        began = time.perf_counter()
+        index = FingerprintIndex.build(features[train], labels[train], meta, directory, seed=seed, **options)
+        build_time = time.perf_counter() - began
+
+        began = time.perf_counter()
+        _, ids = index.search(features[test], k, nprobe if n_lists else None)
+        query_time = time.perf_counter() - began
+        predicted = index.classify(features[test], k, nprobe if n_lists else None)
+
+        if exact_ids is None:
+            exact_ids = ids
+        recall = np.mean([len(np.intersect1d(a, b)) / len(b) for a, b in zip(ids, exact_ids)])
+        report.append({
+            "index": name,
+            "dim": index.meta["dim"],
+            "n_lists": index.meta["n_lists"],
+            "build_s": build_time,
+            "query_ms": query_time / max(len(test), 1) * 1e3,
+            "recall_at_k": float(recall),
+            "accuracy": float(np.mean(predicted == labels[test])),
+        })
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="build an index from the extracted feature store")
+    add_parser = subparsers.add_parser("add", help="insert labelled raw traces into an existing index")
+    query_parser = subparsers.add_parser("query", help="classify raw traces with the index")
+    bench_parser = subparsers.add_parser("benchmark", help="compare approximate search with exact search")
+
+    for sub in (build_parser, add_parser, query_parser, bench_parser):
+        sub.add_argument("--index-dir", help="index directory", default=INDEX_DIR)
+    for sub in (build_parser, bench_parser):
+        sub.add_argument("--features", help="feature store directory", default=FEATURE_DIR)
+        sub.add_argument("--pca", help="project vectors onto this many principal components", type=int)
+        sub.add_argument("--lists", help="number of IVF cells for approximate search", type=int)
+        sub.add_argument("--seed", help="seed for PCA, k-means and the benchmark split", type=int, default=0)
+    add_parser.add_argument("label", help="class label of the traces", type=int)
+    for sub in (add_parser, query_parser):
+        sub.add_argument("traces", help="trace files", nargs="+")
+    for sub in (query_parser, bench_parser):
+        sub.add_argument("-k", "--n-neighbors", help="neighbors per query", type=int, default=5)
+        sub.add_argument("--nprobe", help="IVF cells scanned per query (default: all, i.e. exact)", type=int)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        features, labels, meta = load_feature_store(args.features)
+        index = FingerprintIndex.build(features, labels, meta, args.index_dir, args.pca, args.lists, args.seed)
+        print(f"Built index with {len(index)} fingerprints of dimension {index.meta['dim']} in {args.index_dir}")
+
+    elif args.command == "add":
+        index = FingerprintIndex(args.index_dir)
+        vectors, kept = index.trace_vectors(args.traces)
+        if not kept:
+            print("No usable traces: none has packets in the index window")
+            exit(1)
+        index.add(vectors, [args.label] * len(kept))
+        print(f"Added {len(kept)} traces with label {args.label}; index now holds {len(index)} fingerprints")
+
+    elif args.command == "query":
+        index = FingerprintIndex(args.index_dir)
+        vectors, kept = index.trace_vectors(args.traces)
+        if not kept:
+            print("No usable traces: none has packets in the index window")
+            exit(1)
+        predicted = index.classify(vectors, args.n_neighbors, args.nprobe)
+        for trace_file, label in zip(kept, predicted):
+            print(f"{trace_file}: predicted class {label}")
+
+    elif args.command == "benchmark":
+        features, labels, meta = load_feature_store(args.features)
+        report = benchmark(features, labels, meta, args.n_neighbors, args.pca, args.lists, args.nprobe or 1, args.seed, args.index_dir)
+        for row in report:
+            print(f"{row['index']:>11}: dim {row['dim']}, lists {row['n_lists']}, build {row['build_s']:.3f}s, "
+                  f"query {row['query_ms']:.3f} ms, recall@k {row['recall_at_k']:.3f}, accuracy {row['accuracy']:.4f}")
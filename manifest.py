@@ -0,0 +1,45 @@
+import glob
+import json
+import os
+
+# Trace discovery and the defense run manifest. Kept free of numpy/pandas/sklearn imports so that
+# manifest-only reports start instantly.
+
+# Run manifest in the scrambler folder: one entry per defended trace with its input fingerprint,
+# parameters, seed, output file and traffic totals before and after the defense
+MANIFEST_FILE = 'defense_manifest.json'
+
+
+def find_log_files(scrambler_folder):
+    # Find all .log files (excluding .qoe.log and _modified.log) in the class subfolders; folders and
+    # files are sorted, so outputs do not depend on the filesystem's listing order
+    subfolders = sorted(f for f in os.listdir(scrambler_folder)
+                        if os.path.isdir(os.path.join(scrambler_folder, f)))
+    log_files = []
+    for subfolder in subfolders:
+        subfolder_path = os.path.join(scrambler_folder, subfolder)
+        log_files.extend(sorted(f for f in glob.glob(os.path.join(subfolder_path, '*.log'))
+                                if not f.endswith('.qoe.log') and '_modified.log' not in f))
+    return subfolders, log_files
+
+
+def load_manifest(path):
+    # Returns {trace key: entry}; trace keys, and the file and output_file of every entry, are paths relative
+    # to the scrambler folder, so callers join them with the folder they were given
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['traces']
+
+
+def manifest_seed(entries):
+    # Master seed of the previous run (the most common one among its entries), or None for an empty manifest
+    seeds = [entry['seed'] for entry in entries.values()]
+    return max(set(seeds), key=seeds.count) if seeds else None
+
+
+def save_manifest(entries, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'traces': entries}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
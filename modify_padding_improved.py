@@ -1,163 +1,530 @@
-import pandas as pd
-import os
-import glob
-from pathlib import Path
-import numpy as np
-
-# Path to the LongEnough-defended dataset directory
-data_dir = './LongEnough-defended'
-
-# Scrambler subfolder to process
-scrambler_folder = os.path.join(data_dir, 'constant_4000-scramblerz120z1100z400z1000')
-
-# Discover all subfolders dynamically
-subfolders = [f for f in os.listdir(scrambler_folder) 
-              if os.path.isdir(os.path.join(scrambler_folder, f))]
-
-# Parameters for improved defense based on LongEnough analysis
-padding_size_range = (50, 70)  # Random padding size between 50-70 bytes (based on mean 52.69 bytes)
-time_scramble_std = 5000000  # Standard deviation for time scrambling (5 ms in nanoseconds)
-padding_reduction_ratio = 0.3  # Keep 30% of padding packets
-extra_dummy_packets = 15  # Add 15 extra dummy packets at random times
-
-# List to store overhead statistics
-overhead_stats = []
-
-# Find all .log files (excluding .qoe.log and _modified.log) in the discovered subfolders
-log_files = []
-for subfolder in subfolders:
-    subfolder_path = os.path.join(scrambler_folder, subfolder)
-    log_files.extend([f for f in glob.glob(os.path.join(subfolder_path, '*.log')) 
-                      if not f.endswith('.qoe.log') and '_modified.log' not in f])
-
-# Check if any log files were found
-if not log_files:
-    print("No original .log files (excluding .qoe.log and _modified.log) found in Scrambler subfolders:", subfolders)
-    exit()
-
-# Process each .log file
-for log_file in log_files:
-    try:
-        # Load the .log file
-        df = pd.read_csv(log_file, 
-                         names=['timestamp_ns', 'event_type', 'packet_size', 
-                                'absolute_timestamp', 'cumulative_sent', 'cumulative_received'])
-        
-        # Ensure packet_size and timestamp_ns are numeric
-        df['packet_size'] = pd.to_numeric(df['packet_size'], errors='coerce')
-        df['timestamp_ns'] = pd.to_numeric(df['timestamp_ns'], errors='coerce', downcast='integer')
-        
-        # Check for non-numeric values
-        if df['packet_size'].isna().any() or df['timestamp_ns'].isna().any():
-            print(f"Warning: Non-numeric values found in {log_file}. Skipping invalid rows.")
-            df = df.dropna(subset=['packet_size', 'timestamp_ns'])
-        
-        # Ensure timestamp_ns is int64 to avoid overflow
-        df['timestamp_ns'] = df['timestamp_ns'].astype(np.int64)
-        
-        # Calculate original overhead (total packet size)
-        original_overhead = df['packet_size'].sum()
-        
-        # Modify padding packets
-        df_modified = df.copy()
-        
-        # 1. Reduce padding packets (keep only a fraction)
-        padding_mask = df_modified['event_type'].isin(['sp', 'rp'])
-        padding_indices = df_modified[padding_mask].index
-        if len(padding_indices) > 0:
-            keep_indices = np.random.choice(padding_indices, 
-                                           size=int(len(padding_indices) * padding_reduction_ratio), 
-                                           replace=False)
-            df_modified = df_modified.drop(padding_indices[~padding_indices.isin(keep_indices)])
-        
-        # 2. Randomize padding packet sizes (sp, rp)
-        mask = df_modified['event_type'].isin(['sp', 'rp'])
-        df_modified.loc[mask, 'packet_size'] = np.random.randint(
-            padding_size_range[0], padding_size_range[1] + 1, size=mask.sum(), dtype=np.int64
-        )
-        
-        # 3. Add time scrambling to all packets
-        time_noise = np.random.normal(0, time_scramble_std, size=len(df_modified)).astype(np.int64)
-        df_modified['timestamp_ns'] = df_modified['timestamp_ns'] + time_noise
-        df_modified['timestamp_ns'] = df_modified['timestamp_ns'].clip(lower=0).astype(np.int64)
-        
-        # 4. Update absolute_timestamp to maintain consistency
-        start_time = df_modified['absolute_timestamp'].iloc[0]
-        df_modified['absolute_timestamp'] = start_time + (df_modified['timestamp_ns'] / 1e6).astype(np.int64)
-        
-        # 5. Add extra dummy packets at random times
-        max_time = df_modified['timestamp_ns'].max()
-        if max_time > np.iinfo(np.int64).max:
-            print(f"Warning: max_time ({max_time}) exceeds int64 limit in {log_file}. Using int64.")
-        dummy_times = np.random.randint(0, max_time + 1, size=extra_dummy_packets, dtype=np.int64)
-        dummy_types = np.random.choice(['sp', 'rp'], size=extra_dummy_packets)
-        dummy_sizes = np.random.randint(padding_size_range[0], padding_size_range[1] + 1, 
-                                        size=extra_dummy_packets, dtype=np.int64)
-        dummy_cumulative_sent = [1 if t == 'sp' else 0 for t in dummy_types]
-        dummy_cumulative_received = [1 if t == 'rp' else 0 for t in dummy_types]
-        
-        dummy_df = pd.DataFrame({
-            'timestamp_ns': dummy_times,
-            'event_type': dummy_types,
-            'packet_size': dummy_sizes,
-            'absolute_timestamp': start_time + (dummy_times / 1e6).astype(np.int64),
-            'cumulative_sent': dummy_cumulative_sent,
-            'cumulative_received': dummy_cumulative_received
-        })
-        
-        df_modified = pd.concat([df_modified, dummy_df], ignore_index=True)
-        df_modified = df_modified.sort_values('timestamp_ns').reset_index(drop=True)
-        
-        # Update cumulative_sent and cumulative_received
-        df_modified['cumulative_sent'] = (df_modified['event_type'] == 's').cumsum() + \
-                                        (df_modified['event_type'] == 'sp').cumsum()
-        df_modified['cumulative_received'] = (df_modified['event_type'] == 'r').cumsum() + \
-                                            (df_modified['event_type'] == 'rp').cumsum()
-        
-        # Calculate modified overhead
-        modified_overhead = df_modified['packet_size'].sum()
-        
-        # Save modified data to a new file
-        modified_file = log_file.replace('.log', '_modified.log')
-        df_modified.to_csv(modified_file, index=False)
-        
-        # Store overhead statistics
-        stats = {
-            'file': log_file,
-            'original_overhead': original_overhead,
-            'modified_overhead': modified_overhead,
-            'overhead_reduction': original_overhead - modified_overhead
-        }
-        overhead_stats.append(stats)
-        
-        print(f"Processed {log_file}:")
-        print(f"  Original overhead: {original_overhead} bytes")
-        print(f"  Modified overhead: {modified_overhead} bytes")
-        print(f"  Overhead reduction: {stats['overhead_reduction']} bytes")
-        print(f"  Modified file saved as: {modified_file}")
-        
-    except Exception as e:
-        print(f"Error processing {log_file}: {e}")
-
-# Convert overhead statistics to a DataFrame
-overhead_df = pd.DataFrame(overhead_stats)
-
-# Check if any statistics were collected
-if overhead_df.empty:
-    print("No valid statistics collected. Check the log files for padding packets.")
-    exit()
-
-# Calculate aggregated overhead statistics
-overall_original_overhead = overhead_df['original_overhead'].sum()
-overall_modified_overhead = overhead_df['modified_overhead'].sum()
-overall_reduction = overall_original_overhead - overall_modified_overhead
-
-# Print aggregated overhead statistics
-print("\nAggregated overhead statistics across all Scrambler .log files:")
-print(f"Total original overhead: {overall_original_overhead} bytes")
-print(f"Total modified overhead: {overall_modified_overhead} bytes")
-print(f"Total overhead reduction: {overall_reduction} bytes")
-
-# Save overhead statistics to a CSV file
-overhead_df.to_csv('overhead_stats.csv', index=False)
-print("Overhead statistics saved to overhead_stats.csv")
\ No newline at end of file
+import pandas as pd
+import os
+import argparse
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+import numpy as np
+import run_metrics
+from manifest import find_log_files, load_manifest, manifest_seed, save_manifest, MANIFEST_FILE
+from beauty_modified_knn import bin_packets, get_packet_counts, file_fingerprint, normalize_features, split_features, evaluate_knn
+from feature_store import save_features
+from batch_defense import batch_defense, concatenate_traces, split_traces
+from budget_defense import defend_with_budget
+from streaming_defense import defend_trace_streaming
+from trace_cache import load_trace, trace_to_dataframe, dataframe_to_trace, write_trace_file, traffic_totals, MODIFIED_SUFFIX, MODIFIED_TRACE_SUFFIX
+
+# Path to the LongEnough-defended dataset directory
+data_dir = './LongEnough-defended'
+
+# Scrambler subfolder to process
+scrambler_folder = os.path.join(data_dir, 'constant_4000-scramblerz120z1100z400z1000')
+
+# Parameters for improved defense based on LongEnough analysis
+padding_size_range = (50, 70)  # Random padding size between 50-70 bytes (based on mean 52.69 bytes)
+time_scramble_std = 5000000  # Standard deviation for time scrambling (5 ms in nanoseconds)
+padding_reduction_ratio = 0.3  # Keep 30% of padding packets
+extra_dummy_packets = 15  # Add 15 extra dummy packets at random times
+
+def defense_params(engine='memory', budget=None, batch_size=None):
+    # Parameters recorded in the manifest; a trace is re-run when any of them changes.
+    # engine: 'memory' (apply_defense), 'stream' (streaming_defense) or 'batch' (batch_defense);
+    # budget: {'budget_bps': ...} or {'budget_percent': ...} for the budget_defense scheduler;
+    # batch_size: traces per batch of the batch engine, which decides what shares an RNG stream
+    if budget is not None:
+        return {'padding_size_range': list(padding_size_range), 'time_scramble_std': time_scramble_std,
+                'engine': 'budget', **budget}
+    params = {'padding_size_range': list(padding_size_range), 'time_scramble_std': time_scramble_std,
+              'padding_reduction_ratio': padding_reduction_ratio, 'extra_dummy_packets': extra_dummy_packets,
+              'engine': engine}
+    if engine == 'batch':
+        params['batch_size'] = batch_size
+    return params
+
+
+def manifest_entry(log_file, root, master_seed, params, output, modified_file, original_totals, modified_totals):
+    # Paths are stored relative to the scrambler folder, like the manifest keys, so the manifest stays valid
+    # whatever directory a later run is started from
+    stat = os.stat(log_file)
+    entry = {
+        'file': os.path.relpath(log_file, root),
+        'label': os.path.basename(os.path.dirname(log_file)),
+        'input_size': stat.st_size,
+        'input_mtime_ns': stat.st_mtime_ns,
+        'input_sha256': file_fingerprint(log_file),
+        'params': params,
+        'seed': master_seed,
+        'output': output,
+        'output_file': os.path.relpath(modified_file, root) if modified_file is not None else None,
+        'original': original_totals,
+        'modified': modified_totals,
+    }
+    if modified_file is not None:
+        stat = os.stat(modified_file)
+        entry.update(output_size=stat.st_size, output_mtime_ns=stat.st_mtime_ns)
+    return entry
+
+
+def is_current(entry, log_file, root, master_seed, params, output):
+    # True if the entry was produced from this exact input with the same parameters, seed and output
+    # format, and its output file (relative to root) has not been touched since
+    if entry is None or (entry['params'], entry['seed'], entry['output']) != (params, master_seed, output):
+        return False
+    stat = os.stat(log_file)
+    if (entry['input_size'], entry['input_mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+        if entry['input_sha256'] != file_fingerprint(log_file):
+            return False
+        entry.update(input_size=stat.st_size, input_mtime_ns=stat.st_mtime_ns)
+    if entry['output_file'] is not None:
+        output_file = os.path.join(root, entry['output_file'])
+        if not os.path.exists(output_file):
+            return False
+        stat = os.stat(output_file)
+        if (entry['output_size'], entry['output_mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            return False
+    return True
+
+
+def trace_rng(master_seed, trace_key):
+    # Independent RNG stream per trace, derived from the master seed and the trace's relative path
+    digest = hashlib.sha256(trace_key.replace(os.sep, '/').encode()).digest()
+    return np.random.default_rng([master_seed, *np.frombuffer(digest[:16], dtype=np.uint32).tolist()])
+
+
+def apply_defense(df, rng, padding_size_range=padding_size_range, time_scramble_std=time_scramble_std,
+                  padding_reduction_ratio=padding_reduction_ratio, extra_dummy_packets=extra_dummy_packets):
+    # Modify padding packets
+    df_modified = df.copy()
+
+    # 1. Reduce padding packets (keep only a fraction)
+    padding_mask = df_modified['event_type'].isin(['sp', 'rp'])
+    padding_indices = df_modified[padding_mask].index
+    if len(padding_indices) > 0:
+        keep_indices = rng.choice(padding_indices,
+                                  size=int(len(padding_indices) * padding_reduction_ratio),
+                                  replace=False)
+        df_modified = df_modified.drop(padding_indices[~padding_indices.isin(keep_indices)])
+
+    # 2. Randomize padding packet sizes (sp, rp)
+    mask = df_modified['event_type'].isin(['sp', 'rp'])
+    df_modified.loc[mask, 'packet_size'] = rng.integers(
+        padding_size_range[0], padding_size_range[1] + 1, size=mask.sum(), dtype=np.int64
+    )
+
+    # 3. Add time scrambling to all packets
+    time_noise = rng.normal(0, time_scramble_std, size=len(df_modified)).astype(np.int64)
+    df_modified['timestamp_ns'] = df_modified['timestamp_ns'] + time_noise
+    df_modified['timestamp_ns'] = df_modified['timestamp_ns'].clip(lower=0).astype(np.int64)
+
+    # 4. Update absolute_timestamp to maintain consistency
+    start_time = df_modified['absolute_timestamp'].iloc[0]
+    df_modified['absolute_timestamp'] = start_time + (df_modified['timestamp_ns'] / 1e6).astype(np.int64)
+
+    # 5. Add extra dummy packets at random times
+    max_time = df_modified['timestamp_ns'].max()
+    dummy_times = rng.integers(0, max_time + 1, size=extra_dummy_packets, dtype=np.int64)
+    dummy_types = rng.choice(['sp', 'rp'], size=extra_dummy_packets)
+    dummy_sizes = rng.integers(padding_size_range[0], padding_size_range[1] + 1,
+                               size=extra_dummy_packets, dtype=np.int64)
+    dummy_cumulative_sent = [1 if t == 'sp' else 0 for t in dummy_types]
+    dummy_cumulative_received = [1 if t == 'rp' else 0 for t in dummy_types]
+
+    dummy_df = pd.DataFrame({
+        'timestamp_ns': dummy_times,
+        'event_type': dummy_types,
+        'packet_size': dummy_sizes,
+        'absolute_timestamp': start_time + (dummy_times / 1e6).astype(np.int64),
+        'cumulative_sent': dummy_cumulative_sent,
+        'cumulative_received': dummy_cumulative_received
+    })
+
+    df_modified = pd.concat([df_modified, dummy_df], ignore_index=True)
+    df_modified = df_modified.sort_values('timestamp_ns', kind='stable').reset_index(drop=True)
+
+    # Update cumulative_sent and cumulative_received
+    df_modified['cumulative_sent'] = (df_modified['event_type'] == 's').cumsum() + \
+                                    (df_modified['event_type'] == 'sp').cumsum()
+    df_modified['cumulative_received'] = (df_modified['event_type'] == 'r').cumsum() + \
+                                        (df_modified['event_type'] == 'rp').cumsum()
+
+    return df_modified
+
+
+def process_trace(log_file, master_seed, root=scrambler_folder, output='csv', window=None, stream=False, budget=None):
+    # Apply the defense to one trace; returns (manifest entry, packet counts or None).
+    # output: 'csv' writes <trace>_modified.log, 'binary' writes <trace>_modified.trc, 'none' writes nothing.
+    # window: (start, end) to bin the defended trace straight into Beauty packet counts.
+    # stream: run the bounded-memory chunked engine (csv/none output only).
+    # budget: {'budget_bps': ...} or {'budget_percent': ...} to schedule padding under a bandwidth budget.
+    if stream:
+        return process_trace_streaming(log_file, master_seed, root, output, window)
+    try:
+        # Load the .log file through the binary trace cache
+        trace = load_trace(log_file)
+        df = trace_to_dataframe(trace)
+
+        # Check for non-numeric values (rows without a numeric timestamp are dropped by the cache)
+        if (df['packet_size'] < 0).any():
+            print(f"Warning: Non-numeric values found in {log_file}. Skipping invalid rows.")
+            df = df[df['packet_size'] >= 0].reset_index(drop=True)
+
+        # Calculate original overhead (total packet size), overall and per direction
+        original_totals = traffic_totals(trace)
+
+        rng = trace_rng(master_seed, os.path.relpath(log_file, root))
+        budget_report = None
+        with run_metrics.stage('transform', log_file) as record:
+            if budget is None:
+                df_modified = apply_defense(df, rng)
+                trace_modified = dataframe_to_trace(df_modified)
+            else:
+                df_modified = None
+                trace_modified, budget_report = defend_with_budget(trace, rng, padding_size_range=padding_size_range,
+                                                                   time_scramble_std=time_scramble_std, **budget)
+            record['rows'] = len(df)
+
+        # Calculate modified overhead
+        modified_totals = traffic_totals(trace_modified)
+
+        # Save modified data to a new file, only when requested
+        modified_file = write_defended(log_file, trace_modified, output, df_modified)
+
+        counts = None
+        if window is not None:
+            counts = bin_defended(log_file, trace_modified, window)
+
+        entry = manifest_entry(log_file, root, master_seed, defense_params(budget=budget), output, modified_file,
+                               original_totals, modified_totals)
+        if budget_report is not None:
+            entry['budget'] = budget_report
+        report_trace(entry)
+        return entry, counts
+
+    except Exception as e:
+        print(f"Error processing {log_file}: {e}")
+        return None, None
+
+
+def process_trace_streaming(log_file, master_seed, root=scrambler_folder, output='csv', window=None):
+    # Same as process_trace, but the trace is read, defended and written chunk by chunk
+    try:
+        rng = trace_rng(master_seed, os.path.relpath(log_file, root))
+        params = {'padding_size_range': padding_size_range, 'time_scramble_std': time_scramble_std,
+                  'padding_reduction_ratio': padding_reduction_ratio, 'extra_dummy_packets': extra_dummy_packets}
+
+        modified_file = log_file.replace('.log', MODIFIED_SUFFIX) if output == 'csv' else None
+        # Reading, defending, writing and binning are interleaved chunk by chunk; recorded as one stage
+        with run_metrics.stage('transform', log_file) as record:
+            original_totals, modified_totals, counts = defend_trace_streaming(
+                log_file, rng, params, output_file=modified_file, window=window)
+            record.update(rows=original_totals['packets'], bytes_read=run_metrics.file_size(log_file),
+                          bytes_written=run_metrics.file_size(modified_file))
+
+        stale_file = log_file.replace('.log', MODIFIED_TRACE_SUFFIX)
+        if modified_file is not None and os.path.exists(stale_file):
+            os.remove(stale_file)
+
+        entry = manifest_entry(log_file, root, master_seed, defense_params('stream'), output, modified_file,
+                               original_totals, modified_totals)
+        report_trace(entry)
+        return entry, counts
+
+    except Exception as e:
+        print(f"Error processing {log_file}: {e}")
+        return None, None
+
+
+def write_defended(log_file, trace_modified, output, df_modified=None):
+    # Persist a defended trace as requested by output; returns the file written or None
+    with run_metrics.stage('write', log_file) as record:
+        modified_file = _write_defended(log_file, trace_modified, output, df_modified)
+        record.update(rows=len(trace_modified.timestamp_ns), bytes_written=run_metrics.file_size(modified_file))
+    return modified_file
+
+
+def _write_defended(log_file, trace_modified, output, df_modified):
+    modified_file = None
+    if output == 'csv':
+        modified_file = log_file.replace('.log', MODIFIED_SUFFIX)
+        if df_modified is None:
+            df_modified = trace_to_dataframe(trace_modified)
+        df_modified.to_csv(modified_file, index=False)
+        stale_file = log_file.replace('.log', MODIFIED_TRACE_SUFFIX)
+    elif output == 'binary':
+        modified_file = log_file.replace('.log', MODIFIED_TRACE_SUFFIX)
+        write_trace_file(trace_modified, modified_file, {'source': os.path.abspath(log_file)})
+        stale_file = log_file.replace('.log', MODIFIED_SUFFIX)
+    # Drop the copy in the other format so readers never pick up an older run
+    if modified_file is not None and os.path.exists(stale_file):
+        os.remove(stale_file)
+    return modified_file
+
+
+def bin_defended(log_file, trace_modified, window):
+    with run_metrics.stage('bin', log_file) as record:
+        record['rows'] = len(trace_modified.timestamp_ns)
+        return bin_packets(trace_modified, *window)
+
+
+def process_batch(batch, master_seed, batch_size, root=scrambler_folder, output='csv', window=None):
+    # Defend a batch of traces together with the vectorized engine in batch_defense.py.
+    # batch is (batch index, [log files]); returns [(manifest entry, packet counts or None), ...].
+    # The batch draws from one RNG stream derived from the master seed and the batch index; if it fails, its
+    # traces are retried one by one with streams derived from the master seed, batch index and position.
+    # Batches are cut from the full sorted trace list, so the index and members of a batch do not depend
+    # on which traces the manifest lets a run skip.
+    batch_index, log_files = batch
+    params = defense_params('batch', batch_size=batch_size)
+    results = [(None, None)] * len(log_files)
+    loaded = []
+    for i, log_file in enumerate(log_files):
+        try:
+            trace = load_trace(log_file)
+        except Exception as e:
+            print(f"Error processing {log_file}: {e}")
+            continue
+        if (trace.packet_size < 0).any():
+            print(f"Warning: Non-numeric values found in {log_file}. Skipping invalid rows.")
+        loaded.append((i, log_file, trace))
+
+    try:
+        defended = defend_loaded(loaded, np.random.default_rng([master_seed, batch_index]))
+    except Exception as e:
+        # One bad trace must not cost the whole batch (or, in a pool, the whole run): defend the traces one
+        # at a time, each from its own stream, and skip the ones that fail
+        print(f"Error processing batch {batch_index}: {e}; retrying its traces one by one")
+        defended = []
+        for position, item in enumerate(loaded):
+            try:
+                defended.extend(defend_loaded([item], np.random.default_rng([master_seed, batch_index, position])))
+            except Exception as e:
+                print(f"Error processing {item[1]}: {e}")
+
+    for i, log_file, trace, trace_modified in defended:
+        try:
+            modified_file = write_defended(log_file, trace_modified, output)
+            counts = bin_defended(log_file, trace_modified, window) if window is not None else None
+            entry = manifest_entry(log_file, root, master_seed, params, output, modified_file,
+                                   traffic_totals(trace), traffic_totals(trace_modified))
+            report_trace(entry)
+            results[i] = entry, counts
+        except Exception as e:
+            print(f"Error processing {log_file}: {e}")
+    return results
+
+
+def defend_loaded(loaded, rng):
+    # Batch-defend [(index, log file, trace), ...]; returns [(index, log file, trace, defended trace), ...]
+    trace, offsets = concatenate_traces([trace for _, _, trace in loaded])
+    params = {'padding_size_range': padding_size_range, 'time_scramble_std': time_scramble_std,
+              'padding_reduction_ratio': padding_reduction_ratio, 'extra_dummy_packets': extra_dummy_packets}
+    with run_metrics.stage('transform') as record:
+        defended, offsets = batch_defense(trace, offsets, rng, **params)
+        record['rows'] = len(trace.timestamp_ns)
+    return [(*item, trace_modified) for item, trace_modified in zip(loaded, split_traces(defended, offsets))]
+
+
+def report_trace(entry):
+    original_overhead = entry['original']['bytes']
+    modified_overhead = entry['modified']['bytes']
+    run_metrics.log(f"Processed {entry['file']}:")
+    run_metrics.log(f"  Original overhead: {original_overhead} bytes")
+    run_metrics.log(f"  Modified overhead: {modified_overhead} bytes")
+    run_metrics.log(f"  Overhead reduction: {original_overhead - modified_overhead} bytes")
+    if 'budget' in entry:
+        report = entry['budget']
+        run_metrics.log(f"  Padding: {report['padding_bytes']} bytes of a {report['budget_bytes']:.0f} byte budget")
+    if entry['output_file'] is not None:
+        run_metrics.log(f"  Modified file saved as: {entry['output_file']}")
+
+
+def overhead_row(entry):
+    # Overhead statistics of one manifest entry
+    original_overhead = entry['original']['bytes']
+    modified_overhead = entry['modified']['bytes']
+    row = {
+        'file': entry['file'],
+        'original_overhead': original_overhead,
+        'modified_overhead': modified_overhead,
+        'overhead_reduction': original_overhead - modified_overhead
+    }
+    row.update(entry.get('budget', {}))
+    return row
+
+
+def evaluate_defended(log_files, all_counts, num_classes, window, master_seed):
+    # Turn in-memory packet counts of defended traces into the feature store and score the attack
+    rows = []
+    labels = []
+    for log_file, counts in zip(log_files, all_counts):
+        if counts is None or len(counts[0]) == 0:
+            continue
+        try:
+            label = int(os.path.basename(os.path.dirname(log_file)))
+        except ValueError:
+            print(f"Warning: Invalid video folder name for {log_file}, skipping")
+            continue
+        pps_up, pps_down, pps_all = (c / 0.25 for c in counts)
+        rows.append(np.concatenate([pps_down, pps_up, pps_all]))
+        labels.append(label)
+
+    if not rows:
+        print("Error: No valid features extracted")
+        return
+
+    start, end = window
+    with run_metrics.stage('normalize') as record:
+        features, (max_pps_down, max_pps_up, max_pps_all) = normalize_features(np.array(rows), (start - end) * 4)
+        record['rows'] = len(features)
+    save_features(features, labels, {
+        "start": start,
+        "end": end,
+        "num_classes": num_classes,
+        "bins": (start - end) * 4,
+        "max_pps_down": float(max_pps_down),
+        "max_pps_up": float(max_pps_up),
+        "max_pps_all": float(max_pps_all),
+        "defense_seed": master_seed,
+    })
+    print(f"Extracted {len(features)} feature-label pairs from defended traces")
+
+    train_accuracy, test_accuracy = evaluate_knn(*split_features(features, np.array(labels)))
+    print(f"Train accuracy: {train_accuracy:.4f}")
+    print(f"Test accuracy: {test_accuracy:.4f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="scrambler folder holding the original traces", default=scrambler_folder)
+    parser.add_argument("-j", "--workers", help="number of worker processes (1 = run in this process)", type=int, default=1)
+    parser.add_argument("--chunksize", help="traces handed to a worker at a time", type=int, default=4)
+    parser.add_argument("--seed", help="master seed; each trace derives its own RNG stream from it", type=int, default=None)
+    parser.add_argument("--evaluate", help="bin defended traces in memory into features/ and run the k-NN attack", action="store_true")
+    parser.add_argument("--output", help="how to persist defended traces (default: csv, or none with --evaluate)", choices=["csv", "binary", "none"], default=None)
+    parser.add_argument("-s", "--start", help="eavesdropping start time for --evaluate, in seconds from end of trace", type=int, default=60)
+    parser.add_argument("-e", "--end", help="eavesdropping end time for --evaluate, in seconds from end of trace", type=int, default=0)
+    parser.add_argument("--stream", help="bounded-memory chunked defense for very long traces (csv/none output)", action="store_true")
+    parser.add_argument("--batch", help="defend this many traces at a time with the vectorized batch engine", type=int)
+    budget_group = parser.add_mutually_exclusive_group()
+    budget_group.add_argument("--budget-bps", help="schedule padding under a budget of this many bytes per second of trace", type=float)
+    budget_group.add_argument("--budget-percent", help="schedule padding under a budget of this percentage of the s/r bytes", type=float)
+    parser.add_argument("--force", help="re-run traces even if the manifest shows them unchanged", action="store_true")
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    run_metrics.configure(args, 'modify_padding_improved')
+
+    output = args.output or ('none' if args.evaluate else 'csv')
+    if args.stream and output == 'binary':
+        parser.error("--stream writes csv or none, not binary")
+    if args.stream and args.batch:
+        parser.error("--stream and --batch are different engines; pick one")
+    budget = None
+    if args.budget_bps is not None:
+        budget = {'budget_bps': args.budget_bps}
+    elif args.budget_percent is not None:
+        budget = {'budget_percent': args.budget_percent}
+    if budget is not None and (args.stream or args.batch):
+        parser.error("--budget-bps/--budget-percent run the in-memory engine; drop --stream/--batch")
+    window = (args.start, args.end) if args.evaluate else None
+
+    subfolders, log_files = find_log_files(args.path)
+
+    # Check if any log files were found
+    if not log_files:
+        print("No original .log files (excluding .qoe.log and _modified.log) found in Scrambler subfolders:", subfolders)
+        exit()
+
+    # Without --seed the seed of the previous run is reused, so unchanged traces can be skipped;
+    # a random seed is drawn only when there is no previous run
+    manifest_path = os.path.join(args.path, MANIFEST_FILE)
+    manifest = load_manifest(manifest_path)
+    master_seed = args.seed if args.seed is not None else manifest_seed(manifest)
+    if master_seed is None:
+        master_seed = int(np.random.SeedSequence().entropy % 2**32)
+    print(f"Master seed: {master_seed}")
+
+    # Traces whose input, parameters, seed and output are unchanged since the last run are not re-run;
+    # with --evaluate their packet counts are binned from the existing output file
+    params = defense_params('stream' if args.stream else 'batch' if args.batch else 'memory', budget, args.batch)
+    results = {}
+    for log_file in log_files:
+        entry = manifest.get(os.path.relpath(log_file, args.path))
+        if args.force or not is_current(entry, log_file, args.path, master_seed, params, output):
+            continue
+        if window is not None and entry['output_file'] is None:
+            continue
+        counts = get_packet_counts(os.path.join(args.path, entry['output_file']), *window) if window is not None else None
+        results[log_file] = entry, counts
+    if results:
+        print(f"Skipping {len(results)} traces unchanged since the last run")
+
+    # Process each remaining .log file; results come back in log_files order for any worker count
+    pending = [log_file for log_file in log_files if log_file not in results]
+    with run_metrics.profiled(args.profile):
+        if args.batch:
+            # Batches rather than single traces are handed to the workers. They are cut from all traces, not
+            # just the pending ones, and a batch with any pending trace is re-run whole: its traces share one
+            # RNG stream, so the others come out as before unless a shared input changed.
+            batches = [(index, log_files[i:i + args.batch])
+                       for index, i in enumerate(range(0, len(log_files), args.batch))]
+            batches = [batch for batch in batches if any(log_file not in results for log_file in batch[1])]
+            worker = partial(process_batch, master_seed=master_seed, batch_size=args.batch, root=args.path,
+                             output=output, window=window)
+            if args.workers > 1:
+                with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                    batch_results = list(run_metrics.map_collected(executor, worker, batches))
+            else:
+                batch_results = [worker(batch) for batch in batches]
+            for (_, batch), batch_result in zip(batches, batch_results):
+                results.update(zip(batch, batch_result))
+        else:
+            worker = partial(process_trace, master_seed=master_seed, root=args.path, output=output, window=window, stream=args.stream, budget=budget)
+            if args.workers > 1:
+                with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                    results.update(zip(pending, run_metrics.map_collected(executor, worker, pending, chunksize=args.chunksize)))
+            else:
+                results.update((log_file, worker(log_file)) for log_file in pending)
+    results = [results[log_file] for log_file in log_files]
+
+    # Record every trace of this run; entries of traces that no longer exist are dropped
+    save_manifest({os.path.relpath(log_file, args.path): entry
+                   for log_file, (entry, _) in zip(log_files, results) if entry is not None}, manifest_path)
+
+    # List to store overhead statistics
+    overhead_stats = [overhead_row(entry) for entry, _ in results if entry is not None]
+
+    if args.evaluate:
+        evaluate_defended(log_files, [counts for _, counts in results], len(subfolders), window, master_seed)
+
+    # Convert overhead statistics to a DataFrame
+    overhead_df = pd.DataFrame(overhead_stats)
+
+    # Check if any statistics were collected
+    if overhead_df.empty:
+        print("No valid statistics collected. Check the log files for padding packets.")
+        exit()
+
+    # Calculate aggregated overhead statistics
+    overall_original_overhead = overhead_df['original_overhead'].sum()
+    overall_modified_overhead = overhead_df['modified_overhead'].sum()
+    overall_reduction = overall_original_overhead - overall_modified_overhead
+
+    # Print aggregated overhead statistics
+    print("\nAggregated overhead statistics across all Scrambler .log files:")
+    print(f"Total original overhead: {overall_original_overhead} bytes")
+    print(f"Total modified overhead: {overall_modified_overhead} bytes")
+    print(f"Total overhead reduction: {overall_reduction} bytes")
+    if budget is not None:
+        total_budget = overhead_df['budget_bytes'].sum()
+        total_padding = overhead_df['padding_bytes'].sum()
+        total_duration = overhead_df['duration_s'].sum()
+        print(f"Padding: {total_padding} bytes against a budget of {total_budget:.0f} bytes "
+              f"({total_padding / total_budget * 100 if total_budget > 0 else 0:.1f}% of budget), "
+              f"{total_padding / overhead_df['unpadded_bytes'].sum() * 100:.2f}% over s/r traffic, "
+              f"{total_padding / total_duration if total_duration > 0 else 0:.0f} bytes/s")
+
+    # Save overhead statistics to a CSV file
+    overhead_df.to_csv('overhead_stats.csv', index=False)
+    print("Overhead statistics saved to overhead_stats.csv")
+    print(f"Run manifest saved to {manifest_path}")
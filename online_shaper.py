@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+import struct
+import time
+
+import numpy as np
+
+import modify_padding_improved as defense
+from trace_cache import load_trace, PADDING_CODES
+
+# Mean gap between injected dummy packets; the offline defense adds 15 per trace, here 15 per minute
+dummy_interval_ns = 4000000000
+
+# Loopback framing used by the replay harness: event code, packet size, then size payload bytes.
+# Payloads are written in PAYLOAD-sized slices, so packets of any size the header can hold are sent whole.
+FRAME_HEADER = struct.Struct('<bI')
+MAX_FRAME_SIZE = 2**32 - 1
+PAYLOAD = memoryview(bytes(65536))
+
+PADDING_CODE_SET = frozenset(PADDING_CODES.tolist())
+
+
+class PacketShaper:
+    # Per-packet decisions of the defense, usable without knowing the rest of the trace:
+    # padding is kept with probability padding_reduction_ratio and resized, every kept packet gets a
+    # non-negative delay (|N(0, time_scramble_std)|, jitter as delay), and dummies follow a Poisson process.
+
+    def __init__(self, rng, padding_size_range=defense.padding_size_range,
+                 time_scramble_std=defense.time_scramble_std,
+                 padding_reduction_ratio=defense.padding_reduction_ratio,
+                 dummy_interval_ns=dummy_interval_ns):
+        self.rng = rng
+        self.padding_size_range = padding_size_range
+        self.time_scramble_std = time_scramble_std
+        self.padding_reduction_ratio = padding_reduction_ratio
+        self.dummy_interval_ns = dummy_interval_ns
+
+    def shape(self, event_code, size):
+        # Returns None if the packet is dropped, else (size, delay_ns)
+        if event_code in PADDING_CODE_SET:
+            if self.rng.random() >= self.padding_reduction_ratio:
+                return None
+            size = int(self.rng.integers(self.padding_size_range[0], self.padding_size_range[1] + 1))
+        delay_ns = int(abs(self.rng.normal(0, self.time_scramble_std)))
+        return size, delay_ns
+
+    def next_dummy(self):
+        # Returns (gap_ns until the dummy, event code, size)
+        gap_ns = int(self.rng.exponential(self.dummy_interval_ns))
+        event_code = int(self.rng.choice(PADDING_CODES))
+        size = int(self.rng.integers(self.padding_size_range[0], self.padding_size_range[1] + 1))
+        return gap_ns, event_code, size
+
+
+class AsyncShaper:
+    # Runs a PacketShaper on an asyncio loop: submit() is called as packets arrive and send(event_code, size)
+    # is called when they leave. Delays are in session time and divided by speed on the loop.
+
+    def __init__(self, send, shaper, speed=1.0, preserve_order=False):
+        self.send = send
+        self.shaper = shaper
+        self.speed = speed
+        self.preserve_order = preserve_order
+        self.loop = asyncio.get_running_loop()
+
+        self.pending = 0
+        self.last_departure = 0.0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.dummy_task = None
+
+        self.latencies_ns = []
+        self.queue_depths = []
+        self.max_dispatch_lag_ns = 0
+        self.max_queue_depth = 0
+        self.counts = {'submitted': 0, 'dropped_padding': 0, 'resized_padding': 0, 'forwarded': 0, 'dummies': 0}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def start(self):
+        self.dummy_task = self.loop.create_task(self._dummies())
+
+    def submit(self, event_code, size):
+        arrival = self.loop.time()
+        self.counts['submitted'] += 1
+        self.bytes_in += size
+
+        shaped = self.shaper.shape(event_code, size)
+        if shaped is None:
+            self.counts['dropped_padding'] += 1
+            return
+        if event_code in PADDING_CODE_SET:
+            self.counts['resized_padding'] += 1
+        size, delay_ns = shaped
+
+        departure = arrival + delay_ns / 1e9 / self.speed
+        if self.preserve_order:
+            departure = max(departure, self.last_departure)
+        self.last_departure = max(self.last_departure, departure)
+
+        self.pending += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.pending)
+        self.idle.clear()
+        self.loop.call_at(departure, self._depart, arrival, departure, event_code, size)
+
+    def _depart(self, arrival, departure, event_code, size):
+        self.send(event_code, size)
+        # Packets held by the shaper when this one left, itself included
+        self.queue_depths.append(self.pending)
+        self.pending -= 1
+        self.counts['forwarded'] += 1
+        self.bytes_out += size
+        # The shaper's delay is scaled back to session time; the loop's lag behind the scheduled departure is
+        # real time at any speed, so it is added unscaled rather than multiplied by speed
+        dispatch_lag = max(self.loop.time() - departure, 0.0)
+        self.max_dispatch_lag_ns = max(self.max_dispatch_lag_ns, int(dispatch_lag * 1e9))
+        self.latencies_ns.append(int(((departure - arrival) * self.speed + dispatch_lag) * 1e9))
+        if self.pending == 0:
+            self.idle.set()
+
+    async def _dummies(self):
+        while True:
+            gap_ns, event_code, size = self.shaper.next_dummy()
+            await asyncio.sleep(gap_ns / 1e9 / self.speed)
+            self.send(event_code, size)
+            self.counts['dummies'] += 1
+            self.bytes_out += size
+
+    async def drain(self):
+        # Stop injecting dummies and wait for every delayed packet to leave
+        if self.dummy_task is not None:
+            self.dummy_task.cancel()
+            try:
+                await self.dummy_task
+            except asyncio.CancelledError:
+                pass
+        await self.idle.wait()
+
+    def report(self):
+        latencies = np.array(self.latencies_ns, dtype=np.int64)
+        queue_depths = np.array(self.queue_depths, dtype=np.int64)
+        report = dict(self.counts)
+        report.update({
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'p50_queue_depth': np.percentile(queue_depths, 50) if len(queue_depths) else 0.0,
+            'p99_queue_depth': np.percentile(queue_depths, 99) if len(queue_depths) else 0.0,
+            'max_queue_depth': self.max_queue_depth,
+            'mean_latency_ms': latencies.mean() / 1e6 if len(latencies) else 0.0,
+            'p50_latency_ms': np.percentile(latencies, 50) / 1e6 if len(latencies) else 0.0,
+            'p99_latency_ms': np.percentile(latencies, 99) / 1e6 if len(latencies) else 0.0,
+            'max_latency_ms': latencies.max() / 1e6 if len(latencies) else 0.0,
+            'max_dispatch_lag_ms': self.max_dispatch_lag_ns / 1e6,
+        })
+        return report
+
+
+async def replay_trace(log_file, speed=1.0, seed=0, preserve_order=False, host='127.0.0.1'):
+    # Feed a recorded trace through an AsyncShaper into a loopback TCP socket at speed x real time
+    trace = load_trace(log_file)
+    valid = trace.packet_size >= 0
+    timestamps = np.asarray(trace.timestamp_ns[valid])
+    event_codes = np.asarray(trace.event_code[valid])
+    sizes = np.asarray(trace.packet_size[valid])
+    # Rejected up front: a send failing inside the loop would leave the shaper waiting for the packet forever
+    if (sizes > MAX_FRAME_SIZE).any():
+        raise ValueError(f"{log_file} has packets over the {MAX_FRAME_SIZE} byte frame limit")
+
+    received = {'packets': 0, 'bytes': 0}
+    finished = asyncio.Event()
+
+    async def receive(reader, writer):
+        try:
+            while True:
+                _, size = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                await reader.readexactly(size)
+                received['packets'] += 1
+                received['bytes'] += size
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+        finished.set()
+
+    server = await asyncio.start_server(receive, host, 0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection(host, port)
+
+    def send(event_code, size):
+        writer.write(FRAME_HEADER.pack(event_code, size))
+        while size > 0:
+            writer.write(PAYLOAD[:size])
+            size -= len(PAYLOAD)
+
+    shaper = AsyncShaper(send, PacketShaper(np.random.default_rng(seed)), speed, preserve_order)
+    shaper.start()
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    wall_started = time.perf_counter()
+    first_timestamp = int(timestamps[0]) if len(timestamps) else 0
+    max_lag = 0.0
+
+    for i, (timestamp, event_code, size) in enumerate(zip(timestamps.tolist(), event_codes.tolist(), sizes.tolist())):
+        target = started + (timestamp - first_timestamp) / 1e9 / speed
+        wait = target - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        elif i % 256 == 0:
+            await asyncio.sleep(0)
+        max_lag = max(max_lag, loop.time() - target)
+        shaper.submit(event_code, size)
+        if i % 256 == 0:
+            await writer.drain()
+
+    await shaper.drain()
+    await writer.drain()
+    writer.close()
+    await finished.wait()
+    server.close()
+    await server.wait_closed()
+
+    elapsed = time.perf_counter() - wall_started
+    report = shaper.report()
+    report.update({
+        'file': log_file,
+        'speed': speed,
+        'elapsed_s': elapsed,
+        'packets_per_s': received['packets'] / elapsed if elapsed > 0 else 0.0,
+        'bytes_per_s': received['bytes'] / elapsed if elapsed > 0 else 0.0,
+        'received_packets': received['packets'],
+        'received_bytes': received['bytes'],
+        'max_schedule_lag_ms': max_lag * 1e3,
+    })
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("traces", help=".log traces to replay", nargs="+")
+    parser.add_argument("--speed", help="replay speed relative to real time (e.g. 10 = 10x faster)", type=float, default=1.0)
+    parser.add_argument("--seed", help="seed for the shaper's random decisions", type=int, default=0)
+    parser.add_argument("--preserve-order", help="never let a delayed packet overtake an earlier one", action="store_true")
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    for log_file in args.traces:
+        report = asyncio.run(replay_trace(log_file, args.speed, args.seed, args.preserve_order))
+        print(f"Replayed {log_file} at {args.speed:g}x:")
+        for key, value in report.items():
+            if key not in ('file', 'speed'):
+                print(f"  {key}: {value:.2f}" if isinstance(value, float) else f"  {key}: {value}")
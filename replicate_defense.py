@@ -0,0 +1,175 @@
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import modify_padding_improved as defense
+from batch_defense import batch_defense, concatenate_traces, split_traces
+from beauty_modified_knn import bin_packets, normalize_features, split_features, evaluate_knn
+from sweep_defense import parse_range
+from trace_cache import load_trace
+
+# Metrics summarized over the replicates
+SUMMARY_METRICS = ['train_accuracy', 'test_accuracy', 'modified_overhead', 'overhead_reduction_percentage']
+
+
+def replicate_trace(log_file, master_seed, n_replicates, window, params, root=defense.scrambler_folder):
+    # n_replicates independent defended realizations of one trace from a single batch_defense pass over
+    # n_replicates copies of its parsed columns, so every random draw for all of them is made in bulk.
+    # The RNG stream is derived from the trace path, so results do not depend on how traces are split
+    # over workers. Returns (original bytes, modified bytes per replicate, R x (3 * bins) packets/s
+    # rows laid out as [down, up, all]), or None if the trace cannot be used.
+    try:
+        trace = load_trace(log_file)
+    except Exception as e:
+        print(f"Error processing {log_file}: {e}")
+        return None
+    valid = trace.packet_size >= 0
+    if not valid.any():
+        print(f"Warning: No valid packets found in {log_file}")
+        return None
+
+    copies, offsets = concatenate_traces([trace] * n_replicates)
+    rng = defense.trace_rng(master_seed, os.path.relpath(log_file, root))
+    defended, offsets = batch_defense(copies, offsets, rng, **params)
+
+    modified_bytes = np.add.reduceat(defended.packet_size.astype(np.int64), offsets[:-1])
+    rows = []
+    for replicate in split_traces(defended, offsets):
+        counts = bin_packets(replicate, *window)
+        if counts is None:
+            print(f"Warning: No valid packets found in {log_file}")
+            return None
+        pps_up, pps_down, pps_all = (c / 0.25 for c in counts)
+        rows.append(np.concatenate([pps_down, pps_up, pps_all]))
+    return int(trace.packet_size[valid].sum(dtype=np.int64)), modified_bytes, np.array(rows)
+
+
+def evaluate_replicate(replicate, counts, labels, n_bins, master_seed, n_neighbors):
+    # Attack accuracy on one replicate's features; each replicate gets its own train/test split
+    features, _ = normalize_features(counts, n_bins)
+    random.seed(f"{master_seed}:{replicate}")
+    return evaluate_knn(*split_features(features, labels), n_neighbors=n_neighbors)
+
+
+def _evaluate(task):
+    return evaluate_replicate(*task)
+
+
+def confidence_interval(values, confidence=0.95):
+    # Student t interval for the mean of independent replicates
+    values = np.asarray(values, dtype=np.float64)
+    mean = values.mean()
+    if len(values) < 2:
+        return mean, mean
+    half_width = stats.t.ppf((1 + confidence) / 2, len(values) - 1) * values.std(ddof=1) / np.sqrt(len(values))
+    return mean - half_width, mean + half_width
+
+
+def summarize(results_df, confidence=0.95):
+    rows = []
+    for metric in SUMMARY_METRICS:
+        values = results_df[metric]
+        low, high = confidence_interval(values, confidence)
+        rows.append({'metric': metric, 'mean': values.mean(), 'std': values.std(ddof=1) if len(values) > 1 else 0.0,
+                     'ci_low': low, 'ci_high': high})
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="scrambler folder holding the original traces", default=defense.scrambler_folder)
+    parser.add_argument("-r", "--replicates", help="independent defended realizations per trace", type=int, default=20)
+    parser.add_argument("--seed", help="master seed for the defense and the train/test splits", type=int, default=0)
+    parser.add_argument("--padding-size-range", help="LOW:HIGH padding sizes in bytes", type=parse_range, default=defense.padding_size_range)
+    parser.add_argument("--time-scramble-std", help="timestamp jitter std in ns", type=float, default=defense.time_scramble_std)
+    parser.add_argument("--padding-reduction-ratio", help="fraction of padding packets kept", type=float, default=defense.padding_reduction_ratio)
+    parser.add_argument("--extra-dummy-packets", help="dummy packets added per trace", type=int, default=defense.extra_dummy_packets)
+    parser.add_argument("-s", "--start", help="eavesdropping start time, in seconds from end of trace", type=int, default=60)
+    parser.add_argument("-e", "--end", help="eavesdropping end time, in seconds from end of trace", type=int, default=0)
+    parser.add_argument("-k", "--n-neighbors", help="k for the k-NN attack", type=int, default=5)
+    parser.add_argument("--confidence", help="confidence level of the reported intervals", type=float, default=0.95)
+    parser.add_argument("-j", "--workers", help="number of worker processes (1 = run in this process)", type=int, default=1)
+    parser.add_argument("--chunksize", help="traces handed to a worker at a time", type=int, default=4)
+    args = parser.parse_args()
+
+    _, log_files = defense.find_log_files(args.path)
+    if not log_files:
+        print("No original .log files (excluding .qoe.log and _modified.log) found in", args.path)
+        exit()
+
+    params = {'padding_size_range': args.padding_size_range, 'time_scramble_std': args.time_scramble_std,
+              'padding_reduction_ratio': args.padding_reduction_ratio, 'extra_dummy_packets': args.extra_dummy_packets}
+    window = (args.start, args.end)
+    n_bins = (args.start - args.end) * 4
+    print(f"Defending {len(log_files)} traces {args.replicates} times each")
+
+    began = time.perf_counter()
+    worker = partial(replicate_trace, master_seed=args.seed, n_replicates=args.replicates, window=window,
+                     params=params, root=args.path)
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    try:
+        if executor is not None:
+            results = list(executor.map(worker, log_files, chunksize=args.chunksize))
+        else:
+            results = [worker(log_file) for log_file in log_files]
+        defense_seconds = time.perf_counter() - began
+
+        # Traces x replicates totals and packet counts
+        labels = []
+        kept = []
+        for log_file, result in zip(log_files, results):
+            if result is None:
+                continue
+            try:
+                labels.append(int(os.path.basename(os.path.dirname(log_file))))
+            except ValueError:
+                print(f"Warning: Invalid video folder name for {log_file}, skipping")
+                continue
+            kept.append(result)
+        if not kept:
+            print("Error: No valid features extracted")
+            exit()
+        labels = np.array(labels)
+        original_overhead = sum(original for original, _, _ in kept)
+        modified_overhead = np.sum([modified for _, modified, _ in kept], axis=0)
+        counts = np.stack([rows for _, _, rows in kept], axis=1)
+
+        began = time.perf_counter()
+        tasks = [(replicate, counts[replicate], labels, n_bins, args.seed, args.n_neighbors)
+                 for replicate in range(args.replicates)]
+        if executor is not None:
+            accuracies = list(executor.map(_evaluate, tasks))
+        else:
+            accuracies = [_evaluate(task) for task in tasks]
+        attack_seconds = time.perf_counter() - began
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    results_df = pd.DataFrame({
+        'replicate': np.arange(args.replicates),
+        'train_accuracy': [train for train, _ in accuracies],
+        'test_accuracy': [test for _, test in accuracies],
+        'original_overhead': original_overhead,
+        'modified_overhead': modified_overhead,
+    })
+    results_df['overhead_reduction'] = original_overhead - results_df['modified_overhead']
+    results_df['overhead_reduction_percentage'] = results_df['overhead_reduction'] / original_overhead * 100
+    summary_df = summarize(results_df, args.confidence)
+
+    print(f"\n{args.replicates} replicates over {len(labels)} traces "
+          f"(defense and binning {defense_seconds:.1f}s, attack {attack_seconds:.1f}s):")
+    print(f"Mean and {args.confidence:.0%} confidence interval:")
+    for row in summary_df.to_dict('records'):
+        print(f"  {row['metric']}: {row['mean']:.4f} [{row['ci_low']:.4f}, {row['ci_high']:.4f}] (std {row['std']:.4f})")
+
+    results_df.to_csv('replicate_results.csv', index=False)
+    summary_df.to_csv('replicate_summary.csv', index=False)
+    print("Replicate results saved to replicate_results.csv and replicate_summary.csv")
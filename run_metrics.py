@@ -0,0 +1,163 @@
+import cProfile
+import atexit
+import contextlib
+import csv
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+from functools import partial
+
+# Set by --quiet and --metrics-file; kept in the environment so worker processes inherit them.
+# Stages are only recorded with --metrics-file, so long-running callers do not accumulate records.
+QUIET_ENV = 'DASH_QUIET'
+RECORD_ENV = 'DASH_RECORD_METRICS'
+
+# One record per stage run: stage, file (None for whole-corpus stages), wall time, rows processed,
+# bad rows (non-numeric fields), bytes read and written, and peak RSS of the process so far
+RECORD_FIELDS = ['stage', 'file', 'calls', 'seconds', 'rows', 'bad_rows', 'bytes_read', 'bytes_written', 'peak_rss_mb']
+COUNTERS = ['seconds', 'rows', 'bad_rows', 'bytes_read', 'bytes_written']
+
+PROFILE_TOP = 20
+
+_started = time.perf_counter()
+_records = []
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics-file", help="write per-stage and per-file timings to this .json or .csv file")
+    parser.add_argument("--profile", help="run the main loop under cProfile and dump the stats to this file")
+    parser.add_argument("-q", "--quiet", help="no per-file progress output", action="store_true")
+
+
+def configure(args, script):
+    # Apply the options of add_metrics_arguments; metrics are written when the script exits
+    set_flag(QUIET_ENV, args.quiet)
+    set_flag(RECORD_ENV, args.metrics_file is not None)
+    if args.metrics_file:
+        atexit.register(write_metrics, args.metrics_file, script)
+
+
+def set_flag(name, value):
+    if value:
+        os.environ[name] = '1'
+    else:
+        os.environ.pop(name, None)
+
+
+def log(*args):
+    # print for per-file progress lines, dropped in quiet mode
+    if not os.environ.get(QUIET_ENV):
+        print(*args)
+
+
+def peak_rss_mb():
+    # High-water RSS of this process or of its largest finished child (pool workers), in MiB
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+@contextlib.contextmanager
+def stage(name, file=None):
+    # Time the enclosed code as one run of a stage; the caller fills in the counters of the yielded record
+    record = {'stage': name, 'file': file, 'calls': 1, 'rows': 0, 'bad_rows': 0, 'bytes_read': 0, 'bytes_written': 0}
+    began = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - began
+        if os.environ.get(RECORD_ENV):
+            record['peak_rss_mb'] = peak_rss_mb()
+            _records.append(record)
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def take_records():
+    # Remove and return the records of this process
+    records = list(_records)
+    _records.clear()
+    return records
+
+
+def add_records(records):
+    _records.extend(records)
+
+
+def collected(worker, *args, **kwargs):
+    # Run worker in a pool process and return (result, records it made) for the parent to add_records;
+    # records inherited from a forked parent are dropped first
+    _records.clear()
+    result = worker(*args, **kwargs)
+    return result, take_records()
+
+
+def map_collected(executor, worker, items, **kwargs):
+    # executor.map(worker, items) that adds the records made in the workers to this process
+    for result, records in executor.map(partial(collected, worker), items, **kwargs):
+        add_records(records)
+        yield result
+
+
+def stage_totals(records):
+    # One row per stage, in order of first appearance, summed over files
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], {'stage': record['stage'], 'file': '*', 'calls': 0,
+                                                    **{counter: 0 for counter in COUNTERS}, 'peak_rss_mb': 0.0})
+        total['calls'] += record['calls']
+        for counter in COUNTERS:
+            total[counter] += record[counter]
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+    return list(totals.values())
+
+
+def write_metrics(path, script):
+    # .csv: stage totals (file '*') followed by every record; anything else: a JSON document
+    records = list(_records)
+    totals = stage_totals(records)
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+            writer.writeheader()
+            writer.writerows(totals + records)
+    else:
+        with open(path, 'w') as f:
+            json.dump({
+                'script': script,
+                'argv': sys.argv[1:],
+                'wall_seconds': time.perf_counter() - _started,
+                'peak_rss_mb': peak_rss_mb(),
+                'stages': totals,
+                'files': records,
+            }, f, indent=1)
+    print(f"Run metrics saved to {path}")
+
+
+@contextlib.contextmanager
+def profiled(path):
+    # cProfile the enclosed code in this process (not in pool workers) and dump the stats to path;
+    # does nothing without a path
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        log(summary.getvalue())
+        print(f"Profile saved to {path}")
@@ -0,0 +1,88 @@
+import argparse
+import http.client
+import json
+import os
+import socket
+
+# Client of evaluation_service.py. Only the standard library is imported, so a request costs no
+# pandas/sklearn startup.
+
+SERVICE_PORT = 8765
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def call(endpoint, request=None, port=SERVICE_PORT, socket_path=None, timeout=None):
+    # Send one request to a running service (GET without a request, else POST); returns (HTTP status, JSON body)
+    if socket_path is not None:
+        connection = UnixHTTPConnection(socket_path, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        if request is None:
+            connection.request('GET', endpoint)
+        else:
+            connection.request('POST', endpoint, json.dumps(request), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def parse_range(value):
+    low, high = value.split(":")
+    return int(low), int(high)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", help="localhost TCP port of the service", type=int, default=SERVICE_PORT)
+    parser.add_argument("--socket", help="Unix socket of the service, instead of TCP")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="overhead and attack accuracy of one defense configuration")
+    evaluate_parser.add_argument("--padding-size-range", help="LOW:HIGH padding sizes in bytes", type=parse_range)
+    evaluate_parser.add_argument("--time-scramble-std", help="timestamp jitter std in ns", type=float)
+    evaluate_parser.add_argument("--padding-reduction-ratio", help="fraction of padding packets kept", type=float)
+    evaluate_parser.add_argument("--extra-dummy-packets", help="dummy packets added per trace", type=int)
+    evaluate_parser.add_argument("--seed", help="master seed for the defense and the train/test split", type=int, default=0)
+    evaluate_parser.add_argument("-k", "--n-neighbors", help="k for the k-NN attack", type=int, default=5)
+
+    classify_parser = subparsers.add_parser("classify", help="predict the class of traces")
+    classify_parser.add_argument("traces", help=".log or .trc traces readable by the service", nargs="+")
+
+    subparsers.add_parser("status", help="corpus and cache state of the service")
+    args = parser.parse_args()
+
+    if args.command == "evaluate":
+        params = {name: getattr(args, name) for name in
+                  ('padding_size_range', 'time_scramble_std', 'padding_reduction_ratio', 'extra_dummy_packets')
+                  if getattr(args, name) is not None}
+        status, body = call('/evaluate', {'params': params, 'seed': args.seed, 'n_neighbors': args.n_neighbors},
+                            args.port, args.socket)
+    elif args.command == "classify":
+        status, body = call('/classify', {'traces': [os.path.abspath(trace) for trace in args.traces]},
+                            args.port, args.socket)
+    else:
+        status, body = call('/status', None, args.port, args.socket)
+
+    if status != 200:
+        print(f"Error {status}: {body['error']}")
+        exit(1)
+    if args.command == "classify":
+        for prediction in body['predictions']:
+            print(f"{prediction['file']}: class {prediction['label']}")
+        for trace_file in body['unreadable']:
+            print(f"{trace_file}: no packets in the window")
+    else:
+        for key, value in body.items():
+            print(f"{key}: {value}")
@@ -0,0 +1,438 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import modify_padding_improved as defense
+import run_metrics
+from analyze_overhead import add_overhead_columns, overhead_row, rescan_row
+from analyze_packet_size import GROUPS, SizeStats, analyze_file
+from beauty_modified_knn import get_packet_counts
+from feature_store import FEATURE_DIR, save_features
+from manifest import find_log_files, save_manifest, MANIFEST_FILE
+from trace_cache import add_totals, modified_trace_path, TOTALS_KEYS
+
+# Map/reduce execution of the pipeline over a corpus split into shards that may live on different machines.
+# A shard manifest lists the traces of every shard by path relative to the corpus root, so each map task
+# only needs its own shard under a local --root. Map tasks write one small partial per (stage, shard);
+# the reduce step merges the partials into the same outputs as the single-node scripts.
+
+SHARD_MANIFEST = 'shard_manifest.json'
+PARTIALS_DIR = 'partials'
+
+STAGES = ['size', 'defense', 'overhead', 'features']
+PARTITIONS = ['class', 'hash']
+
+
+def trace_key(log_file, root):
+    # Relative path with '/' separators, the same on every machine
+    return os.path.relpath(log_file, root).replace(os.sep, '/')
+
+
+def shard_of(key, n_shards, partition, class_shards):
+    if partition == 'class':
+        return class_shards[key.split('/')[0]]
+    # sha256 rather than hash(), which is salted per process
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'big') % n_shards
+
+
+def plan_shards(root, n_shards, partition='class', seed=0):
+    # Shard manifest of the original traces under root. By class, whole class folders are dealt out
+    # round-robin in sorted order; by hash, every trace goes to the shard its relative path hashes to.
+    subfolders, log_files = find_log_files(root)
+    keys = sorted(trace_key(log_file, root) for log_file in log_files)
+    class_shards = {label: i % n_shards for i, label in enumerate(subfolders)}
+    shards = [[] for _ in range(n_shards)]
+    for key in keys:
+        shards[shard_of(key, n_shards, partition, class_shards)].append(key)
+    return {'root': os.path.abspath(root), 'partition': partition, 'seed': seed,
+            'num_classes': len(subfolders), 'shards': shards}
+
+
+def load_shard_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(data, path):
+    # Written to a temporary file first, so a reduce never reads a half-written partial
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def partial_path(partials_dir, stage, shard):
+    extension = 'npz' if stage == 'features' else 'json'
+    return os.path.join(partials_dir, f'{stage}-{shard:04d}.{extension}')
+
+
+def map_size(keys, root):
+    # Per-file rows and the pooled accumulator state of every group
+    pooled = {group: SizeStats() for group in GROUPS}
+    rows = []
+    failed = []
+    for key in keys:
+        try:
+            stats = analyze_file(os.path.join(root, key))
+        except Exception as e:
+            print(f"Error processing {key}: {e}")
+            failed.append(key)
+            continue
+        for group, group_stats in stats.items():
+            pooled[group].merge(group_stats)
+            if group_stats.count:
+                rows.append({'file': key, 'group': group, **group_stats.row()})
+    return {'rows': rows, 'pooled': {group: stats.state() for group, stats in pooled.items()}, 'failed': failed}
+
+
+def map_defense(keys, root, seed, output):
+    # Defended traces are written next to the originals on this machine; the partial holds their manifest entries
+    entries = {}
+    failed = []
+    for key in keys:
+        entry, _ = defense.process_trace(os.path.join(root, key), seed, root=root, output=output)
+        if entry is None:
+            failed.append(key)
+        else:
+            entries[key] = entry
+    return {'entries': entries, 'failed': failed}
+
+
+def map_overhead(keys, root, defense_partial=None):
+    # Per-file overhead rows and traffic totals per class. Rows come from the manifest entries of the shard's
+    # defense partial when there is one, like analyze_overhead.py without --rescan; otherwise every original
+    # and modified trace is read.
+    rows = []
+    classes = {}
+    failed = []
+    entries = load_shard_manifest(defense_partial)['entries'] if defense_partial is not None else None
+    for key in keys:
+        if entries is not None:
+            entry = entries.get(key)
+            if entry is None:
+                print(f"Warning: No defense entry for {key} in {defense_partial}")
+            row = overhead_row(key, entry['label'], entry['original'], entry['modified']) if entry else None
+        else:
+            row = rescan_row(os.path.join(root, key), root)
+        if row is None:
+            failed.append(key)
+            continue
+        rows.append(row)
+        totals = classes.setdefault(row['class'], {'traces': 0, 'original': dict.fromkeys(TOTALS_KEYS, 0),
+                                                   'modified': dict.fromkeys(TOTALS_KEYS, 0)})
+        totals['traces'] += 1
+        for side in ('original', 'modified'):
+            totals[side] = add_totals(totals[side], {name: row[f'{side}_{name}'] for name in TOTALS_KEYS})
+    return {'rows': rows, 'classes': classes, 'failed': failed}
+
+
+def map_features(keys, root, start, end, modified=True):
+    # Raw [down, up, all] packets/s rows and their per-direction maxima; normalization waits for the reduce
+    n_bins = (start - end) * 4
+    rows = []
+    labels = []
+    files = []
+    failed = []
+    for key in keys:
+        log_file = os.path.join(root, key)
+        trace_file = modified_trace_path(log_file) if modified else log_file
+        if trace_file is None:
+            print(f"Warning: No modified file found for {log_file}")
+            failed.append(key)
+            continue
+        counts = get_packet_counts(trace_file, start, end)
+        if counts is None or len(counts[0]) == 0:
+            failed.append(key)
+            continue
+        try:
+            label = int(key.split('/')[0])
+        except ValueError:
+            print(f"Warning: Invalid video folder name for {key}, skipping")
+            failed.append(key)
+            continue
+        pps_up, pps_down, pps_all = (c / 0.25 for c in counts)
+        rows.append(np.concatenate([pps_down, pps_up, pps_all]))
+        labels.append(label)
+        files.append(key)
+    counts = np.array(rows).reshape(len(rows), 3 * n_bins)
+    maxima = counts.reshape(len(rows), 3, n_bins).max(axis=(0, 2)) if rows else np.zeros(3)
+    return {'counts': counts, 'labels': np.array(labels, dtype=np.int32), 'files': np.array(files, dtype=str),
+            'maxima': maxima, 'window': np.array([start, end]), 'failed': np.array(failed, dtype=str)}
+
+
+def run_map(manifest, shard, stage, root, partials_dir, output='csv', start=60, end=0, modified=True, rescan=False):
+    # One map task: run a stage over the traces of one shard and write its partial
+    keys = manifest['shards'][shard]
+    if stage == 'size':
+        result = map_size(keys, root)
+    elif stage == 'defense':
+        result = map_defense(keys, root, manifest['seed'], output)
+    elif stage == 'overhead':
+        defense_partial = partial_path(partials_dir, 'defense', shard)
+        if rescan or not os.path.exists(defense_partial):
+            if not rescan:
+                print(f"No defense partial at {defense_partial}; reading the traces instead")
+            defense_partial = None
+        result = map_overhead(keys, root, defense_partial)
+    else:
+        result = map_features(keys, root, start, end, modified)
+
+    os.makedirs(partials_dir, exist_ok=True)
+    path = partial_path(partials_dir, stage, shard)
+    if stage == 'features':
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **result)
+        os.replace(tmp_path, path)
+    else:
+        save_json({'stage': stage, 'shard': shard, **result}, path)
+    print(f"Shard {shard}: {stage} over {len(keys)} traces ({len(result['failed'])} failed) saved to {path}")
+    return path
+
+
+def load_partials(manifest, stage, partials_dir):
+    # Partials of every shard, in shard order; all of them must be present
+    paths = [partial_path(partials_dir, stage, shard) for shard in range(len(manifest['shards']))]
+    missing = [shard for shard, path in enumerate(paths) if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"No {stage} partials for shards {missing} in {partials_dir}")
+    if stage == 'features':
+        return [dict(np.load(path)) for path in paths]
+    return [load_shard_manifest(path) for path in paths]
+
+
+def reduce_size(partials, output_dir):
+    pooled = {group: SizeStats() for group in GROUPS}
+    rows = []
+    for partial in partials:
+        rows.extend(partial['rows'])
+        for group, state in partial['pooled'].items():
+            pooled[group].merge(SizeStats.from_state(state))
+    if not rows:
+        print("No valid statistics collected. Check the log files for packets.")
+        return
+
+    pooled_df = pd.DataFrame([{'group': group, **group_stats.row()} for group, group_stats in pooled.items()])
+    stats_df = pd.DataFrame(rows).sort_values('file', kind='stable')
+    stats_df.to_csv(os.path.join(output_dir, 'packet_size_stats.csv'), index=False)
+    pooled_df.to_csv(os.path.join(output_dir, 'packet_size_pooled.csv'), index=False)
+    print(f"Pooled packet size statistics across {stats_df['file'].nunique()} files:")
+    print(pooled_df.to_string(index=False, float_format=lambda value: f"{value:.2f}"))
+    print(f"Statistics saved to packet_size_stats.csv and packet_size_pooled.csv in {output_dir}")
+
+
+def reduce_defense(partials, output_dir):
+    # One run manifest for the whole corpus; its paths are relative to the corpus root, as in every shard
+    entries = {}
+    for partial in partials:
+        entries.update(partial['entries'])
+    save_manifest(entries, os.path.join(output_dir, MANIFEST_FILE))
+    original = sum(entry['original']['bytes'] for entry in entries.values())
+    modified = sum(entry['modified']['bytes'] for entry in entries.values())
+    print(f"Defended {len(entries)} traces: {original} -> {modified} bytes "
+          f"({(original - modified) / original * 100 if original else 0:.2f}% reduction)")
+    print(f"Run manifest saved to {os.path.join(output_dir, MANIFEST_FILE)}")
+
+
+def reduce_overhead(partials, output_dir):
+    rows = []
+    classes = {}
+    for partial in partials:
+        rows.extend(partial['rows'])
+        for label, totals in partial['classes'].items():
+            if label in classes:
+                merged = classes[label]
+                merged['traces'] += totals['traces']
+                for side in ('original', 'modified'):
+                    merged[side] = add_totals(merged[side], totals[side])
+            else:
+                classes[label] = totals
+    if not rows:
+        print("No valid statistics collected. Check the log files for packet_size data.")
+        return
+
+    overhead_df = add_overhead_columns(pd.DataFrame(rows).sort_values('file').reset_index(drop=True))
+    class_rows = [{'class': label, 'traces': totals['traces'],
+                   **{f'{side}_{key}': totals[side][key] for side in ('original', 'modified') for key in TOTALS_KEYS}}
+                  for label, totals in classes.items()]
+    class_df = add_overhead_columns(pd.DataFrame(class_rows))
+    class_df = class_df.sort_values('class', key=lambda labels: pd.to_numeric(labels, errors='coerce')).reset_index(drop=True)
+    totals = [f'{side}_{key}' for side in ('original', 'modified') for key in TOTALS_KEYS]
+    overall = add_overhead_columns(pd.DataFrame([class_df[totals].sum()])).to_dict('records')[0]
+
+    overhead_df.to_csv(os.path.join(output_dir, 'overhead_comparison.csv'), index=False)
+    class_df.to_csv(os.path.join(output_dir, 'overhead_by_class.csv'), index=False)
+    print(f"Aggregated overhead statistics across {len(overhead_df)} traces:")
+    print(f"Total original overhead: {overall['original_overhead']} bytes")
+    print(f"Total modified overhead: {overall['modified_overhead']} bytes")
+    print(f"Total overhead reduction: {overall['overhead_reduction']} bytes ({overall['overhead_reduction_percentage']:.2f}%)")
+    print(f"Overhead comparison statistics saved to overhead_comparison.csv and overhead_by_class.csv in {output_dir}")
+
+
+def reduce_features(partials, output_dir, num_classes):
+    # Corpus maxima are the maxima of the shard maxima, so the features equal a single-node extraction
+    windows = {tuple(int(value) for value in partial['window']) for partial in partials}
+    if len(windows) > 1:
+        raise ValueError(f"Feature partials were binned with different windows: {sorted(windows)}")
+    start, end = windows.pop()
+    n_bins = (start - end) * 4
+    partials = [partial for partial in partials if len(partial['labels'])]
+    if not partials:
+        print("Error: No valid features extracted")
+        return
+
+    counts = np.concatenate([partial['counts'] for partial in partials])
+    labels = np.concatenate([partial['labels'] for partial in partials])
+    files = np.concatenate([partial['files'] for partial in partials])
+    order = np.argsort(files, kind='stable')
+    maxima = np.max([partial['maxima'] for partial in partials], axis=0)
+    features = counts[order] / np.repeat(maxima, n_bins)
+
+    feature_dir = os.path.join(output_dir, FEATURE_DIR)
+    save_features(features, labels[order], {
+        "start": start,
+        "end": end,
+        "num_classes": num_classes,
+        "bins": n_bins,
+        "max_pps_down": float(maxima[0]),
+        "max_pps_up": float(maxima[1]),
+        "max_pps_all": float(maxima[2]),
+    }, feature_dir)
+    print(f"Extracted {len(features)} feature-label pairs from {len(partials)} shards into {feature_dir}")
+
+
+def run_reduce(manifest, stage, partials_dir, output_dir='.'):
+    partials = load_partials(manifest, stage, partials_dir)
+    failed = sum(len(partial['failed']) for partial in partials)
+    if failed:
+        print(f"Warning: {failed} traces failed in the {stage} map tasks")
+    os.makedirs(output_dir, exist_ok=True)
+    if stage == 'size':
+        reduce_size(partials, output_dir)
+    elif stage == 'defense':
+        reduce_defense(partials, output_dir)
+    elif stage == 'overhead':
+        reduce_overhead(partials, output_dir)
+    else:
+        reduce_features(partials, output_dir, manifest['num_classes'])
+
+
+def run_local(manifest_path, stages, root, partials_dir, output_dir='.', workers=os.cpu_count(), map_args=()):
+    # Stand-in for a cluster: every map task runs as a separate process on this machine, at most workers
+    # at a time, with its output in <partials>/<stage>-<shard>.log; a stage is reduced once all its shards finish
+    manifest = load_shard_manifest(manifest_path)
+    os.makedirs(partials_dir, exist_ok=True)
+    for stage in stages:
+        began = time.perf_counter()
+        pending = list(range(len(manifest['shards'])))
+        running = []
+        failed = []
+        while pending or running:
+            while pending and len(running) < workers:
+                shard = pending.pop(0)
+                log = open(os.path.join(partials_dir, f'{stage}-{shard:04d}.log'), 'w')
+                process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'map', '--manifest', manifest_path,
+                                            '--shard', str(shard), '--stage', stage, '--root', root,
+                                            '--partials', partials_dir, *map_args],
+                                           stdout=log, stderr=subprocess.STDOUT)
+                running.append((shard, process, log))
+            # Free a slot as soon as any task exits, not just the oldest, so one slow shard does not idle the others
+            finished = [task for task in running if task[1].poll() is not None]
+            if not finished:
+                time.sleep(0.05)
+                continue
+            for task in finished:
+                running.remove(task)
+                shard, process, log = task
+                log.close()
+                if process.returncode != 0:
+                    failed.append(shard)
+        if failed:
+            raise RuntimeError(f"{stage} map tasks failed for shards {failed}; see their logs in {partials_dir}")
+        print(f"{stage}: {len(manifest['shards'])} map tasks in {time.perf_counter() - began:.1f}s")
+        run_reduce(manifest, stage, partials_dir, output_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = subparsers.add_parser("plan", help="partition the traces of a corpus into shards")
+    plan_parser.add_argument("--path", help="corpus root with one subfolder per class", default=defense.scrambler_folder)
+    plan_parser.add_argument("-n", "--shards", help="number of shards", type=int, required=True)
+    plan_parser.add_argument("--by", help="keep class folders together or spread traces by path hash", choices=PARTITIONS, default="class")
+    plan_parser.add_argument("--seed", help="master seed every defense map task uses", type=int, default=0)
+    plan_parser.add_argument("--manifest", help="shard manifest to write", default=SHARD_MANIFEST)
+
+    map_parser = subparsers.add_parser("map", help="run one stage over one shard and write its partial")
+    map_parser.add_argument("--manifest", help="shard manifest", default=SHARD_MANIFEST)
+    map_parser.add_argument("--shard", help="shard index", type=int, required=True)
+    map_parser.add_argument("--stage", choices=STAGES, required=True)
+    map_parser.add_argument("--root", help="local directory holding this shard's class folders (default: the planned root)")
+    map_parser.add_argument("--partials", help="directory the partial is written to", default=PARTIALS_DIR)
+    run_metrics.add_metrics_arguments(map_parser)
+
+    reduce_parser = subparsers.add_parser("reduce", help="merge the partials of every shard for one stage")
+    reduce_parser.add_argument("--manifest", help="shard manifest", default=SHARD_MANIFEST)
+    reduce_parser.add_argument("--stage", choices=STAGES, required=True)
+    reduce_parser.add_argument("--partials", help="directory holding the partials", default=PARTIALS_DIR)
+    reduce_parser.add_argument("--output-dir", help="directory the merged outputs are written to", default=".")
+
+    local_parser = subparsers.add_parser("run-local", help="run every shard as a separate local process, then reduce")
+    local_parser.add_argument("--manifest", help="shard manifest", default=SHARD_MANIFEST)
+    local_parser.add_argument("--stages", help="stages to run, in order", choices=STAGES, nargs="+", default=STAGES)
+    local_parser.add_argument("--root", help="corpus root (default: the planned root)")
+    local_parser.add_argument("--partials", help="directory holding the partials and map task logs", default=PARTIALS_DIR)
+    local_parser.add_argument("--output-dir", help="directory the merged outputs are written to", default=".")
+    local_parser.add_argument("-j", "--workers", help="map tasks run at a time", type=int, default=os.cpu_count())
+
+    # Map task options, passed through by run-local
+    for subparser in (map_parser, local_parser):
+        subparser.add_argument("--output", help="how the defense persists defended traces", choices=["csv", "binary"], default="csv")
+        subparser.add_argument("-s", "--start", help="eavesdropping start time for features, in seconds from end of trace", type=int, default=60)
+        subparser.add_argument("-e", "--end", help="eavesdropping end time for features, in seconds from end of trace", type=int, default=0)
+        subparser.add_argument("--original", help="bin the original traces instead of the defended ones", action="store_true")
+        subparser.add_argument("--rescan", help="compute overhead by reading the traces instead of the defense partial", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        manifest = plan_shards(args.path, args.shards, args.by, args.seed)
+        if not any(manifest['shards']):
+            print("No original .log files (excluding .qoe.log and _modified.log) found in", args.path)
+            exit()
+        save_json(manifest, args.manifest)
+        sizes = [len(keys) for keys in manifest['shards']]
+        print(f"Planned {sum(sizes)} traces in {len(sizes)} shards by {args.by} ({min(sizes)}-{max(sizes)} traces per shard)")
+        print(f"Shard manifest saved to {args.manifest}")
+    elif args.command == "map":
+        manifest = load_shard_manifest(args.manifest)
+        if not 0 <= args.shard < len(manifest['shards']):
+            parser.error(f"--shard must be in [0, {len(manifest['shards'])})")
+        run_metrics.configure(args, 'sharded_pipeline')
+        with run_metrics.profiled(args.profile):
+            run_map(manifest, args.shard, args.stage, args.root or manifest['root'], args.partials, args.output,
+                    args.start, args.end, not args.original, args.rescan)
+    elif args.command == "reduce":
+        try:
+            run_reduce(load_shard_manifest(args.manifest), args.stage, args.partials, args.output_dir)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"Error: {e}")
+            exit(1)
+    else:
+        map_args = ['--output', args.output, '--start', str(args.start), '--end', str(args.end)]
+        if args.original:
+            map_args.append('--original')
+        if args.rescan:
+            map_args.append('--rescan')
+        root = args.root or load_shard_manifest(args.manifest)['root']
+        try:
+            run_local(args.manifest, args.stages, root, args.partials, args.output_dir, args.workers, map_args)
+        except (RuntimeError, FileNotFoundError, ValueError) as e:
+            print(f"Error: {e}")
+            exit(1)
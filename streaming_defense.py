@@ -0,0 +1,169 @@
+import numpy as np
+
+from beauty_modified_knn import LAST_TIME_CODES, bin_packets
+from trace_cache import Trace, EVENT_CODES, PADDING_CODES, iter_trace_chunks, trace_to_dataframe, traffic_totals, add_totals, TOTALS_KEYS
+
+# Timestamp jitter is truncated at this many standard deviations, which bounds how far a packet
+# can move and therefore how many packets the reorder buffer has to hold
+REORDER_SIGMAS = 6
+
+# Rows read from the trace per chunk
+CHUNK_ROWS = 100000
+
+SENT_COUNTED = np.array([EVENT_CODES['s'], EVENT_CODES['sp']], dtype=np.int8)
+RECEIVED_COUNTED = np.array([EVENT_CODES['r'], EVENT_CODES['rp']], dtype=np.int8)
+
+
+def scan_trace(log_file, chunk_rows=CHUNK_ROWS):
+    # First pass over a trace: (padding packet count, last timestamp, traffic totals) of its valid rows
+    n_padding = 0
+    max_time = 0
+    totals = dict.fromkeys(TOTALS_KEYS, 0)
+    for chunk in iter_trace_chunks(log_file, chunk_rows):
+        valid = chunk.packet_size >= 0
+        n_padding += int(np.isin(chunk.event_code[valid], PADDING_CODES).sum())
+        if valid.any():
+            max_time = max(max_time, int(chunk.timestamp_ns[valid].max()))
+        totals = add_totals(totals, traffic_totals(chunk))
+    return n_padding, max_time, totals
+
+
+def stream_defense(chunks, rng, n_padding, max_time, padding_size_range, time_scramble_std,
+                   padding_reduction_ratio, extra_dummy_packets, reorder_window=None):
+    # Generator version of modify_padding_improved.apply_defense over time-ordered Trace chunks.
+    # Yields defended Trace chunks in timestamp order; memory is bounded by one chunk plus the
+    # packets within reorder_window of its end. n_padding and max_time come from scan_trace.
+    if reorder_window is None:
+        reorder_window = int(REORDER_SIGMAS * time_scramble_std)
+
+    # 1. Padding reduction: exactly int(n_padding * ratio) packets are kept, chosen uniformly.
+    # Each chunk's share of the kept set is hypergeometric, then chosen uniformly within the chunk.
+    keep_remaining = int(n_padding * padding_reduction_ratio)
+    padding_remaining = n_padding
+
+    # 5. Dummy packets are few, so they are drawn up front and merged in as the stream passes them
+    dummy_times = np.sort(rng.integers(0, max_time + 1, size=extra_dummy_packets, dtype=np.int64))
+    dummy_codes = rng.choice(PADDING_CODES, size=extra_dummy_packets)
+    dummy_sizes = rng.integers(padding_size_range[0], padding_size_range[1] + 1,
+                               size=extra_dummy_packets, dtype=np.int64)
+    # Dummies sort after original packets with the same timestamp
+    dummy_seq = np.iinfo(np.int64).max - extra_dummy_packets + np.arange(extra_dummy_packets)
+    dummy_next = 0
+
+    pending = {'ts': np.empty(0, np.int64), 'code': np.empty(0, np.int8),
+               'size': np.empty(0, np.int64), 'seq': np.empty(0, np.int64)}
+    state = {'start_time': None, 'sent': 0, 'received': 0}
+    seq_offset = 0
+
+    def emit(ts, code, size, seq):
+        order = np.lexsort((seq, ts))
+        ts, code, size = ts[order], code[order], size[order]
+        sent = state['sent'] + np.cumsum(np.isin(code, SENT_COUNTED))
+        received = state['received'] + np.cumsum(np.isin(code, RECEIVED_COUNTED))
+        if len(ts):
+            state['sent'], state['received'] = int(sent[-1]), int(received[-1])
+        start_time = state['start_time'] if state['start_time'] is not None else 0
+        return Trace(timestamp_ns=ts, event_code=code, packet_size=size,
+                     absolute_timestamp=start_time + (ts / 1e6).astype(np.int64),
+                     cumulative_sent=sent, cumulative_received=received)
+
+    for chunk in chunks:
+        valid = chunk.packet_size >= 0
+        ts = np.asarray(chunk.timestamp_ns[valid], dtype=np.int64)
+        code = np.asarray(chunk.event_code[valid])
+        size = np.asarray(chunk.packet_size[valid], dtype=np.int64)
+        absolute = chunk.absolute_timestamp[valid]
+        n_rows = len(ts)
+        if n_rows == 0:
+            continue
+        last_original = ts[-1]
+
+        padding = np.isin(code, PADDING_CODES)
+        n_chunk_padding = int(padding.sum())
+        keep = ~padding
+        if n_chunk_padding:
+            n_keep = 0
+            if keep_remaining > 0:
+                n_keep = int(rng.hypergeometric(n_chunk_padding, padding_remaining - n_chunk_padding, keep_remaining))
+            keep_padding = np.zeros(n_chunk_padding, dtype=bool)
+            keep_padding[rng.choice(n_chunk_padding, size=n_keep, replace=False)] = True
+            keep[padding] = keep_padding
+            padding_remaining -= n_chunk_padding
+            keep_remaining -= n_keep
+        ts, code, size, absolute, padding = ts[keep], code[keep], size[keep], absolute[keep], padding[keep]
+        seq = seq_offset + np.flatnonzero(keep)
+        seq_offset += n_rows
+
+        if state['start_time'] is None and len(ts):
+            state['start_time'] = int(absolute[0])
+
+        # 2. Randomize padding packet sizes
+        size[padding] = rng.integers(padding_size_range[0], padding_size_range[1] + 1,
+                                     size=int(padding.sum()), dtype=np.int64)
+
+        # 3. Time scrambling, truncated to the reorder window
+        noise = np.clip(rng.normal(0, time_scramble_std, size=len(ts)), -reorder_window, reorder_window)
+        ts = np.maximum(ts + noise.astype(np.int64), 0)
+
+        pending = {'ts': np.concatenate([pending['ts'], ts]), 'code': np.concatenate([pending['code'], code]),
+                   'size': np.concatenate([pending['size'], size]), 'seq': np.concatenate([pending['seq'], seq])}
+
+        # Later packets are at least last_original - reorder_window after jitter, so everything
+        # earlier than that is final and can be emitted
+        threshold = last_original - reorder_window
+        ready = pending['ts'] < threshold
+        dummy_stop = dummy_next + int(np.searchsorted(dummy_times[dummy_next:], threshold))
+        if ready.any() or dummy_stop > dummy_next:
+            dummies = slice(dummy_next, dummy_stop)
+            yield emit(np.concatenate([pending['ts'][ready], dummy_times[dummies]]),
+                       np.concatenate([pending['code'][ready], dummy_codes[dummies]]),
+                       np.concatenate([pending['size'][ready], dummy_sizes[dummies]]),
+                       np.concatenate([pending['seq'][ready], dummy_seq[dummies]]))
+            pending = {column: values[~ready] for column, values in pending.items()}
+            dummy_next = dummy_stop
+
+    dummies = slice(dummy_next, extra_dummy_packets)
+    remaining = emit(np.concatenate([pending['ts'], dummy_times[dummies]]),
+                     np.concatenate([pending['code'], dummy_codes[dummies]]),
+                     np.concatenate([pending['size'], dummy_sizes[dummies]]),
+                     np.concatenate([pending['seq'], dummy_seq[dummies]]))
+    if len(remaining.timestamp_ns):
+        yield remaining
+
+
+def defend_trace_streaming(log_file, rng, params, output_file=None, window=None, chunk_rows=CHUNK_ROWS):
+    # Stream one trace through the defense. Writes a CSV like process_trace when output_file is set,
+    # and bins the Beauty window from a retained tail when window=(start, end) is set.
+    # Returns (original traffic totals, modified traffic totals, packet counts or None).
+    n_padding, max_time, original_totals = scan_trace(log_file, chunk_rows)
+    modified_totals = dict.fromkeys(TOTALS_KEYS, 0)
+
+    # Only packets within `start` seconds of the latest trace-ending event can fall in the window
+    tail = []
+    last_event_ns = None
+
+    chunks = stream_defense(iter_trace_chunks(log_file, chunk_rows), rng, n_padding, max_time, **params)
+    first = True
+    for chunk in chunks:
+        modified_totals = add_totals(modified_totals, traffic_totals(chunk))
+        if output_file is not None:
+            trace_to_dataframe(chunk).to_csv(output_file, mode='w' if first else 'a', header=first, index=False)
+        first = False
+
+        if window is not None:
+            ends = np.flatnonzero(np.isin(chunk.event_code, LAST_TIME_CODES))
+            if len(ends):
+                last_event_ns = int(chunk.timestamp_ns[ends[-1]])
+            tail.append(chunk)
+            if last_event_ns is not None:
+                horizon = last_event_ns - window[0] * 1000000000
+                tail = [Trace(*(column[part.timestamp_ns >= horizon] for column in part)) for part in tail]
+                tail = [part for part in tail if len(part.timestamp_ns)]
+
+    if first and output_file is not None:
+        trace_to_dataframe(Trace(*(np.empty(0, dtype=np.int64) for _ in Trace._fields))).to_csv(output_file, index=False)
+
+    counts = None
+    if window is not None and tail:
+        counts = bin_packets(Trace(*(np.concatenate(columns) for columns in zip(*tail))), *window)
+    return original_totals, modified_totals, counts
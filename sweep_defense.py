@@ -0,0 +1,162 @@
+import argparse
+import itertools
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import modify_padding_improved as defense
+from beauty_modified_knn import bin_packets, normalize_features, split_features, evaluate_knn
+from trace_cache import load_trace, trace_to_dataframe, dataframe_to_trace
+
+# Parsed original traces, loaded once per worker process: [(label, trace_key, DataFrame), ...]
+_originals = []
+
+
+def load_originals(scrambler_folder):
+    # Load every original trace of the defended dataset, labelled by its class folder
+    _, log_files = defense.find_log_files(scrambler_folder)
+    originals = []
+    for log_file in log_files:
+        label = os.path.basename(os.path.dirname(log_file))
+        try:
+            label = int(label)
+        except ValueError:
+            print(f"Warning: Invalid video folder name {label}, skipping")
+            continue
+        df = trace_to_dataframe(load_trace(log_file))
+        df = df[df['packet_size'] >= 0].reset_index(drop=True)
+        originals.append((label, os.path.relpath(log_file, scrambler_folder), df))
+    return originals
+
+
+def _init_worker(scrambler_folder):
+    global _originals
+    _originals = load_originals(scrambler_folder)
+
+
+def defended_features(originals, params, seed, start, end):
+    # Apply one defense configuration in memory to every original trace and bin the results.
+    # Returns (features, labels, original_overhead, modified_overhead).
+    original_overhead = 0
+    modified_overhead = 0
+    all_counts = []
+    all_labels = []
+
+    for label, trace_key, df in originals:
+        df_modified = defense.apply_defense(df, defense.trace_rng(seed, trace_key), **params)
+        original_overhead += int(df['packet_size'].sum())
+        modified_overhead += int(df_modified['packet_size'].sum())
+
+        counts = bin_packets(dataframe_to_trace(df_modified), start, end)
+        if counts is None:
+            continue
+        pps_up, pps_down, pps_all = (c / 0.25 for c in counts)
+        all_counts.append(np.concatenate([pps_down, pps_up, pps_all]))
+        all_labels.append(label)
+
+    features, _ = normalize_features(np.array(all_counts), (start - end) * 4)
+    return features, np.array(all_labels), original_overhead, modified_overhead
+
+
+def attack_accuracy(features, labels, seed, n_neighbors):
+    # Same split for every configuration so accuracies are comparable
+    random.seed(seed)
+    return evaluate_knn(*split_features(features, labels), n_neighbors=n_neighbors)
+
+
+def evaluate_config(params, seed, start, end, n_neighbors):
+    # Apply one defense configuration in memory and measure its overhead and k-NN accuracy
+    began = time.perf_counter()
+    features, labels, original_overhead, modified_overhead = defended_features(_originals, params, seed, start, end)
+    train_accuracy, test_accuracy = attack_accuracy(features, labels, seed, n_neighbors)
+
+    reduction = original_overhead - modified_overhead
+    return {
+        'padding_size_range': f"{params['padding_size_range'][0]}:{params['padding_size_range'][1]}",
+        'time_scramble_std': params['time_scramble_std'],
+        'padding_reduction_ratio': params['padding_reduction_ratio'],
+        'extra_dummy_packets': params['extra_dummy_packets'],
+        'original_overhead': original_overhead,
+        'modified_overhead': modified_overhead,
+        'overhead_reduction': reduction,
+        'overhead_reduction_percentage': reduction / original_overhead * 100 if original_overhead > 0 else 0,
+        'train_accuracy': train_accuracy,
+        'test_accuracy': test_accuracy,
+        'seconds': time.perf_counter() - began,
+    }
+
+
+def _evaluate(args):
+    return evaluate_config(*args)
+
+
+def pareto_front(results_df):
+    # A configuration is Pareto-optimal if no other one has both lower-or-equal bytes and accuracy
+    costs = results_df[['modified_overhead', 'test_accuracy']].to_numpy()
+    dominated = np.zeros(len(costs), dtype=bool)
+    for i, cost in enumerate(costs):
+        no_worse = (costs <= cost).all(axis=1)
+        better = (costs < cost).any(axis=1)
+        dominated[i] = (no_worse & better).any()
+    return ~dominated
+
+
+def parse_range(value):
+    low, high = value.split(":")
+    return int(low), int(high)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="scrambler folder holding the original traces", default=defense.scrambler_folder)
+    parser.add_argument("--padding-size-range", help="LOW:HIGH padding sizes in bytes", type=parse_range, nargs="+",
+                        default=[defense.padding_size_range])
+    parser.add_argument("--time-scramble-std", help="timestamp jitter std in ns", type=float, nargs="+",
+                        default=[defense.time_scramble_std])
+    parser.add_argument("--padding-reduction-ratio", help="fraction of padding packets kept", type=float, nargs="+",
+                        default=[defense.padding_reduction_ratio])
+    parser.add_argument("--extra-dummy-packets", help="dummy packets added per trace", type=int, nargs="+",
+                        default=[defense.extra_dummy_packets])
+    parser.add_argument("-s", "--start", help="eavesdropping start time, in seconds from end of trace", type=int, default=60)
+    parser.add_argument("-e", "--end", help="eavesdropping end time, in seconds from end of trace", type=int, default=0)
+    parser.add_argument("-k", "--n-neighbors", help="k for the k-NN attack", type=int, default=5)
+    parser.add_argument("--seed", help="master seed for the defense and the train/test split", type=int, default=0)
+    parser.add_argument("-j", "--workers", help="configurations evaluated in parallel", type=int, default=1)
+    parser.add_argument("--output", help="CSV file for the sweep table", default="defense_sweep.csv")
+    args = parser.parse_args()
+
+    _, log_files = defense.find_log_files(args.path)
+    if not log_files:
+        print("No original .log files (excluding .qoe.log and _modified.log) found in", args.path)
+        exit()
+
+    grid = [
+        {'padding_size_range': size_range, 'time_scramble_std': scramble_std,
+         'padding_reduction_ratio': reduction_ratio, 'extra_dummy_packets': dummies}
+        for size_range, scramble_std, reduction_ratio, dummies in itertools.product(
+            args.padding_size_range, args.time_scramble_std, args.padding_reduction_ratio, args.extra_dummy_packets)
+    ]
+    print(f"Evaluating {len(grid)} defense configurations")
+
+    tasks = [(params, args.seed, args.start, args.end, args.n_neighbors) for params in grid]
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                 initargs=(args.path,)) as executor:
+            results = list(executor.map(_evaluate, tasks))
+    else:
+        _init_worker(args.path)
+        results = [_evaluate(task) for task in tasks]
+
+    results_df = pd.DataFrame(results)
+    results_df['pareto'] = pareto_front(results_df)
+    results_df = results_df.sort_values(['modified_overhead', 'test_accuracy']).reset_index(drop=True)
+
+    print("\nPareto-optimal configurations (bytes vs. test accuracy):")
+    print(results_df[results_df['pareto']].drop(columns=['pareto']).to_string(index=False))
+
+    results_df.to_csv(args.output, index=False)
+    print(f"Sweep results saved to {args.output}")
@@ -0,0 +1,129 @@
+import argparse
+import os
+
+import numpy as np
+
+from trace_cache import Trace, EVENT_CODES, trace_to_dataframe
+
+# Folders created under the output root, mirroring the real datasets
+ORIGINAL_DIR = 'LongEnough'
+DEFENDED_DIR = os.path.join('LongEnough-defended', 'constant_4000-scramblerz120z1100z400z1000')
+
+# DASH player model: fixed-length segments fetched in on/off bursts once the buffer is full
+SEGMENT_SECONDS = 4
+BUFFER_SECONDS = 30
+MSS = 1448
+ACK_SIZE_RANGE = (52, 66)
+REQUEST_SIZE_RANGE = (400, 700)
+
+# Per-class mean video bitrate (bits/s) and per-segment variation around it (log-normal sigma);
+# the segment size sequence is the class fingerprint
+BITRATE_RANGE = (500000, 4000000)
+SEGMENT_SIGMA = 0.35
+
+# Per-trace download throughput (bits/s) and noise on the segment sizes
+THROUGHPUT_RANGE = (20000000, 50000000)
+TRACE_SIGMA = 0.05
+
+# Padding of the defended copies: constant 4000-byte sp/rp packets
+PADDING_SIZE = 4000
+
+EPOCH_MS = 1700000000000
+
+
+def segment_sizes(seed, label, n_segments):
+    # Segment sizes in bytes shared by every trace of a class
+    rng = np.random.default_rng([seed, label])
+    bitrate = rng.uniform(*BITRATE_RANGE)
+    return bitrate * SEGMENT_SECONDS / 8 * rng.lognormal(0, SEGMENT_SIGMA, size=n_segments)
+
+
+def generate_trace(rng, sizes, duration):
+    # One playback session as (timestamps ns, event codes, packet sizes), cut at duration seconds
+    throughput = rng.uniform(*THROUGHPUT_RANGE)
+    sizes = sizes * rng.lognormal(0, TRACE_SIGMA, size=len(sizes))
+    timestamps, codes, packet_sizes = [], [], []
+    done = rng.uniform(0, 0.5)
+    for k, size in enumerate(sizes):
+        # Startup fills the buffer back to back; afterwards a segment is fetched as one is played out
+        request = max(done, k * SEGMENT_SECONDS - BUFFER_SECONDS) + rng.uniform(0, 0.05)
+        if request >= duration:
+            break
+        n_packets = int(np.ceil(size / MSS))
+        download = size * 8 / (throughput * rng.uniform(0.7, 1.0))
+        arrivals = request + 0.02 + np.sort(rng.uniform(0, download, size=n_packets))
+        data_sizes = np.full(n_packets, MSS)
+        data_sizes[-1] = max(int(size) - MSS * (n_packets - 1), ACK_SIZE_RANGE[0])
+        acks = arrivals[1::2] + 0.0001
+
+        timestamps += [[request], arrivals, acks]
+        codes += [[EVENT_CODES['s']], np.full(n_packets, EVENT_CODES['r']), np.full(len(acks), EVENT_CODES['s'])]
+        packet_sizes += [[rng.integers(*REQUEST_SIZE_RANGE)], data_sizes,
+                         rng.integers(ACK_SIZE_RANGE[0], ACK_SIZE_RANGE[1] + 1, size=len(acks))]
+        done = arrivals[-1]
+
+    timestamps = (np.concatenate(timestamps) * 1e9).astype(np.int64)
+    codes = np.concatenate(codes).astype(np.int8)
+    packet_sizes = np.concatenate(packet_sizes).astype(np.int64)
+    keep = timestamps < duration * 1000000000
+    return timestamps[keep], codes[keep], packet_sizes[keep]
+
+
+def add_padding(rng, timestamps, codes, sizes, duration, padding_rate, padding_up):
+    # Constant-size padding packets at Poisson times, a padding_up fraction of them upstream (sp)
+    n_padding = rng.poisson(padding_rate * duration)
+    padding_times = rng.integers(0, duration * 1000000000, size=n_padding, dtype=np.int64)
+    padding_codes = np.where(rng.random(n_padding) < padding_up, EVENT_CODES['sp'], EVENT_CODES['rp']).astype(np.int8)
+    return (np.concatenate([timestamps, padding_times]), np.concatenate([codes, padding_codes]),
+            np.concatenate([sizes, np.full(n_padding, PADDING_SIZE, dtype=np.int64)]))
+
+
+def to_trace(timestamps, codes, sizes, epoch_ms):
+    order = np.argsort(timestamps, kind='stable')
+    timestamps, codes, sizes = timestamps[order], codes[order], sizes[order]
+    sent = np.isin(codes, [EVENT_CODES['s'], EVENT_CODES['sp']])
+    received = np.isin(codes, [EVENT_CODES['r'], EVENT_CODES['rp']])
+    return Trace(timestamp_ns=timestamps, event_code=codes, packet_size=sizes,
+                 absolute_timestamp=epoch_ms + timestamps // 1000000,
+                 cumulative_sent=np.cumsum(sent), cumulative_received=np.cumsum(received))
+
+
+def generate_dataset(root, classes=16, traces_per_class=10, duration=120, padding_rate=40.0, padding_up=0.5, seed=0):
+    # Write root/LongEnough/<class>/trace<i>.log and an undefended copy of every trace with padding added
+    # under root/LongEnough-defended/constant_4000-.../<class>/. Output depends only on the arguments.
+    # Returns {'traces': ..., 'packets': ..., 'defended_packets': ...}.
+    n_segments = duration // SEGMENT_SECONDS + BUFFER_SECONDS // SEGMENT_SECONDS + 2
+    summary = {'traces': 0, 'packets': 0, 'defended_packets': 0}
+    for label in range(classes):
+        sizes = segment_sizes(seed, label, n_segments)
+        for index in range(traces_per_class):
+            rng = np.random.default_rng([seed, label, index])
+            epoch_ms = EPOCH_MS + int(rng.integers(0, 86400000))
+            timestamps, codes, packet_sizes = generate_trace(rng, sizes, duration)
+            original = to_trace(timestamps, codes, packet_sizes, epoch_ms)
+            defended = to_trace(*add_padding(rng, timestamps, codes, packet_sizes, duration, padding_rate, padding_up), epoch_ms)
+
+            for folder, trace in ((ORIGINAL_DIR, original), (DEFENDED_DIR, defended)):
+                directory = os.path.join(root, folder, str(label))
+                os.makedirs(directory, exist_ok=True)
+                trace_to_dataframe(trace).to_csv(os.path.join(directory, f'trace{index}.log'), header=False, index=False)
+            summary['traces'] += 1
+            summary['packets'] += len(original.timestamp_ns)
+            summary['defended_packets'] += len(defended.timestamp_ns)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", help="directory to create LongEnough/ and LongEnough-defended/ in")
+    parser.add_argument("--classes", help="number of videos (class folders)", type=int, default=16)
+    parser.add_argument("--traces", help="traces per class", type=int, default=10)
+    parser.add_argument("--duration", help="trace length in seconds", type=int, default=120)
+    parser.add_argument("--padding-rate", help="padding packets per second in the defended copies", type=float, default=40.0)
+    parser.add_argument("--padding-up", help="fraction of padding packets sent upstream (sp)", type=float, default=0.5)
+    parser.add_argument("--seed", help="seed; the same arguments always produce the same files", type=int, default=0)
+    args = parser.parse_args()
+
+    summary = generate_dataset(args.root, args.classes, args.traces, args.duration, args.padding_rate, args.padding_up, args.seed)
+    print(f"Wrote {summary['traces']} traces ({summary['packets']} packets, {summary['defended_packets']} with padding) "
+          f"per dataset under {args.root}")
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+
+import modify_padding_improved as defense
+from batch_defense import batch_defense, concatenate_traces, split_traces
+from synthetic_dataset import add_padding, generate_trace, segment_sizes, to_trace, EPOCH_MS
+from trace_cache import trace_to_dataframe
+
+
+def write_traces(directory, n_traces, duration=30):
+    log_files = []
+    for index in range(n_traces):
+        rng = np.random.default_rng(index)
+        trace = to_trace(*generate_trace(rng, segment_sizes(0, 0, duration // 4 + 8), duration), EPOCH_MS)
+        log_file = str(directory / f'trace{index}.log')
+        trace_to_dataframe(trace).to_csv(log_file, header=False, index=False)
+        log_files.append(log_file)
+    return log_files
+
+
+def test_corrupt_trace_does_not_abort_batch(tmp_path, monkeypatch):
+    log_files = write_traces(tmp_path, 3)
+    load_trace = defense.load_trace
+
+    def load_corrupt(log_file):
+        # Columns of different lengths, as from a damaged cache file
+        trace = load_trace(log_file, cache_dir=str(tmp_path / 'cache'))
+        if log_file == log_files[1]:
+            trace = trace._replace(packet_size=trace.packet_size[:-10])
+        return trace
+
+    monkeypatch.setattr(defense, 'load_trace', load_corrupt)
+    results = defense.process_batch((0, log_files), master_seed=1, batch_size=3, root=str(tmp_path), output='none')
+
+    assert results[1] == (None, None)
+    for log_file, (entry, _) in zip([log_files[0], log_files[2]], [results[0], results[2]]):
+        assert entry['file'] == os.path.basename(log_file)
+        assert entry['modified']['packets'] > 0
+
+
+PARAMS = {'padding_size_range': (50, 70), 'time_scramble_std': 5000000, 'padding_reduction_ratio': 0.3,
+          'extra_dummy_packets': 15}
+
+
+def padded_trace(seed, duration=30):
+    rng = np.random.default_rng(seed)
+    timestamps, codes, sizes = generate_trace(rng, segment_sizes(0, seed, duration // 4 + 8), duration)
+    timestamps, codes, sizes = add_padding(rng, timestamps, codes, sizes, duration, 40.0, 0.5)
+    # Shifted past the jitter so no timestamp is clipped at zero
+    return to_trace(timestamps + 10**9, codes, sizes, EPOCH_MS)
+
+
+def defense_statistics(original, defended):
+    # Per-trace quantities both engines must agree on: padding and s/r row counts, padding sizes, the s/r
+    # rows' sizes (which the defense never changes) and their summed timestamp shift (a jitter sample)
+    padding = defended['event_type'].isin(['sp', 'rp'])
+    traffic = original[~original['event_type'].isin(['sp', 'rp'])]
+    kept_traffic = defended[~padding]
+    return {
+        'padding': int(padding.sum()),
+        'padding_sizes': defended.loc[padding, 'packet_size'].to_numpy(),
+        'traffic_untouched': (sorted(zip(traffic['event_type'], traffic['packet_size']))
+                              == sorted(zip(kept_traffic['event_type'], kept_traffic['packet_size']))),
+        'shift': int(kept_traffic['timestamp_ns'].sum() - traffic['timestamp_ns'].sum()),
+        'traffic': len(traffic),
+    }
+
+
+def test_batch_defense_matches_apply_defense_in_distribution():
+    originals = [padded_trace(seed) for seed in range(3)]
+    frames = [trace_to_dataframe(trace) for trace in originals]
+    per_file = []
+    batched = []
+    for seed in range(40):
+        rng = np.random.default_rng(seed)
+        per_file.extend(defense_statistics(df, defense.apply_defense(df, rng, **PARAMS)) for df in frames)
+        trace, offsets = concatenate_traces(originals)
+        defended, offsets = batch_defense(trace, offsets, rng, **PARAMS)
+        batched.extend(defense_statistics(df, trace_to_dataframe(defended))
+                       for df, defended in zip(frames, split_traces(defended, offsets)))
+
+    for stats in (per_file, batched):
+        # Exactly int(padding * ratio) padding packets kept plus the dummies, in every trace
+        for i, df in enumerate(frames):
+            n_padding = int(df['event_type'].isin(['sp', 'rp']).sum())
+            expected = int(n_padding * PARAMS['padding_reduction_ratio']) + PARAMS['extra_dummy_packets']
+            assert all(s['padding'] == expected for s in stats[i::len(frames)])
+        assert all(s['traffic_untouched'] for s in stats)
+
+        sizes = np.concatenate([s['padding_sizes'] for s in stats])
+        assert sizes.min() == PARAMS['padding_size_range'][0] and sizes.max() == PARAMS['padding_size_range'][1]
+        assert abs(sizes.mean() - 60) < 0.5
+
+        # The summed shift of n rows is N(0, n * std^2)
+        jitter_std = np.sqrt(np.mean([s['shift'] ** 2 / s['traffic'] for s in stats]))
+        assert abs(jitter_std / PARAMS['time_scramble_std'] - 1) < 0.2
+
+    per_file_sizes = np.concatenate([s['padding_sizes'] for s in per_file])
+    batched_sizes = np.concatenate([s['padding_sizes'] for s in batched])
+    assert abs(per_file_sizes.std() - batched_sizes.std()) < 0.5
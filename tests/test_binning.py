@@ -0,0 +1,84 @@
+import math
+
+import numpy as np
+import pytest
+
+from beauty_modified_knn import bin_packets
+from synthetic_dataset import add_padding, generate_trace, segment_sizes, to_trace, EPOCH_MS
+from trace_cache import parse_log, trace_to_dataframe
+
+
+def baseline_last_time(lines):
+    for line in reversed(lines):
+        tokens = line.split(",")
+        if len(tokens) < 2:
+            continue
+        if tokens[1] in ("r", "r+p", "s", "s+p"):
+            try:
+                return math.ceil(int(tokens[0]) / 1000000000 / 2) * 2
+            except ValueError:
+                continue
+    return -1
+
+
+def baseline_packet_count(lines, direction, start, end):
+    # The line-by-line loop bin_packets replaced
+    counts = []
+    last_time = baseline_last_time(lines)
+    for line in lines:
+        tokens = line.split(",")
+        if len(tokens) < 2:
+            continue
+        try:
+            timestamp = int(tokens[0]) / 1000000000
+        except ValueError:
+            continue
+        if timestamp < last_time - start:
+            continue
+        if timestamp >= last_time - end:
+            break
+        if direction not in tokens[1]:
+            continue
+        offset = (timestamp - (last_time - start)) * 4.0
+        while len(counts) <= offset:
+            counts.append(0)
+        counts[math.floor(offset)] += 1
+    while len(counts) < (start - end) * 4:
+        counts.append(0)
+    return counts[:(start - end) * 4]
+
+
+def write_log(log_file, seed, duration=90):
+    rng = np.random.default_rng(seed)
+    timestamps, codes, sizes = generate_trace(rng, segment_sizes(0, seed, duration // 4 + 8), duration)
+    df = trace_to_dataframe(to_trace(*add_padding(rng, timestamps, codes, sizes, duration, 40.0, 0.5), EPOCH_MS))
+    # Combined and unknown events, a few rows out of time order and a row without a numeric timestamp
+    rows = rng.choice(len(df), size=40, replace=False)
+    df.loc[rows[:20], 'event_type'] = rng.choice(['s+p', 'r+p', 'x'], size=20)
+    df.loc[rows[20:40], 'timestamp_ns'] += rng.integers(-10**9, 10**9, size=20)
+    lines = df.to_csv(header=False, index=False).splitlines(keepends=True)
+    lines.insert(len(lines) // 2, "garbage,r,100,0,0,0\n")
+    with open(log_file, 'w') as f:
+        f.writelines(lines)
+    return str(log_file)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('start, end', [(60, 0), (30, 10), (200, 0)])
+def test_bin_packets_matches_baseline_loop(tmp_path, seed, start, end):
+    log_file = write_log(tmp_path / 'trace.log', seed)
+    with open(log_file) as f:
+        lines = f.readlines()
+
+    pps_up, pps_down, pps_all = bin_packets(parse_log(log_file), start, end)
+    expected_up = baseline_packet_count(lines, "s", start, end)
+    expected_down = baseline_packet_count(lines, "r", start, end)
+    np.testing.assert_array_equal(pps_up, expected_up)
+    np.testing.assert_array_equal(pps_down, expected_down)
+    np.testing.assert_array_equal(pps_all, np.add(expected_up, expected_down))
+    assert sum(expected_up) > 0 and sum(expected_down) > 0
+
+
+def test_bin_packets_without_packets():
+    empty = to_trace(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8), np.empty(0, dtype=np.int64), EPOCH_MS)
+    assert bin_packets(empty, 60, 0) is None
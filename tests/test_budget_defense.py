@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from budget_defense import defend_with_budget
+from synthetic_dataset import add_padding, generate_trace, segment_sizes, to_trace, EPOCH_MS
+
+
+def synthetic_trace(seed, duration=60):
+    rng = np.random.default_rng(seed)
+    timestamps, codes, sizes = generate_trace(rng, segment_sizes(0, seed, duration // 4 + 8), duration)
+    return to_trace(*add_padding(rng, timestamps, codes, sizes, duration, 40.0, 0.5), EPOCH_MS)
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('budget', [{'budget_bps': 2000.0}, {'budget_percent': 1.0}, {'budget_percent': 10.0}])
+def test_padding_never_exceeds_budget(seed, budget):
+    _, report = defend_with_budget(synthetic_trace(seed), np.random.default_rng(seed), **budget)
+    assert report['padding_bytes'] <= report['budget_bytes']
+    # The unspent remainder is less than one packet plus the draw shortfall, not a systematic underspend
+    assert report['padding_bytes'] >= 0.95 * report['budget_bytes']
@@ -0,0 +1,41 @@
+import threading
+from http.server import HTTPServer
+
+import numpy as np
+import pytest
+
+from evaluation_service import EvaluationService, ServiceHandler
+from feature_store import save_features
+from service_client import call
+
+META = {"start": 60, "end": 0, "num_classes": 2, "bins": 240,
+        "max_pps_down": 100.0, "max_pps_up": 50.0, "max_pps_all": 150.0}
+
+
+@pytest.fixture
+def port(tmp_path):
+    rng = np.random.default_rng(0)
+    save_features(rng.random((10, 3 * 240)), np.arange(10) % 2, META, str(tmp_path / "features"))
+    (tmp_path / "corpus").mkdir()
+    service = EvaluationService(str(tmp_path / "corpus"), feature_dir=str(tmp_path / "features"))
+    server = HTTPServer(('127.0.0.1', 0), ServiceHandler)
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_classify_trace_without_packets_in_window(tmp_path, port):
+    # A trace with no usable packets is listed as unreadable, not rejected as a bad request
+    empty = tmp_path / "empty.log"
+    empty.write_text("garbage\n")
+    status, body = call('/classify', {'traces': [str(empty)]}, port)
+    assert status == 200
+    assert body == {'predictions': [], 'unreadable': [str(empty)]}
+
+
+def test_classify_missing_trace(tmp_path, port):
+    status, body = call('/classify', {'traces': [str(tmp_path / "missing.log")]}, port)
+    assert status == 404
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from fingerprint_index import FingerprintIndex, trace_vectors
+
+META = {"start": 60, "end": 0, "max_pps_down": 100.0, "max_pps_up": 50.0, "max_pps_all": 150.0}
+DIM = 3 * 60 * 4
+
+
+def test_trace_vectors_without_usable_traces(tmp_path):
+    vectors, kept = trace_vectors([], META)
+    assert vectors.shape == (0, DIM) and kept == []
+
+    unusable = tmp_path / "garbage.log"
+    unusable.write_text("garbage\n")
+    vectors, kept = trace_vectors([str(unusable)], META)
+    assert vectors.shape == (0, DIM) and kept == []
+
+
+def test_empty_index(tmp_path):
+    index = FingerprintIndex.build(np.empty((0, DIM)), [], META, str(tmp_path / "index"))
+    queries = np.random.default_rng(0).random((3, DIM))
+    distances, ids = index.search(queries, k=5)
+    assert distances.shape == ids.shape == (3, 0)
+    with pytest.raises(ValueError):
+        index.classify(queries)
+
+
+@pytest.mark.parametrize("n_lists", [None, 4])
+def test_empty_query_set(tmp_path, n_lists):
+    rng = np.random.default_rng(0)
+    index = FingerprintIndex.build(rng.random((40, DIM)), np.arange(40) % 4, META, str(tmp_path / "index"),
+                                   n_lists=n_lists)
+    distances, ids = index.search(np.empty((0, DIM)), k=5, nprobe=1)
+    assert distances.shape == ids.shape == (0, 5)
+    assert index.classify(np.empty((0, DIM)), k=5, nprobe=1).shape == (0,)
+    index.add(np.empty((0, DIM)), [])
+    assert len(index) == 40
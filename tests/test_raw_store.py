@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pytest
+
+import feature_store
+from beauty_modified_knn import ingest_traces, load_ingested_features
+from feature_store import append_raw_counts, create_raw_store, load_raw_store, COUNTS_FILE, ENTRIES_FILE
+from synthetic_dataset import generate_trace, segment_sizes, to_trace, EPOCH_MS
+from trace_cache import trace_to_dataframe
+
+BINS = 8
+
+
+def rows(n, value):
+    return np.full((n, 3, BINS), value, dtype=np.int32)
+
+
+def entry(path, row):
+    return {"path": path, "size": 1, "mtime_ns": 1, "sha256": path, "label": 0, "row": row}
+
+
+def test_interrupted_append_is_discarded(tmp_path):
+    raw_dir = str(tmp_path / 'raw')
+    meta = create_raw_store({"start": 2, "end": 0, "bins": BINS, "modified": False}, raw_dir)
+    append_raw_counts(rows(2, 1), [entry('a', 0), entry('b', 1)], meta, raw_dir)
+
+    # An ingest killed after writing its rows and entries but before committing meta.json,
+    # with a retirement of a, a new trace c and a half-written line
+    with open(os.path.join(raw_dir, COUNTS_FILE), 'ab') as f:
+        f.write(rows(3, 7).tobytes()[:-5])
+    with open(os.path.join(raw_dir, ENTRIES_FILE), 'a') as f:
+        f.write('{"path": "a", "row": null}\n{"path": "c", "size": 1, "mtime_ns": 1, "sha256": "c", "label": 0, "row": 2}\n{"pa')
+
+    counts, entries, meta = load_raw_store(raw_dir)
+    assert sorted(entries) == ['a', 'b'] and entries['a']['row'] == 0
+    np.testing.assert_array_equal(counts, rows(2, 1))
+
+    # The next ingest reuses row 2 for d; the uncommitted entry of c must not point at it
+    append_raw_counts(rows(1, 3), [entry('d', 2)], meta, raw_dir)
+    counts, entries, meta = load_raw_store(raw_dir)
+    assert sorted(entries) == ['a', 'b', 'd']
+    assert [entries[key]['row'] for key in 'abd'] == [0, 1, 2]
+    np.testing.assert_array_equal(counts, np.concatenate([rows(2, 1), rows(1, 3)]))
+    assert os.path.getsize(os.path.join(raw_dir, COUNTS_FILE)) == 3 * 3 * BINS * 4
+
+
+def write_trace(path, label, seed, duration=20):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rng = np.random.default_rng(seed)
+    trace = to_trace(*generate_trace(rng, segment_sizes(label, seed, duration // 4 + 8), duration), EPOCH_MS)
+    trace_to_dataframe(trace).to_csv(path, header=False, index=False)
+
+
+def test_ingest_recovers_from_interrupted_ingest(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    corpus = tmp_path / 'corpus'
+    write_trace(corpus / '0' / 'trace0.log', 0, 0)
+    write_trace(corpus / '1' / 'trace0.log', 1, 1)
+    ingest_traces(str(corpus), 8, 0, raw_dir='raw')
+
+    # Interrupted while adding one trace
+    write_trace(corpus / '0' / 'trace1.log', 0, 2)
+    save_raw_meta = feature_store.save_raw_meta
+
+    def interrupted(meta, raw_dir):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(feature_store, 'save_raw_meta', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        ingest_traces(str(corpus), 8, 0, raw_dir='raw')
+    monkeypatch.setattr(feature_store, 'save_raw_meta', save_raw_meta)
+
+    # Before the next run, that trace is gone again and another one takes its row
+    os.remove(corpus / '0' / 'trace1.log')
+    write_trace(corpus / '1' / 'trace1.log', 1, 3)
+    assert ingest_traces(str(corpus), 8, 0, raw_dir='raw') == 1
+
+    ingest_traces(str(corpus), 8, 0, raw_dir='fresh')
+    features, labels = load_ingested_features('raw')
+    expected_features, expected_labels = load_ingested_features('fresh')
+    assert sorted(load_raw_store('raw')[1]) == ['0/trace0.log', '1/trace0.log', '1/trace1.log']
+    np.testing.assert_array_equal(labels, expected_labels)
+    np.testing.assert_array_equal(features, expected_features)
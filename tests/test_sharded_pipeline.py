@@ -0,0 +1,92 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import modify_padding_improved as defense
+from analyze_overhead import add_overhead_columns, rescan_rows
+from analyze_packet_size import GROUPS, SizeStats, analyze_file
+from beauty_modified_knn import extract_features
+from feature_store import load_feature_store
+from manifest import find_log_files, load_manifest, MANIFEST_FILE
+from sharded_pipeline import plan_shards, run_map, run_reduce, STAGES
+from synthetic_dataset import generate_dataset, DEFENDED_DIR
+
+SEED = 5
+START, END = 8, 0
+
+
+@pytest.fixture(scope='module')
+def corpora(tmp_path_factory):
+    # The same padded corpus twice: one run by the single-node functions, one through every map and reduce
+    tmp_path = tmp_path_factory.mktemp('corpus')
+    generate_dataset(str(tmp_path / 'generated'), classes=3, traces_per_class=3, duration=20)
+    single = str(tmp_path / 'single')
+    sharded = str(tmp_path / 'sharded')
+    shutil.copytree(tmp_path / 'generated' / DEFENDED_DIR, single)
+    shutil.copytree(tmp_path / 'generated' / DEFENDED_DIR, sharded)
+
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        manifest = plan_shards(sharded, 2, 'hash', seed=SEED)
+        assert all(manifest['shards'])
+        output_dir = str(tmp_path / 'reduced')
+        for stage in STAGES:
+            for shard in range(len(manifest['shards'])):
+                run_map(manifest, shard, stage, sharded, str(tmp_path / 'partials'), start=START, end=END)
+            run_reduce(manifest, stage, str(tmp_path / 'partials'), output_dir)
+
+        _, log_files = find_log_files(single)
+        results = [defense.process_trace(log_file, SEED, root=single) for log_file in log_files]
+        entries = {os.path.relpath(log_file, single): entry for log_file, (entry, _) in zip(log_files, results)}
+        extract_features(single, START, END, modified=True)
+        yield {'single': single, 'sharded': sharded, 'output_dir': output_dir, 'entries': entries,
+               'features': load_feature_store(str(tmp_path / 'features'), mmap=False)}
+    finally:
+        os.chdir(cwd)
+
+
+def test_size_stage(corpora):
+    _, log_files = find_log_files(corpora['single'])
+    pooled = {group: SizeStats() for group in GROUPS}
+    rows = []
+    for log_file in log_files:
+        for group, stats in analyze_file(log_file).items():
+            pooled[group].merge(stats)
+            if stats.count:
+                rows.append({'file': os.path.relpath(log_file, corpora['single']), 'group': group, **stats.row()})
+
+    reduced = pd.read_csv(os.path.join(corpora['output_dir'], 'packet_size_stats.csv'))
+    pd.testing.assert_frame_equal(reduced, pd.DataFrame(rows).astype(reduced.dtypes.to_dict()))
+    reduced_pooled = pd.read_csv(os.path.join(corpora['output_dir'], 'packet_size_pooled.csv'))
+    pooled_df = pd.DataFrame([{'group': group, **stats.row()} for group, stats in pooled.items()])
+    pd.testing.assert_frame_equal(reduced_pooled, pooled_df.astype(reduced_pooled.dtypes.to_dict()))
+
+
+def test_defense_stage(corpora):
+    reduced = load_manifest(os.path.join(corpora['output_dir'], MANIFEST_FILE))
+    assert sorted(reduced) == sorted(corpora['entries'])
+    for key, entry in corpora['entries'].items():
+        for field in ('file', 'label', 'input_sha256', 'params', 'seed', 'output', 'output_file', 'original', 'modified'):
+            assert reduced[key][field] == entry[field], (key, field)
+        with open(os.path.join(corpora['single'], entry['output_file'])) as single, \
+                open(os.path.join(corpora['sharded'], entry['output_file'])) as sharded:
+            assert single.read() == sharded.read()
+
+
+def test_overhead_stage(corpora):
+    expected = add_overhead_columns(pd.DataFrame(rescan_rows(corpora['single'])).sort_values('file').reset_index(drop=True))
+    reduced = pd.read_csv(os.path.join(corpora['output_dir'], 'overhead_comparison.csv'), dtype={'class': str})
+    pd.testing.assert_frame_equal(reduced, expected, check_dtype=False)
+
+
+def test_features_stage(corpora):
+    features, labels, meta = corpora['features']
+    reduced_features, reduced_labels, reduced_meta = load_feature_store(
+        os.path.join(corpora['output_dir'], 'features'), mmap=False)
+    np.testing.assert_array_equal(reduced_labels, labels)
+    np.testing.assert_array_equal(reduced_features, features)
+    assert reduced_meta == meta
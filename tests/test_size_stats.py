@@ -0,0 +1,77 @@
+import json
+
+import numpy as np
+import pytest
+
+from analyze_packet_size import SizeStats, PERCENTILES
+
+
+def random_parts(seed, high=1500):
+    # Uneven parts, including empty and single-element ones
+    rng = np.random.default_rng(seed)
+    lengths = [0, 1, *rng.integers(1, 2000, size=8).tolist(), 0, 1]
+    return [rng.integers(0, high, size=n) for n in rng.permutation(lengths)]
+
+
+def merged(parts):
+    # Each part accumulated on its own, as by one map task, then merged
+    total = SizeStats()
+    for part in parts:
+        stats = SizeStats()
+        stats.update(part)
+        total.merge(stats)
+    return total
+
+
+def assert_matches_pooled(stats, sizes):
+    assert stats.count == len(sizes)
+    assert stats.mean == pytest.approx(sizes.mean(), rel=1e-12)
+    assert stats.std() == pytest.approx(sizes.std(ddof=1), rel=1e-9)
+    assert (stats.min, stats.max) == (sizes.min(), sizes.max())
+    for q in PERCENTILES:
+        assert stats.percentile(q) == np.percentile(sizes, q, method='inverted_cdf')
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_merge_matches_pooled_numpy(seed):
+    parts = random_parts(seed)
+    assert_matches_pooled(merged(parts), np.concatenate(parts))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_merge_order_does_not_matter(seed):
+    parts = random_parts(seed)
+    forward = merged(parts)
+    backward = merged(parts[::-1])
+    assert forward.count == backward.count
+    assert forward.mean == pytest.approx(backward.mean, rel=1e-12)
+    assert forward.std() == pytest.approx(backward.std(), rel=1e-9)
+    np.testing.assert_array_equal(forward.histogram, backward.histogram)
+
+
+def test_state_round_trip():
+    parts = random_parts(0)
+    stats = merged(parts)
+    restored = SizeStats.from_state(json.loads(json.dumps(stats.state())))
+    assert restored.row() == stats.row()
+    # Restored accumulators keep merging like the originals
+    restored.merge(merged(parts))
+    assert_matches_pooled(restored, np.concatenate(parts * 2))
+
+
+def test_sizes_beyond_histogram():
+    # Mean, std, min and max stay exact; percentiles in the overflow bin report the maximum
+    sizes = np.array([100] * 90 + [70000] * 5 + [90000] * 5)
+    stats = merged([sizes[:50], sizes[50:]])
+    assert stats.mean == pytest.approx(sizes.mean())
+    assert stats.std() == pytest.approx(sizes.std(ddof=1))
+    assert stats.percentile(50) == 100
+    assert stats.percentile(95) == 90000
+
+
+def test_empty_and_single():
+    empty = merged([np.array([], dtype=np.int64)])
+    assert empty.count == 0 and np.isnan(empty.percentile(50)) and np.isnan(empty.std())
+    single = merged([np.array([], dtype=np.int64), np.array([42])])
+    assert (single.mean, single.min, single.max, single.percentile(5)) == (42, 42, 42, 42)
+    assert np.isnan(single.std())
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+import modify_padding_improved as defense
+from beauty_modified_knn import bin_packets
+from streaming_defense import defend_trace_streaming, stream_defense, SENT_COUNTED, RECEIVED_COUNTED
+from synthetic_dataset import add_padding, generate_trace, segment_sizes, to_trace, EPOCH_MS
+from trace_cache import Trace, parse_log, trace_to_dataframe, dataframe_to_trace, traffic_totals, PADDING_CODES
+
+PARAMS = {'padding_size_range': (50, 70), 'time_scramble_std': 5000000, 'padding_reduction_ratio': 0.3,
+          'extra_dummy_packets': 15}
+
+
+def padded_trace(seed, duration=30):
+    rng = np.random.default_rng(seed)
+    timestamps, codes, sizes = generate_trace(rng, segment_sizes(0, seed, duration // 4 + 8), duration)
+    timestamps, codes, sizes = add_padding(rng, timestamps, codes, sizes, duration, 40.0, 0.5)
+    # Shifted past the jitter so no timestamp is clipped at zero
+    return to_trace(timestamps + 10**9, codes, sizes, EPOCH_MS)
+
+
+def stream(trace, rng, chunk_rows=1000):
+    chunks = (Trace(*(column[start:start + chunk_rows] for column in trace))
+              for start in range(0, len(trace.timestamp_ns), chunk_rows))
+    n_padding = int(np.isin(trace.event_code, PADDING_CODES).sum())
+    defended = list(stream_defense(chunks, rng, n_padding, int(trace.timestamp_ns.max()), **PARAMS))
+    return Trace(*(np.concatenate(columns) for columns in zip(*defended)))
+
+
+def defense_statistics(original, defended):
+    # Per-trace quantities both engines must agree on: padding and s/r row counts, padding sizes, the s/r
+    # rows' sizes (which the defense never changes) and their summed timestamp shift (a jitter sample)
+    padding = defended['event_type'].isin(['sp', 'rp'])
+    traffic = original[~original['event_type'].isin(['sp', 'rp'])]
+    kept_traffic = defended[~padding]
+    return {
+        'padding': int(padding.sum()),
+        'padding_sizes': defended.loc[padding, 'packet_size'].to_numpy(),
+        'traffic_untouched': (sorted(zip(traffic['event_type'], traffic['packet_size']))
+                              == sorted(zip(kept_traffic['event_type'], kept_traffic['packet_size']))),
+        'shift': int(kept_traffic['timestamp_ns'].sum() - traffic['timestamp_ns'].sum()),
+        'traffic': len(traffic),
+    }
+
+
+def test_stream_defense_matches_apply_defense_in_distribution():
+    originals = [padded_trace(seed) for seed in range(3)]
+    frames = [trace_to_dataframe(trace) for trace in originals]
+    per_file = []
+    streamed = []
+    for seed in range(40):
+        rng = np.random.default_rng(seed)
+        for trace, df in zip(originals, frames):
+            per_file.append(defense_statistics(df, defense.apply_defense(df, rng, **PARAMS)))
+            defended = stream(trace, rng)
+            streamed.append(defense_statistics(df, trace_to_dataframe(defended)))
+            # Emitted in time order with the cumulative columns recounted over the whole trace
+            assert (np.diff(defended.timestamp_ns) >= 0).all()
+            np.testing.assert_array_equal(defended.cumulative_sent, np.cumsum(np.isin(defended.event_code, SENT_COUNTED)))
+            np.testing.assert_array_equal(defended.cumulative_received,
+                                          np.cumsum(np.isin(defended.event_code, RECEIVED_COUNTED)))
+
+    for stats in (per_file, streamed):
+        # Exactly int(padding * ratio) padding packets kept plus the dummies, in every trace
+        for i, df in enumerate(frames):
+            n_padding = int(df['event_type'].isin(['sp', 'rp']).sum())
+            expected = int(n_padding * PARAMS['padding_reduction_ratio']) + PARAMS['extra_dummy_packets']
+            assert all(s['padding'] == expected for s in stats[i::len(frames)])
+        assert all(s['traffic_untouched'] for s in stats)
+
+        sizes = np.concatenate([s['padding_sizes'] for s in stats])
+        assert sizes.min() == PARAMS['padding_size_range'][0] and sizes.max() == PARAMS['padding_size_range'][1]
+        assert abs(sizes.mean() - 60) < 0.5
+
+        # The summed shift of n rows is N(0, n * std^2); truncation at REORDER_SIGMAS is negligible
+        jitter_std = np.sqrt(np.mean([s['shift'] ** 2 / s['traffic'] for s in stats]))
+        assert abs(jitter_std / PARAMS['time_scramble_std'] - 1) < 0.2
+
+
+def test_streamed_file_matches_reported_totals_and_counts(tmp_path):
+    log_file = str(tmp_path / 'trace.log')
+    output_file = str(tmp_path / 'trace_modified.log')
+    trace = padded_trace(0, duration=40)
+    trace_to_dataframe(trace).to_csv(log_file, header=False, index=False)
+
+    original_totals, modified_totals, counts = defend_trace_streaming(
+        log_file, np.random.default_rng(0), PARAMS, output_file=output_file, window=(20, 5), chunk_rows=2000)
+
+    written = dataframe_to_trace(pd.read_csv(output_file))
+    assert original_totals == traffic_totals(parse_log(log_file))
+    assert modified_totals == traffic_totals(written)
+    # Binned from the retained tail while streaming, equal to binning the whole written trace
+    for streamed_counts, expected in zip(counts, bin_packets(written, 20, 5)):
+        np.testing.assert_array_equal(streamed_counts, expected)
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+
+from synthetic_dataset import generate_trace, segment_sizes, to_trace, EPOCH_MS
+from trace_cache import (cache_path, iter_trace_chunks, load_trace, parse_log, read_cache, read_trace_file,
+                         trace_to_dataframe, write_trace_file, Trace, COLUMN_DTYPES)
+
+
+def write_log(log_file, seed, duration=20):
+    rng = np.random.default_rng(seed)
+    trace = to_trace(*generate_trace(rng, segment_sizes(0, seed, duration // 4 + 8), duration), EPOCH_MS)
+    trace_to_dataframe(trace).to_csv(log_file, header=False, index=False)
+    # A damaged row: kept with packet_size -1, as the cache stores non-numeric values
+    with open(log_file, 'a') as f:
+        f.write(f"{int(trace.timestamp_ns[-1]) + 1},r,oops,{EPOCH_MS},0,0\n")
+    return str(log_file)
+
+
+def assert_traces_equal(trace, expected):
+    for column in COLUMN_DTYPES:
+        np.testing.assert_array_equal(getattr(trace, column), getattr(expected, column), err_msg=column)
+        assert getattr(trace, column).dtype == COLUMN_DTYPES[column]
+
+
+def test_cache_round_trip(tmp_path):
+    log_file = write_log(tmp_path / 'trace.log', 0)
+    cache_dir = str(tmp_path / 'cache')
+    parsed = parse_log(log_file)
+    assert parsed.packet_size[-1] == -1
+
+    assert_traces_equal(load_trace(log_file, cache_dir=cache_dir), parsed)
+    assert os.path.exists(cache_path(log_file, cache_dir))
+    cached = read_cache(log_file, cache_dir)
+    assert isinstance(cached.timestamp_ns, np.memmap)
+    assert_traces_equal(cached, parsed)
+    assert_traces_equal(load_trace(log_file, cache_dir=cache_dir), parsed)
+
+
+@pytest.mark.parametrize('cached', [True, False])
+def test_chunks_match_whole_trace(tmp_path, cached):
+    log_file = write_log(tmp_path / 'trace.log', 1)
+    cache_dir = str(tmp_path / 'cache')
+    if cached:
+        load_trace(log_file, cache_dir=cache_dir)
+    chunks = list(iter_trace_chunks(log_file, chunk_rows=1000, cache_dir=cache_dir))
+    assert len(chunks) > 1
+    assert_traces_equal(Trace(*(np.concatenate(columns) for columns in zip(*chunks))), parse_log(log_file))
+
+
+def test_rewritten_log_invalidates_cache(tmp_path):
+    log_file = write_log(tmp_path / 'trace.log', 0)
+    cache_dir = str(tmp_path / 'cache')
+    load_trace(log_file, cache_dir=cache_dir)
+
+    write_log(tmp_path / 'trace.log', 1)
+    assert read_cache(log_file, cache_dir) is None
+    assert_traces_equal(load_trace(log_file, cache_dir=cache_dir), parse_log(log_file))
+    assert read_cache(log_file, cache_dir) is not None
+
+
+def test_touched_log_invalidates_cache(tmp_path):
+    # Same size, new mtime: the cache cannot tell the content is unchanged, so it is rebuilt
+    log_file = write_log(tmp_path / 'trace.log', 0)
+    cache_dir = str(tmp_path / 'cache')
+    load_trace(log_file, cache_dir=cache_dir)
+    stat = os.stat(log_file)
+    os.utime(log_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert read_cache(log_file, cache_dir) is None
+
+
+def test_damaged_cache_is_rebuilt(tmp_path):
+    log_file = write_log(tmp_path / 'trace.log', 0)
+    cache_dir = str(tmp_path / 'cache')
+    load_trace(log_file, cache_dir=cache_dir)
+    with open(cache_path(log_file, cache_dir), 'wb') as f:
+        f.write(b'garbage')
+    assert read_cache(log_file, cache_dir) is None
+    assert_traces_equal(load_trace(log_file, cache_dir=cache_dir), parse_log(log_file))
+
+
+def test_empty_trace_file_round_trip(tmp_path):
+    empty = Trace(*(np.empty(0, dtype=dtype) for dtype in COLUMN_DTYPES.values()))
+    path = write_trace_file(empty, str(tmp_path / 'empty.trc'))
+    assert_traces_equal(read_trace_file(path), empty)
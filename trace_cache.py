@@ -0,0 +1,276 @@
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import run_metrics
+
+# Column schema shared by all LongEnough .log traces
+COLUMNS = ['timestamp_ns', 'event_type', 'packet_size',
+           'absolute_timestamp', 'cumulative_sent', 'cumulative_received']
+
+# Event types are stored as int8 codes; anything else is stored as EVENT_OTHER
+EVENT_TYPES = ['s', 'r', 'sp', 'rp', 's+p', 'r+p']
+EVENT_CODES = {event: code for code, event in enumerate(EVENT_TYPES)}
+EVENT_OTHER = -1
+
+# Codes per direction (an event belongs to a direction if its name contains it)
+SENT_CODES = np.array([EVENT_CODES[e] for e in EVENT_TYPES if 's' in e], dtype=np.int8)
+RECEIVED_CODES = np.array([EVENT_CODES[e] for e in EVENT_TYPES if 'r' in e], dtype=np.int8)
+PADDING_CODES = np.array([EVENT_CODES['sp'], EVENT_CODES['rp']], dtype=np.int8)
+
+# Binary layout of the cached columns; missing integer values are stored as -1
+COLUMN_DTYPES = {
+    'timestamp_ns': np.int64,
+    'event_code': np.int8,
+    'packet_size': np.int32,
+    'absolute_timestamp': np.int64,
+    'cumulative_sent': np.int64,
+    'cumulative_received': np.int64,
+}
+
+# Cache location, one binary file per trace (set TRACE_CACHE_DIR to move it)
+CACHE_DIR = os.environ.get('TRACE_CACHE_DIR', './.trace_cache')
+CACHE_MAGIC = b'DASHTRC1'
+CACHE_ALIGN = 64
+
+# Standalone binary trace files (same layout as cache entries) and defended-trace naming
+TRACE_SUFFIX = '.trc'
+MODIFIED_SUFFIX = '_modified.log'
+MODIFIED_TRACE_SUFFIX = '_modified' + TRACE_SUFFIX
+
+Trace = namedtuple('Trace', list(COLUMN_DTYPES))
+
+
+def _to_int64(values):
+    # Exact integer parse (no float round-trip for ns timestamps); invalid entries become -1
+    numeric = pd.to_numeric(values, errors='coerce')
+    valid = numeric.notna().to_numpy()
+    result = np.full(len(values), -1, dtype=np.int64)
+    try:
+        result[valid] = values[valid].astype(np.int64).to_numpy()
+    except (ValueError, TypeError, OverflowError):
+        result[valid] = numeric[valid].to_numpy().astype(np.int64)
+    return result, valid
+
+
+def _parse_frame(df):
+    # Convert raw string columns into a Trace, skipping rows without a numeric timestamp
+    timestamps, valid = _to_int64(df['timestamp_ns'])
+    df = df[valid]
+
+    columns = {'timestamp_ns': timestamps[valid],
+               'event_code': df['event_type'].map(EVENT_CODES).fillna(EVENT_OTHER).to_numpy().astype(np.int8)}
+    for column in ['packet_size', 'absolute_timestamp', 'cumulative_sent', 'cumulative_received']:
+        values, _ = _to_int64(df[column])
+        columns[column] = values.astype(COLUMN_DTYPES[column])
+
+    return Trace(**columns)
+
+
+def parse_log(log_file):
+    # Parse a .log trace into columnar arrays
+    return _parse_frame(pd.read_csv(log_file, names=COLUMNS, dtype=str))
+
+
+def iter_trace_chunks(log_file, chunk_rows=1000000, cache_dir=CACHE_DIR):
+    # Yield a trace as consecutive Trace chunks of at most chunk_rows rows. Valid cache entries are
+    # sliced from the memory map; otherwise the .log is read incrementally without building the cache.
+    trace = None
+    if log_file.endswith(TRACE_SUFFIX):
+        trace = read_trace_file(log_file)
+    elif cache_dir is not None:
+        trace = read_cache(log_file, cache_dir)
+
+    if trace is not None:
+        for start in range(0, len(trace.timestamp_ns), chunk_rows):
+            yield Trace(*(column[start:start + chunk_rows] for column in trace))
+        return
+
+    for df in pd.read_csv(log_file, names=COLUMNS, dtype=str, chunksize=chunk_rows):
+        yield _parse_frame(df)
+
+
+def cache_path(log_file, cache_dir=CACHE_DIR):
+    key = hashlib.sha1(os.path.abspath(log_file).encode()).hexdigest()
+    return os.path.join(cache_dir, key + TRACE_SUFFIX)
+
+
+def write_trace_file(trace, path, header=None):
+    # Layout: magic, header length, JSON header, then each column aligned to CACHE_ALIGN
+    n_rows = len(trace.timestamp_ns)
+    header = dict(header or {}, rows=n_rows, columns={})
+
+    offset = 0
+    for column, dtype in COLUMN_DTYPES.items():
+        header['columns'][column] = offset
+        nbytes = n_rows * np.dtype(dtype).itemsize
+        offset += -(-nbytes // CACHE_ALIGN) * CACHE_ALIGN
+
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(CACHE_MAGIC) + 8 + len(header_bytes)) // CACHE_ALIGN) * CACHE_ALIGN
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(CACHE_MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for column, dtype in COLUMN_DTYPES.items():
+            f.seek(data_start + header['columns'][column])
+            f.write(np.ascontiguousarray(getattr(trace, column), dtype=dtype).tobytes())
+        f.truncate(data_start + offset)
+    # Atomic rename so concurrent readers never see a partial file
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_trace_header(path):
+    # Returns (header, data_start) of a binary trace file, or None if it is not one
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return None
+            header_len = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(header_len))
+    except (OSError, ValueError):
+        return None
+    data_start = -(-(len(CACHE_MAGIC) + 8 + header_len) // CACHE_ALIGN) * CACHE_ALIGN
+    return header, data_start
+
+
+def read_trace_file(path, header=None):
+    # Memory-map the columns of a binary trace file
+    if header is None:
+        found = read_trace_header(path)
+        if found is None:
+            raise ValueError(f"{path} is not a binary trace file")
+        header = found
+    header, data_start = header
+
+    n_rows = header['rows']
+    if n_rows == 0:
+        return Trace(**{column: np.empty(0, dtype=dtype) for column, dtype in COLUMN_DTYPES.items()})
+
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    columns = {}
+    for column, dtype in COLUMN_DTYPES.items():
+        start = data_start + header['columns'][column]
+        columns[column] = buffer[start:start + n_rows * np.dtype(dtype).itemsize].view(dtype)
+    return Trace(**columns)
+
+
+def write_cache(trace, log_file, cache_dir=CACHE_DIR):
+    stat = os.stat(log_file)
+    header = {'source': os.path.abspath(log_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return write_trace_file(trace, cache_path(log_file, cache_dir), header)
+
+
+def read_cache(log_file, cache_dir=CACHE_DIR):
+    # Return a memory-mapped Trace, or None if the cache entry is missing or stale
+    try:
+        stat = os.stat(log_file)
+    except OSError:
+        return None
+    path = cache_path(log_file, cache_dir)
+    found = read_trace_header(path)
+    if found is None:
+        return None
+
+    header, _ = found
+    if header.get('size') != stat.st_size or header.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+    return read_trace_file(path, found)
+
+
+def load_trace(log_file, cache_dir=CACHE_DIR):
+    # Load a trace through the binary cache, converting the .log on first use.
+    # Binary trace files (TRACE_SUFFIX) are memory-mapped directly.
+    # Recorded in the run metrics as a 'load' (memory map) or 'parse' (CSV conversion) stage.
+    with run_metrics.stage('load', log_file) as record:
+        if log_file.endswith(TRACE_SUFFIX):
+            trace, source = read_trace_file(log_file), log_file
+        else:
+            trace = read_cache(log_file, cache_dir) if cache_dir is not None else None
+            source = cache_path(log_file, cache_dir) if trace is not None else log_file
+        if trace is None:
+            record['stage'] = 'parse'
+            trace = parse_log(log_file)
+            if cache_dir is not None:
+                try:
+                    write_cache(trace, log_file, cache_dir)
+                except OSError as e:
+                    print(f"Warning: Could not cache {log_file}: {e}")
+        record.update(rows=len(trace.timestamp_ns), bad_rows=int((trace.packet_size < 0).sum()),
+                      bytes_read=run_metrics.file_size(source))
+    return trace
+
+
+def modified_trace_path(log_file):
+    # Defended output of a trace: the binary _modified.trc if present, else the _modified.log CSV
+    for suffix in (MODIFIED_TRACE_SUFFIX, MODIFIED_SUFFIX):
+        path = log_file.replace('.log', suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+# Keys of traffic_totals, per trace and summed over traces
+TOTALS_KEYS = ('bytes', 'packets', 'sent_bytes', 'sent_packets', 'received_bytes', 'received_packets')
+
+
+def traffic_totals(trace):
+    # Byte and packet totals over the valid rows of a trace, overall and per direction
+    valid = trace.packet_size >= 0
+    sizes = np.asarray(trace.packet_size[valid], dtype=np.int64)
+    event_codes = trace.event_code[valid]
+    sent = np.isin(event_codes, SENT_CODES)
+    received = np.isin(event_codes, RECEIVED_CODES)
+    return {
+        'bytes': int(sizes.sum()),
+        'packets': int(len(sizes)),
+        'sent_bytes': int(sizes[sent].sum()),
+        'sent_packets': int(sent.sum()),
+        'received_bytes': int(sizes[received].sum()),
+        'received_packets': int(received.sum()),
+    }
+
+
+def add_totals(totals, other):
+    # Sum two traffic_totals dicts
+    return {key: totals[key] + other[key] for key in TOTALS_KEYS}
+
+
+def event_names(event_codes):
+    # Map int8 event codes back to their string names ('' for EVENT_OTHER)
+    names = np.array(EVENT_TYPES + [''], dtype=object)
+    return names[event_codes]
+
+
+def trace_to_dataframe(trace):
+    # Materialize a Trace as a DataFrame with the original six-column schema
+    return pd.DataFrame({
+        'timestamp_ns': np.asarray(trace.timestamp_ns, dtype=np.int64),
+        'event_type': event_names(trace.event_code),
+        'packet_size': np.asarray(trace.packet_size, dtype=np.int64),
+        'absolute_timestamp': np.asarray(trace.absolute_timestamp, dtype=np.int64),
+        'cumulative_sent': np.asarray(trace.cumulative_sent, dtype=np.int64),
+        'cumulative_received': np.asarray(trace.cumulative_received, dtype=np.int64),
+    })
+
+
+def dataframe_to_trace(df):
+    # Inverse of trace_to_dataframe, for traces produced in memory (e.g. by the defense)
+    return Trace(
+        timestamp_ns=df['timestamp_ns'].to_numpy(dtype=np.int64),
+        event_code=df['event_type'].map(EVENT_CODES).fillna(EVENT_OTHER).to_numpy().astype(np.int8),
+        packet_size=df['packet_size'].to_numpy(dtype=np.int32),
+        absolute_timestamp=df['absolute_timestamp'].to_numpy(dtype=np.int64),
+        cumulative_sent=df['cumulative_sent'].to_numpy(dtype=np.int64),
+        cumulative_received=df['cumulative_received'].to_numpy(dtype=np.int64),
+    )